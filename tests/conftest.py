@@ -0,0 +1,3 @@
+# The util modules import each other, and the cycle only resolves when they are imported in the
+# order the bot imports them, starting from codeforces_common.
+from tle.util import codeforces_common  # noqa: F401
@@ -0,0 +1,208 @@
+"""
+    Upgrades databases with the schema from before migrations were versioned.
+"""
+
+import re
+import sqlite3
+
+import pytest
+
+from tle.util.db import migrations
+from tle.util.db.cache_db_conn import CacheDbConn
+from tle.util.db.user_db_conn import UserDbConn
+
+# The tables touched by the migrations, as they were created before versioning.
+LEGACY_USER_SCHEMA = '''
+    CREATE TABLE user_handle (
+        user_id TEXT, guild_id TEXT, handle TEXT, active INTEGER,
+        PRIMARY KEY (user_id, guild_id)
+    );
+    CREATE UNIQUE INDEX ix_user_handle_guild_handle ON user_handle (guild_id, handle);
+    CREATE TABLE cf_user_cache (
+        handle TEXT PRIMARY KEY, first_name TEXT, last_name TEXT, country TEXT, city TEXT,
+        organization TEXT, contribution INTEGER, rating INTEGER, maxRating INTEGER,
+        last_online_time INTEGER, registration_time INTEGER, friend_of_count INTEGER,
+        title_photo TEXT
+    );
+    CREATE TABLE duelist (user_id INTEGER PRIMARY KEY NOT NULL, rating INTEGER NOT NULL,
+                          guild_id TEXT);
+    CREATE TABLE hard75_challenge (
+        user_id TEXT, handle TEXT, current_streak INTEGER, longest_streak INTEGER,
+        c1_id INTEGER, p1_id INTEGER, p1_name TEXT, c2_id INTEGER, p2_id INTEGER, p2_name TEXT,
+        assigned_date TEXT, last_updated TEXT, rating INTEGER, start_date TEXT
+    );
+    CREATE TABLE duel (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, challenger INTEGER NOT NULL,
+        challengee INTEGER NOT NULL, issue_time REAL NOT NULL, start_time REAL,
+        finish_time REAL, problem_name TEXT, contest_id INTEGER, p_index INTEGER,
+        status INTEGER, winner INTEGER, type INTEGER, guild_id TEXT
+    );
+    CREATE TABLE challenge (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, issue_time REAL NOT NULL,
+        finish_time REAL, problem_name TEXT NOT NULL, contest_id INTEGER NOT NULL,
+        p_index INTEGER NOT NULL, rating_delta INTEGER NOT NULL, status INTEGER NOT NULL
+    );
+    CREATE TABLE trainings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, score INTEGER, lives INTEGER,
+        time_left REAL, mode INTEGER NOT NULL, status INTEGER NOT NULL
+    );
+    CREATE TABLE training_problems (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, training_id INTEGER NOT NULL,
+        issue_time REAL NOT NULL, finish_time REAL, problem_name TEXT NOT NULL,
+        contest_id INTEGER NOT NULL, p_index INTEGER NOT NULL, rating INTEGER NOT NULL,
+        status INTEGER NOT NULL
+    );
+    CREATE TABLE lockout_ongoing_rounds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, guild TEXT, users TEXT, rating TEXT, points TEXT,
+        time INT, problems TEXT, status TEXT, duration INTEGER, repeat INTEGER, times TEXT
+    );
+    CREATE TABLE lockout_finished_rounds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, guild TEXT, users TEXT, rating TEXT, points TEXT,
+        time INT, problems TEXT, status TEXT, duration INTEGER, repeat INTEGER, times TEXT,
+        end_time INT
+    );
+
+    INSERT INTO user_handle VALUES ('1', 'g', 'Tourist', 1), ('2', 'g', 'Petr', 1);
+    INSERT INTO cf_user_cache (handle, rating, title_photo)
+        VALUES ('tourist', 3800, 'https://userpic.codeforces.org/tourist.jpg'),
+               ('Petr', 3200, 'https://userpic.codeforces.org/Petr.jpg');
+    INSERT INTO duelist VALUES (1, 1500, 'g');
+    INSERT INTO duel (challenger, challengee, issue_time, status, guild_id)
+        VALUES (1, 2, 100.0, 4, 'g');
+    INSERT INTO challenge (user_id, issue_time, finish_time, problem_name, contest_id, p_index,
+                           rating_delta, status)
+        VALUES ('1', 100.0, 200.0, 'A', 1, 0, 10, 0);
+    INSERT INTO trainings (user_id, score, lives, time_left, mode, status)
+        VALUES ('1', 0, 3, NULL, 0, 1);
+    INSERT INTO lockout_finished_rounds (guild, users, end_time) VALUES ('g', '1 2', 300);
+'''
+
+LEGACY_CACHE_SCHEMA = '''
+    CREATE TABLE rating_change (
+        contest_id INTEGER NOT NULL, handle TEXT NOT NULL, rank INTEGER,
+        rating_update_time INTEGER, old_rating INTEGER, new_rating INTEGER,
+        UNIQUE (contest_id, handle)
+    );
+    CREATE INDEX ix_rating_change_contest_id ON rating_change (contest_id);
+    CREATE INDEX ix_rating_change_handle ON rating_change (handle);
+
+    INSERT INTO rating_change VALUES (1, 'tourist', 1, 100, 0, 1600),
+                                     (2, 'tourist', 1, 200, 1600, 2100),
+                                     (2, 'Petr', 2, 200, 0, 1500);
+'''
+
+
+def _legacy_db(path, schema):
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.commit()
+    return conn
+
+
+def _indexes(conn):
+    return {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def _rows(conn, tables):
+    return {table: conn.execute(f'SELECT * FROM {table} ORDER BY rowid').fetchall()
+            for table in tables}
+
+
+def _index_changes(migration_list):
+    """The indexes the migrations create and those they drop, in the end."""
+    created, dropped = set(), set()
+    for migration in migration_list:
+        for statement in migration.statements:
+            if match := re.match(r'CREATE INDEX IF NOT EXISTS (\w+)', statement):
+                created.add(match[1])
+                dropped.discard(match[1])
+            elif match := re.match(r'DROP INDEX IF EXISTS (\w+)', statement):
+                created.discard(match[1])
+                dropped.add(match[1])
+    return created, dropped
+
+
+@pytest.mark.parametrize('schema, migration_list', [
+    (LEGACY_USER_SCHEMA, UserDbConn.MIGRATIONS),
+    (LEGACY_CACHE_SCHEMA, CacheDbConn.MIGRATIONS),
+], ids=['user', 'cache'])
+def test_upgrade_legacy(tmp_path, schema, migration_list):
+    conn = _legacy_db(tmp_path / 'legacy.db', schema)
+    tables = [name for name, in conn.execute("SELECT name FROM sqlite_master "
+                                             "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    rows = _rows(conn, tables)
+    assert migrations.get_version(conn) == 0
+
+    applied = migrations.upgrade(conn, migration_list)
+
+    assert applied == list(range(1, len(migration_list) + 1))
+    assert migrations.get_version(conn) == len(migration_list)
+    created, dropped = _index_changes(migration_list)
+    indexes = _indexes(conn)
+    assert created <= indexes
+    assert not dropped & indexes
+    assert _rows(conn, tables) == rows
+    assert migrations.upgrade(conn, migration_list) == []
+
+
+def test_upgrade_makes_queries_use_indexes(tmp_path):
+    conn = _legacy_db(tmp_path / 'legacy.db', LEGACY_USER_SCHEMA)
+    migrations.upgrade(conn, UserDbConn.MIGRATIONS)
+    for migration in UserDbConn.MIGRATIONS:
+        for query in migration.queries:
+            plan = ' '.join(migrations.query_plan(conn, query))
+            assert 'USING' in plan, query
+
+
+def test_open_legacy_user_db(tmp_path):
+    path = tmp_path / 'legacy.db'
+    _legacy_db(path, LEGACY_USER_SCHEMA).close()
+    user_db = UserDbConn(str(path))
+    assert migrations.get_version(user_db.conn) == len(UserDbConn.MIGRATIONS)
+    assert user_db.get_handle(1, 'g') == 'Tourist'
+    assert user_db.fetch_cf_user('TOURIST').rating == 3800
+
+
+@pytest.mark.parametrize('schema, migration_list', [
+    (LEGACY_USER_SCHEMA, UserDbConn.MIGRATIONS),
+    (LEGACY_CACHE_SCHEMA, CacheDbConn.MIGRATIONS),
+], ids=['user', 'cache'])
+def test_explain_leaves_file_unchanged(tmp_path, schema, migration_list):
+    path = tmp_path / 'legacy.db'
+    conn = _legacy_db(path, schema)
+    indexes = _indexes(conn)
+    contents = path.read_bytes()
+
+    report = migrations.explain(conn, migration_list)
+
+    assert [version for version, _, _ in report] == list(range(1, len(migration_list) + 1))
+    assert not conn.in_transaction
+    assert path.read_bytes() == contents
+    assert migrations.get_version(conn) == 0
+    assert _indexes(conn) == indexes
+
+
+def test_upgrade_fills_in_gitgud_monthly_scores(tmp_path):
+    from tle.cogs.codeforces import _calculateGitgudMonthlyScore
+
+    conn = _legacy_db(tmp_path / 'legacy.db', LEGACY_USER_SCHEMA)
+    # Completed challenges across deltas, months and more points weeks, and a skipped one.
+    challenges = [('1', 1680400000.0, 1680500000.0, -500), ('1', 1680400000.0, 1680600000.0, 0),
+                  ('1', 1682500000.0, 1682600000.0, 200), ('2', 1682400000.0, 1682900000.0, 300),
+                  ('2', 1690000000.0, 1690100000.0, -100)]
+    conn.executemany('INSERT INTO challenge (user_id, issue_time, finish_time, problem_name, '
+                     'contest_id, p_index, rating_delta, status) VALUES (?, ?, ?, ?, 1, 0, ?, 0)',
+                     [(user_id, issue, finish, 'A', delta)
+                      for user_id, issue, finish, delta in challenges])
+    conn.execute("INSERT INTO challenge (user_id, issue_time, problem_name, contest_id, p_index, "
+                 "rating_delta, status) VALUES ('2', 1690000000.0, 'B', 1, 0, 0, 2)")
+    challenges.append(('1', 100.0, 200.0, 10))
+
+    migrations.upgrade(conn, UserDbConn.MIGRATIONS)
+
+    expected = {}
+    for user_id, issue, finish, delta in challenges:
+        month_start, score = _calculateGitgudMonthlyScore(delta, issue, finish)
+        expected[user_id, month_start] = expected.get((user_id, month_start), 0) + score
+    scores = conn.execute('SELECT user_id, month_start, score FROM gitgud_monthly_score')
+    assert {(user_id, month_start): score for user_id, month_start, score in scores} == expected
@@ -0,0 +1,20 @@
+import sqlite3
+
+from tle.util.db import query_audit
+
+
+def _audit(*queries):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE t (a INTEGER, b TEXT, c TEXT);
+        CREATE INDEX ix_t_a ON t (a);
+        CREATE INDEX ix_t_b_c ON t (b, c);
+    ''')
+    return [entry.full_scans for entry in query_audit.audit(conn, [('m', q) for q in queries])]
+
+
+def test_full_scans():
+    assert _audit('SELECT * FROM t WHERE c = ?',
+                  'SELECT b FROM t ORDER BY b',
+                  'SELECT * FROM t WHERE a = ?',
+                  'SELECT 1') == [['t'], ['t (index ix_t_b_c)'], [], []]
@@ -0,0 +1,138 @@
+"""
+    Checks the vectorized rating calculator against the scalar implementation it replaced.
+"""
+
+import random
+from dataclasses import dataclass
+
+import numpy as np
+import pytest
+from numpy.fft import fft, ifft
+
+from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator, intdiv, predict_deltas
+
+
+@dataclass
+class Contestant:
+    party: str
+    points: float
+    penalty: int
+    rating: int
+    need_rating: int = 0
+    delta: int = 0
+    rank: float = 0.0
+    seed: float = 0.0
+
+
+class ScalarRatingCalculator:
+    """The calculator as it was before it was vectorized, one contestant at a time."""
+
+    def __init__(self, standings):
+        self.contestants = [Contestant(handle, points, penalty, rating)
+                            for handle, points, penalty, rating in standings]
+        self._precalc_seed()
+        self._reassign_ranks()
+        self._process()
+        self._update_delta()
+
+    def calculate_rating_changes(self):
+        return {contestant.party: contestant.delta for contestant in self.contestants}
+
+    def get_seed(self, rating, me=None):
+        seed = self.seed[rating]
+        if me:
+            seed -= self.elo_win_prob[rating - me.rating]
+        return seed
+
+    def _precalc_seed(self):
+        MAX = 6144
+        self.elo_win_prob = np.roll(1 / (1 + pow(10, np.arange(-MAX, MAX) / 400)), -MAX)
+        count = np.zeros(2 * MAX)
+        for a in self.contestants:
+            count[a.rating] += 1
+        self.seed = 1 + ifft(fft(count) * fft(self.elo_win_prob)).real
+
+    def _reassign_ranks(self):
+        contestants = self.contestants
+        contestants.sort(key=lambda o: (-o.points, o.penalty))
+        points = penalty = rank = None
+        for i in reversed(range(len(contestants))):
+            if contestants[i].points != points or contestants[i].penalty != penalty:
+                rank = i + 1
+                points = contestants[i].points
+                penalty = contestants[i].penalty
+            contestants[i].rank = rank
+
+    def _process(self):
+        for a in self.contestants:
+            a.seed = self.get_seed(a.rating, a)
+            mid_rank = (a.rank * a.seed) ** 0.5
+            a.need_rating = self._rank_to_rating(mid_rank, a)
+            a.delta = intdiv(a.need_rating - a.rating, 2)
+
+    def _rank_to_rating(self, rank, me):
+        left, right = 1, 8000
+        while right - left > 1:
+            mid = (left + right) // 2
+            if self.get_seed(mid, me) < rank:
+                right = mid
+            else:
+                left = mid
+        return left
+
+    def _update_delta(self):
+        contestants = self.contestants
+        n = len(contestants)
+
+        contestants.sort(key=lambda o: -o.rating)
+        correction = intdiv(-sum(c.delta for c in contestants), n) - 1
+        for contestant in contestants:
+            contestant.delta += correction
+
+        zero_sum_count = min(4 * round(n ** 0.5), n)
+        delta_sum = -sum(contestants[i].delta for i in range(zero_sum_count))
+        correction = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
+        for contestant in contestants:
+            contestant.delta += correction
+
+
+def random_standings(rng, n, *, max_points, max_penalty):
+    """Standings of `n` contestants. Small point and penalty ranges make for many ties."""
+    return [(f'user{i}', rng.randint(0, max_points) * 0.5, rng.randint(0, max_penalty),
+             rng.randint(0, 4000))
+            for i in range(n)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_scalar(seed):
+    rng = random.Random(seed)
+    standings = random_standings(rng, rng.randint(2, 500), max_points=20, max_penalty=300)
+    assert (CodeforcesRatingCalculator(standings).calculate_rating_changes()
+            == ScalarRatingCalculator(standings).calculate_rating_changes())
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_scalar_with_ties(seed):
+    rng = random.Random(seed)
+    standings = random_standings(rng, rng.randint(2, 300), max_points=3, max_penalty=2)
+    assert (CodeforcesRatingCalculator(standings).calculate_rating_changes()
+            == ScalarRatingCalculator(standings).calculate_rating_changes())
+
+
+def test_matches_scalar_with_everyone_tied():
+    standings = [(f'user{i}', 1.0, 10, 1000 + 100 * i) for i in range(10)]
+    assert (CodeforcesRatingCalculator(standings).calculate_rating_changes()
+            == ScalarRatingCalculator(standings).calculate_rating_changes())
+
+
+@pytest.mark.parametrize('rating', [0, 1500, 4000])
+def test_matches_scalar_with_one_participant(rating):
+    standings = [('user', 3.0, 20, rating)]
+    assert (CodeforcesRatingCalculator(standings).calculate_rating_changes()
+            == ScalarRatingCalculator(standings).calculate_rating_changes())
+
+
+def test_predict_deltas():
+    standings = random_standings(random.Random(0), 50, max_points=10, max_penalty=100)
+    assert predict_deltas(standings) == ScalarRatingCalculator(standings).calculate_rating_changes()
+    assert predict_deltas([]) == {}
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from tle import constants
+from tle.util import cache_system2
+from tle.util import codeforces_api as cf
+from tle.util.db.cache_db_conn import CacheDbConn
+
+
+def _user(handle, rating):
+    return cf.User(handle, None, None, None, None, None, None, rating, rating, None, None, None,
+                   None)
+
+
+class FakeCacheMaster:
+    def __init__(self, conn):
+        self.conn = conn
+        self.contest_cache = None
+
+
+async def _load(rating_cache):
+    # What RatingChangesCache.run does, without starting its tasks.
+    rating_cache._load_redirects()
+    await rating_cache._load_store()
+
+
+@pytest.fixture
+def rating_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, 'RATING_STORE_DIR', str(tmp_path / 'rating_store'))
+    conn = CacheDbConn(str(tmp_path / 'cache.db'))
+    return cache_system2.RatingChangesCache(FakeCacheMaster(conn))
+
+
+@pytest.fixture
+def api_users(monkeypatch):
+    users = {}
+    fetched = []
+
+    async def info_skipping_missing(handles):
+        fetched.append(list(handles))
+        return [users[handle.lower()] for handle in handles if handle.lower() in users]
+
+    monkeypatch.setattr(cf, 'info_skipping_missing', info_skipping_missing)
+    return users, fetched
+
+
+def test_effective_ratings_with_empty_store(rating_cache, api_users):
+    users, fetched = api_users
+    users['rated'] = _user('Rated', 1900)
+    users['unrated'] = _user('unrated', None)
+    asyncio.run(_load(rating_cache))
+    ratings = asyncio.run(rating_cache.get_effective_ratings(['rated', 'unrated', 'missing'],
+                                                             1500))
+    assert ratings == [1900, 1500, 1500]
+    # The API ratings are kept.
+    asyncio.run(rating_cache.get_effective_ratings(['RATED'], 1500))
+    assert fetched == [['rated', 'unrated', 'missing']]
+
+
+def test_effective_ratings_follow_redirects(rating_cache, api_users):
+    _, fetched = api_users
+    conn = rating_cache.cache_master.conn
+    asyncio.run(conn.save_rating_changes([
+        cf.RatingChange(1, None, 'OldName', 1, 100, 0, 1600),
+        cf.RatingChange(2, None, 'OldName', 1, 200, 1600, 1800),
+        cf.RatingChange(2, None, 'other', 2, 200, 0, 1400),
+    ]))
+    asyncio.run(_load(rating_cache))
+    rating_cache.add_handle_redirects([('oldname', 'NewName')])
+    ratings = asyncio.run(rating_cache.get_effective_ratings(['newname', 'Other'], 1500))
+    assert ratings == [1800, 1400]
+    assert fetched == []
+
+
+def test_fetch_contest_without_changes_clears_store(rating_cache, monkeypatch):
+    conn = rating_cache.cache_master.conn
+    asyncio.run(conn.save_rating_changes([
+        cf.RatingChange(1, None, 'tourist', 1, 100, 0, 1600),
+        cf.RatingChange(2, None, 'tourist', 1, 200, 1600, 1800),
+    ]))
+    asyncio.run(_load(rating_cache))
+    rating_cache.cache_master.contest_cache = type('ContestCache', (), {
+        'contest_by_id': {2: object()}})()
+
+    async def fetch(contests):
+        return []
+
+    monkeypatch.setattr(rating_cache, '_fetch', fetch)
+    assert asyncio.run(rating_cache.fetch_contest(2)) == 0
+    assert not rating_cache.has_rating_changes_saved(2)
+    assert [change.newRating for change in
+            rating_cache.get_rating_changes_for_handle('tourist')] == [1600]
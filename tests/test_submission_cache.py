@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from tle.util import cache_system2
+from tle.util import codeforces_api as cf
+from tle.util.db.cache_db_conn import CacheDbConn
+
+
+def _submission(id_, verdict='OK'):
+    problem = cf.Problem(1, None, 'A', 'Problem', 'PROGRAMMING', None, 800, [])
+    author = cf.Party(1, [cf.Member('tourist')], 'PRACTICE', None, None, False, None, 0)
+    return cf.Submission(id_, 1, problem, author, 'C++', verdict, id_, 0)
+
+
+class FakeCacheMaster:
+    def __init__(self, conn):
+        self.conn = conn
+
+
+@pytest.fixture
+def submission_cache(tmp_path):
+    conn = CacheDbConn(str(tmp_path / 'cache.db'))
+    return cache_system2.SubmissionCache(FakeCacheMaster(conn))
+
+
+@pytest.fixture
+def api_submissions(monkeypatch):
+    submissions = []
+    calls = []
+
+    async def status(*, handle, from_=1, count=None):
+        calls.append((handle, from_, count))
+        await asyncio.sleep(0)
+        end = None if count is None else from_ - 1 + count
+        return submissions[from_ - 1:end]
+
+    monkeypatch.setattr(cf.user, 'status', status)
+    return submissions, calls
+
+
+def test_concurrent_calls_share_a_fetch(submission_cache, api_submissions):
+    submissions, calls = api_submissions
+    submissions += [_submission(2), _submission(1)]
+
+    async def get_twice():
+        return await asyncio.gather(submission_cache.get_submissions('tourist'),
+                                    submission_cache.get_submissions('tourist'))
+
+    first, second = asyncio.run(get_twice())
+    assert first == second == submissions
+    assert first is not second
+    assert calls == [('tourist', 1, None)]
+
+
+def test_fetches_only_new_submissions(submission_cache, api_submissions):
+    submissions, calls = api_submissions
+    submissions += [_submission(2, 'TESTING'), _submission(1)]
+    asyncio.run(submission_cache.get_submissions('tourist'))
+    submissions[:] = [_submission(3), _submission(2), _submission(1)]
+
+    assert asyncio.run(submission_cache.get_submissions('tourist')) == submissions
+    # Only the head is fetched again, the submission being judged is part of it.
+    assert calls[1:] == [('tourist', 1, cache_system2.SubmissionCache._HEAD_FETCH_COUNT)]
@@ -0,0 +1,53 @@
+from collections import namedtuple
+
+import pytest
+
+from tle.util.db.user_db_conn import Duel, UserDbConn
+
+Problem = namedtuple('Problem', 'name contestId index rating')
+
+
+@pytest.fixture
+def user_db(tmp_path):
+    return UserDbConn(str(tmp_path / 'user.db'))
+
+
+def _duel_status(user_db, duelid):
+    return user_db.conn.execute('SELECT status FROM duel WHERE id = ?', (duelid,)).fetchone()[0]
+
+
+def test_failed_method_in_batch_keeps_the_rest(user_db):
+    duelid = user_db.create_duel(1, 2, 100, Problem('A', 1, 'A', 800), 0, 'g')
+    with user_db.batch():
+        assert user_db.new_challenge('1', 100, Problem('A', 1, 'A', 800), 10) == 1
+        # The challenge is active, so a second one is rolled back.
+        assert user_db.new_challenge('1', 200, Problem('B', 1, 'B', 800), 10) == 0
+        assert user_db.start_duel(duelid, 'g', 150) == 1
+    challenges = user_db.conn.execute('SELECT problem_name FROM challenge').fetchall()
+    assert [row.problem_name for row in challenges] == ['A']
+    assert _duel_status(user_db, duelid) == Duel.ONGOING
+
+
+def test_failed_batch_rolls_back_everything(user_db):
+    duelid = user_db.create_duel(1, 2, 100, Problem('A', 1, 'A', 800), 0, 'g')
+    with pytest.raises(RuntimeError):
+        with user_db.batch():
+            assert user_db.start_duel(duelid, 'g', 150) == 1
+            raise RuntimeError
+    assert _duel_status(user_db, duelid) == Duel.PENDING
+
+
+def test_failed_method_rolls_back_its_writes(user_db):
+    user_db.new_challenge('1', 100, Problem('A', 1, 'A', 800), 10)
+    assert user_db.new_challenge('1', 200, Problem('B', 1, 'B', 800), 10) == 0
+    assert not user_db.conn.in_transaction
+    assert user_db.conn.execute('SELECT COUNT(*) AS n FROM challenge').fetchone().n == 1
+
+
+def test_update_status(user_db):
+    for user_id, handle in (('1', 'a'), ('2', 'b'), ('3', 'c')):
+        user_db.set_handle(user_id, 'g', handle)
+    user_db.reset_status('g')
+    assert user_db.update_status('g', []) == 0
+    assert user_db.update_status('g', ['1', '3']) == 2
+    assert sorted(user_db.get_handles_for_guild('g')) == [(1, 'a'), (3, 'c')]
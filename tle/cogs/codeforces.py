@@ -33,6 +33,16 @@ def _calculateGitgudScoreForDelta(delta):
     index = (delta - _GITGUD_SCORE_DISTRIB_MIN)//100
     return _GITGUD_SCORE_DISTRIB[index]
 
+def _calculateGitgudMonthlyScore(delta, issue_time, finish_time):
+    """Returns the start of the month a challenge completed at `finish_time` counts for and
+    its monthly points, doubled if it was issued in the more points week of that month."""
+    finish = datetime.datetime.fromtimestamp(finish_time)
+    start_time, end_time = cf_common.get_start_and_end_of_month(finish)
+    score = _calculateGitgudScoreForDelta(delta)
+    if start_time >= _GITGUD_MORE_POINTS_START_TIME and issue_time >= end_time - _ONE_WEEK_DURATION:
+        score *= 2
+    return start_time, score
+
 class CodeforcesCogError(commands.CommandError):
     pass
 
@@ -112,9 +122,9 @@ class Codeforces(commands.Cog):
         rating = round(user.effective_rating, -2)
         rating = max(1100, rating)
         rating = min(3000, rating)
-        resp = await cf.user.rating(handle=handle)
+        resp = await cf_common.cache2.rating_changes_cache.get_history(handle)
         contests = {change.contestId for change in resp}
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
         problems = [prob for prob in cf_common.cache2.problem_cache.problems
                     if prob.name not in solved and prob.contestId in contests]
@@ -164,21 +174,15 @@ class Codeforces(commands.Cog):
                 else:
                     erating = srating
 
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
 
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating >= srating and prob.rating <= erating and prob.name not in solved
-                    and not cf_common.is_contest_writer(prob.contestId, handle)
-                    and prob.matches_all_tags(tags)
-                    and not prob.matches_any_tag(bantags)]
+        problems = cf_common.cache2.problem_cache.problem_index.query(
+            srating, erating, tags=tags, bantags=bantags, exclude_names=solved, writers=[handle])
 
         if not problems:
             raise CodeforcesCogError('Problems not found within the search parameters')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max([random.randrange(len(problems)) for _ in range(3)])
         problem = problems[choice]
 
@@ -203,7 +207,7 @@ class Codeforces(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        submissions = [await cf.user.status(handle=handle) for handle in handles]
+        handles, submissions = await cf_common.get_submissions_reporting_failures(ctx, handles)
         submissions = [sub for subs in submissions for sub in subs]
         submissions = filt.filter_subs(submissions)
 
@@ -255,7 +259,7 @@ class Codeforces(commands.Cog):
 
         handles = handles or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        resp = await cf_common.cache2.submission_cache.get_submissions_for_all(handles)
         submissions = [sub for user in resp for sub in user]
         solved = {sub.problem.name for sub in submissions}
         info = await cf.user.info(handles=handles)
@@ -263,19 +267,13 @@ class Codeforces(commands.Cog):
         rating += delta
         rating = max(800, rating)
         rating = min(3500, rating)
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if abs(prob.rating - rating) <= 300 and prob.name not in solved
-                    and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
-                    and not cf_common.is_nonstandard_problem(prob)
-                    and prob.matches_all_tags(tags)
-                    and not prob.matches_any_tag(bantags)]
+        problems = cf_common.cache2.problem_cache.problem_index.query(
+            rating - 300, rating + 300, tags=tags, bantags=bantags, exclude_names=solved,
+            writers=handles, standard_only=True)
 
         if len(problems) < 4:
             raise CodeforcesCogError('Problems not found within the search parameters')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choices = []
         for i in range(4):
             k = max(random.randrange(len(problems) - i) for _ in range(2))
@@ -317,7 +315,7 @@ class Codeforces(commands.Cog):
         rating = round(user.effective_rating, -2)
         rating = max(1100, rating)
         rating = min(3000, rating)
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions}
         noguds = cf_common.user_db.get_noguds(ctx.message.author.id)
         delta = 0
@@ -338,25 +336,12 @@ class Codeforces(commands.Cog):
 
         await self._validate_gitgud_status(ctx, delta)
         
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if (prob.rating == rating + delta 
-                    and prob.name not in solved 
-                    and prob.name not in noguds)
-                    and prob.matches_all_tags(tags)
-                    and not prob.matches_any_tag(bantags)]
-                        
-
-        def check(problem):
-            return (not cf_common.is_nonstandard_problem(problem) and
-                    not cf_common.is_contest_writer(problem.contestId, handle))
-
-        problems = list(filter(check, problems))
+        problems = cf_common.cache2.problem_cache.problem_index.query(
+            rating + delta, rating + delta, tags=tags, bantags=bantags,
+            exclude_names=solved | noguds, writers=[handle], standard_only=True)
         if not problems:
             raise CodeforcesCogError('No problem to assign')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max(random.randrange(len(problems)) for _ in range(5))
         if tags or bantags:
             delta = delta - 200
@@ -436,7 +421,7 @@ class Codeforces(commands.Cog):
         if not active:
             raise CodeforcesCogError(f'You do not have an active challenge')
 
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
 
         challenge_id, issue_time, name, contestId, index, delta = active
@@ -445,7 +430,9 @@ class Codeforces(commands.Cog):
 
         score = _calculateGitgudScoreForDelta(delta)
         finish_time = int(datetime.datetime.now().timestamp())
-        rc = cf_common.user_db.complete_challenge(user_id, challenge_id, finish_time, score)
+        month_start, monthly_score = _calculateGitgudMonthlyScore(delta, issue_time, finish_time)
+        rc = cf_common.user_db.complete_challenge(user_id, challenge_id, finish_time, score,
+                                                  month_start, monthly_score)
 
         now = datetime.datetime.now()
         start_time, end_time = cf_common.get_start_and_end_of_month(now)
@@ -548,7 +535,7 @@ class Codeforces(commands.Cog):
 
         # subs_by_contest_id contains contest_id mapped to [list of problem.name]
         subs_by_contest_id = defaultdict(set)
-        for sub in await cf.user.status(handle=handle):
+        for sub in await cf_common.cache2.submission_cache.get_submissions(handle):
             if sub.verdict == 'OK':
                 try:
                     contest = cf_common.cache2.contest_cache.get_contest(sub.problem.contestId)
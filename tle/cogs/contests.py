@@ -103,6 +103,17 @@ def _get_ongoing_vc_participants():
         ongoing_vc_participants |= vc_participants
     return ongoing_vc_participants
 
+def _watch_ongoing_vc_participants():
+    """ Makes the submission watcher poll the handles of users registered in an ongoing vc, until
+        their vc is finished.
+    """
+    handles = []
+    for vc_id in cf_common.user_db.get_ongoing_rated_vc_ids():
+        vc = cf_common.user_db.get_rated_vc(vc_id)
+        handles += [cf_common.user_db.get_handle(member_id, vc.guild_id)
+                    for member_id in cf_common.user_db.get_rated_vc_user_ids(vc_id)]
+    cf_common.cache2.submission_watcher.watch('ratedvc', handles)
+
 class Contests(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -554,6 +565,7 @@ class Contests(commands.Cog):
         start_time = time.time()
         finish_time = start_time + contest.durationSeconds + _RATED_VC_EXTRA_TIME
         cf_common.user_db.create_rated_vc(contest_id, start_time, finish_time, ctx.guild.id, [member.id for member in members])
+        _watch_ongoing_vc_participants()
         title = f'Starting {contest.name} for:'
         msg = "\n".join(f'[{discord.utils.escape_markdown(handle)}]({cf.PROFILE_BASE_URL}{handle})' for handle in handles)
         embed = discord_common.cf_color_embed(title=title, description=msg, url=contest.url)
@@ -626,7 +638,10 @@ class Contests(commands.Cog):
         ranklist = await cf_common.cache2.ranklist_cache.generate_vc_ranklist(vc.contest_id, handle_to_member_id)
 
         async def has_running_subs(handle):
-            return [sub for sub in await cf.user.status(handle=handle)
+            # Submissions being judged are among the latest ones, which the submission watcher
+            # polls for the participants of ongoing vcs.
+            watcher = cf_common.cache2.submission_watcher
+            return [sub for sub in await watcher.get_recent_submissions(handle)
                     if sub.verdict == 'TESTING' and
                        sub.problem.contestId == vc.contest_id and
                        sub.relativeTimeSeconds <= vc.finish_time - vc.start_time]
@@ -642,27 +657,31 @@ class Contests(commands.Cog):
             return
         rating_change_by_handle = {}
         RatingChange = namedtuple('RatingChange', 'handle oldRating newRating')
-        for handle, member_id in zip(handles, member_ids):
-            delta = ranklist.delta_by_handle.get(handle)
-            if delta is None:  # The user did not participate.
-                cf_common.user_db.remove_last_ratedvc_participation(member_id)
-                continue
-            old_rating = cf_common.user_db.get_vc_rating(member_id)
-            new_rating = old_rating + delta
-            rating_change_by_handle[handle] = RatingChange(handle=handle, oldRating=old_rating, newRating=new_rating)
-            cf_common.user_db.update_vc_rating(vc_id, member_id, new_rating)
-        cf_common.user_db.finish_rated_vc(vc_id)
+        with cf_common.user_db.batch():
+            for handle, member_id in zip(handles, member_ids):
+                delta = ranklist.delta_by_handle.get(handle)
+                if delta is None:  # The user did not participate.
+                    cf_common.user_db.remove_last_ratedvc_participation(member_id)
+                    continue
+                old_rating = cf_common.user_db.get_vc_rating(member_id)
+                new_rating = old_rating + delta
+                rating_change_by_handle[handle] = RatingChange(handle=handle, oldRating=old_rating, newRating=new_rating)
+                cf_common.user_db.update_vc_rating(vc_id, member_id, new_rating)
+            cf_common.user_db.finish_rated_vc(vc_id)
         await channel.send(embed=self._make_vc_rating_changes_embed(channel.guild, vc.contest_id, rating_change_by_handle))
         await self._show_ranklist(channel, vc.contest_id, handles, ranklist=ranklist, vc=True)
 
     @tasks.task_spec(name='WatchRatedVCs',
                      waiter=tasks.Waiter.fixed_delay(_WATCHING_RATED_VC_WAIT_TIME))
     async def _watch_rated_vcs_task(self, _):
+        _watch_ongoing_vc_participants()
         ongoing_rated_vcs = cf_common.user_db.get_ongoing_rated_vc_ids()
         if ongoing_rated_vcs is None:
             return
         for rated_vc_id in ongoing_rated_vcs:
             await self._watch_rated_vc(rated_vc_id)
+        # Participants of the vcs finished just now are not watched anymore.
+        _watch_ongoing_vc_participants()
 
     @commands.command(brief='Unregister this user from an ongoing ratedvc', usage='@user')
     @commands.has_any_role(constants.TLE_ADMIN, constants.TLE_MODERATOR)
@@ -771,7 +790,7 @@ class Contests(commands.Cog):
         ]
         plt.legend(labels, loc='upper left', prop=gc.fontprop)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='VC rating graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -830,7 +849,7 @@ class Contests(commands.Cog):
         ]
         plt.legend(labels, loc='upper left', prop=gc.fontprop)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='VC performance graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -875,14 +894,12 @@ class Contests(commands.Cog):
                 # get rating of contestants from cache
                 # we want to have the rating before the contest we query for
                 from_cache = True
-                cached_ratings = cf_common.cache2.rating_changes_cache.get_all_ratings_before_timestamp(reqcontest[0].startTimeSeconds)
-                for row in ranklist:
-                    member = row.party.members[0].handle
+                members = [row.party.members[0].handle for row in ranklist]
+                cached_ratings = cf_common.cache2.rating_changes_cache.get_ratings_before_timestamp(
+                    reqcontest[0].startTimeSeconds, members)
+                for member in members:
                     # members not in cache are considered new (Unrated)
-                    if member in cached_ratings:
-                        rating_cache[member] = cached_ratings[member].newRating
-                    else:
-                        rating_cache[member] = 0
+                    rating_cache[member] = cached_ratings.get(member, 0)
             else:
                 for change in rating_change:
                     rating_cache[change.handle] = change.oldRating
@@ -15,6 +15,7 @@ from tle.util import codeforces_api as cf
 from tle.util import codeforces_common as cf_common
 from tle.util import paginator
 from tle.util import discord_common
+from tle.util import events
 from tle.util import table
 from tle.util import graph_common as gc
 from tle.util.elo import _ELO_CONSTANT
@@ -117,14 +118,44 @@ class Dueling(commands.Cog):
         self.bot = bot
         self.converter = commands.MemberConverter()
         self.draw_offers = {}
+        # Held while completing a duel, so that it is not completed twice by the periodic check,
+        # a submission verdict and a command at the same time.
+        self._complete_lock = asyncio.Lock()
 
     @commands.Cog.listener()
     @discord_common.once
     async def on_ready(self):
+        cf_common.event_sys.add_listener(self._on_submission_verdict)
         asyncio.create_task(self._check_ongoing_duels())
-    
+
+    def _watch_ongoing_duels(self):
+        handles = [cf_common.user_db.get_handle(userid, guild.id)
+                   for guild in self.bot.guilds
+                   for entry in cf_common.user_db.get_ongoing_duels(guild.id)
+                   for userid in (entry.challenger, entry.challengee)]
+        cf_common.cache2.submission_watcher.watch('duel', handles)
+
+    @events.listener_spec(name='DuelSubmissionVerdictListener',
+                          event_cls=events.SubmissionVerdict,
+                          with_lock=True)
+    async def _on_submission_verdict(self, event):
+        solved = {sub.problem.name for sub in event.submissions if sub.verdict == 'OK'}
+        if not solved:
+            return
+        for guild in self.bot.guilds:
+            userid = cf_common.user_db.get_user_id(event.handle, guild.id)
+            if userid is None:
+                continue
+            entry = cf_common.user_db.check_duel_complete(userid, guild.id)
+            if entry is None or entry.problem_name not in solved:
+                continue
+            channel = self.bot.get_channel(cf_common.user_db.get_duel_channel(guild.id))
+            if channel is not None:
+                await self._check_duel_complete(guild, channel, entry, True)
+
     async def _check_ongoing_duels(self):
         try:
+            self._watch_ongoing_duels()
             for guild in self.bot.guilds:
                 await self._check_ongoing_duels_for_guild(guild)    
         except Exception as exception:
@@ -162,8 +193,11 @@ class Dueling(commands.Cog):
                 if challengee is None:
                     logger.warn(f'_check_ongoing_duels_for_guild: member with {challengee_id} could not be retrieved.')
 
-                embed = complete_duel(duelid, guild.id, Winner.DRAW,
-                                challenger, challengee, now, 0.5, dtype)
+                async with self._complete_lock:
+                    if not self._is_ongoing(guild, entry):
+                        continue
+                    embed = complete_duel(duelid, guild.id, Winner.DRAW,
+                                    challenger, challengee, now, 0.5, dtype)
                 timelimit = cf_common.pretty_time_format(_DUEL_MAX_DUEL_DURATION) 
                 await channel.send(f'Auto draw of duel between {challenger.mention} and {challengee.mention} since it was active for more than {timelimit}.', embed=embed)    
 
@@ -221,7 +255,7 @@ class Dueling(commands.Cog):
         userids = [challenger_id, challengee_id]
         handles = [cf_common.user_db.get_handle(
             userid, ctx.guild.id) for userid in userids]
-        submissions = [await cf.user.status(handle=handle) for handle in handles]
+        submissions = await cf_common.cache2.submission_cache.get_submissions_for_all(handles)
 
         if not cf_common.user_db.is_duelist(challenger_id, ctx.guild.id):
             cf_common.user_db.register_duelist(challenger_id, ctx.guild.id)
@@ -258,12 +292,9 @@ class Dueling(commands.Cog):
                 in cf_common.user_db.get_duel_problem_names(userid, ctx.guild.id)} # maybe guild id is not needed here
 
         def get_problems(rating):
-            return [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating == rating and prob.name not in solved and prob.name not in seen
-                    and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
-                    and not cf_common.is_nonstandard_problem(prob)
-                    and prob.matches_all_tags(tags)
-                    and not prob.matches_any_tag(bantags)]
+            return cf_common.cache2.problem_cache.problem_index.query(
+                rating, rating, tags=tags, bantags=bantags, exclude_names=solved | seen,
+                writers=handles, standard_only=True)
 
         for problems in map(get_problems, range(rating, 400, -100)):
             if problems:
@@ -274,9 +305,6 @@ class Dueling(commands.Cog):
             raise DuelCogError(
                 f'No unsolved {rstr}problems left for {ctx.author.mention} vs {opponent.mention}.')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max(random.randrange(len(problems)) for _ in range(5))
         problem = problems[choice]
 
@@ -365,6 +393,7 @@ class Dueling(commands.Cog):
         if rc != 1:
             raise DuelCogError(
                 f'Unable to start the duel between {challenger.mention} and {ctx.author.mention}.')
+        self._watch_ongoing_duels()
 
         problem = cf_common.cache2.problem_cache.problem_by_name[name]
         title = f'{problem.index}. {problem.name}'
@@ -374,8 +403,11 @@ class Dueling(commands.Cog):
         embed.add_field(name='Rating', value=problem.rating)
         await ctx.send(f'Starting duel: {challenger.mention} vs {ctx.author.mention}', embed=embed)
     
-    async def _get_solve_time(self, handle, contest_id, index):
-        subs = [sub for sub in await cf.user.status(handle=handle)
+    async def _get_solve_time(self, handle, contest_id, index, fresh=True):
+        """Unless `fresh` is set, the submissions of the last poll of the submission watcher
+        are used."""
+        watcher = cf_common.cache2.submission_watcher
+        subs = [sub for sub in await watcher.get_recent_submissions(handle, fresh=fresh)
                 if (sub.verdict == 'OK' or sub.verdict == 'TESTING')
                 and sub.problem.contestId == contest_id
                 and sub.problem.index == index]
@@ -442,7 +474,18 @@ class Dueling(commands.Cog):
                             winner, loser, win_time, 1, dtype)
         await ctx.send(f'{loser.mention} gave up. {winner.mention} won the duel against {loser.mention}!', embed=embed)
 
+    @staticmethod
+    def _is_ongoing(guild, data):
+        current = cf_common.user_db.check_duel_complete(data.challenger, guild.id)
+        return current is not None and current.id == data.id
+
     async def _check_duel_complete(self, guild, channel, data, isAutoComplete = False):
+        async with self._complete_lock:
+            # The duel may have been completed while waiting for the lock.
+            if self._is_ongoing(guild, data):
+                await self._check_duel_complete_locked(guild, channel, data, isAutoComplete)
+
+    async def _check_duel_complete_locked(self, guild, channel, data, isAutoComplete):
         duelid, challenger_id, challengee_id, start_timestamp, problem_name, contest_id, index, dtype = data
 
         # get discord member
@@ -460,8 +503,9 @@ class Dueling(commands.Cog):
         highrated_member = challenger if users[0].effective_rating > users[1].effective_rating else challengee
         lowrated_member = challengee if users[0].effective_rating > users[1].effective_rating else challenger
         higherrated_rating, lowerrated_rating = highrated_user.effective_rating, lowrated_user.effective_rating
-        highrated_timestamp = await self._get_solve_time(highrated_user.handle, contest_id, index)
-        lowrated_timestamp = await self._get_solve_time(lowrated_user.handle, contest_id, index) 
+        fresh = not isAutoComplete
+        highrated_timestamp = await self._get_solve_time(highrated_user.handle, contest_id, index, fresh)
+        lowrated_timestamp = await self._get_solve_time(lowrated_user.handle, contest_id, index, fresh)
 
 
         # no pending submissions allowed
@@ -891,7 +935,7 @@ class Dueling(commands.Cog):
         ]
         plt.legend(labels, loc='upper left', prop=gc.fontprop)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Duel rating graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -1,4 +1,3 @@
-import bisect
 import collections
 import datetime as dt
 import time
@@ -33,6 +32,12 @@ CONTEST_ACTIVE_TIME_CUTOFF = 90 * 24 * 60 * 60 # 90 days
 class GraphCogError(commands.CommandError):
     pass
 
+async def _send_plot(ctx, discord_file, title):
+    embed = discord_common.cf_color_embed(title=title)
+    discord_common.attach_image(embed, discord_file)
+    discord_common.set_author_footer(embed, ctx.author)
+    await ctx.send(embed=embed, file=discord_file)
+
 def nice_sub_type(types):
     nice_map = {'CONTESTANT':'Contest: {}',
                 'OUT_OF_COMPETITION':'Unofficial: {}',
@@ -240,8 +245,17 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.rating(handle=handle) for handle in handles]
+        title = 'Rating graph on Codeforces'
+        resp = await cf_common.cache2.rating_changes_cache.get_histories(handles)
         resp = [filt.filter_rating_changes(rating_changes) for rating_changes in resp]
+        # The histories are part of the key, as they are fetched from the API when the saved
+        # ones are incomplete.
+        cache_key = ('rating', tuple(handles), zoom, number, peak,
+                     tuple(tuple(rating_changes) for rating_changes in resp))
+        discord_file = gc.plot_cache.get(cache_key)
+        if discord_file is not None:
+            await _send_plot(ctx, discord_file, title)
+            return
 
         if not any(resp):
             handles_str = ', '.join(f'`{handle}`' for handle in handles)
@@ -285,11 +299,8 @@ class Graphs(commands.Cog):
                     max_rating = max(max_rating, rating.newRating)
             plt.ylim(min_rating - 100, max_rating + 200)
 
-        discord_file = gc.get_current_figure_as_file()
-        embed = discord_common.cf_color_embed(title='Rating graph on Codeforces')
-        discord_common.attach_image(embed, discord_file)
-        discord_common.set_author_footer(embed, ctx.author)
-        await ctx.send(embed=embed, file=discord_file)
+        discord_file = await gc.get_current_figure_as_file(cache_key=cache_key)
+        await _send_plot(ctx, discord_file, title)
 
 
     @plot.command(brief='Plot Codeforces performance graph', aliases=['perf'], usage='[+zoom] [+peak] [handles...] [d>=[[dd]mm]yyyy] [d<[[dd]mm]yyyy]')
@@ -301,7 +312,7 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.rating(handle=handle) for handle in handles]
+        resp = await cf_common.cache2.rating_changes_cache.get_histories(handles)
         # extract last rating before corrections
         current_ratings = [rating_changes[-1].newRating if rating_changes else 'Unrated' for rating_changes in resp]
         resp = cf.user.correct_rating_changes(resp=resp)
@@ -342,7 +353,7 @@ class Graphs(commands.Cog):
                     max_rating = max(max_rating, rating.newRating)
             plt.ylim(min_rating - 100, max_rating + 200)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Performance graph on Codeforces')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -367,7 +378,7 @@ class Graphs(commands.Cog):
 
         handles = args or ('!' + str(ctx.author),)
         handle, = await cf_common.resolve_handles(ctx, self.converter, handles)
-        ratingchanges = await cf.user.rating(handle=handle)
+        ratingchanges = await cf_common.cache2.rating_changes_cache.get_history(handle)
         if not ratingchanges:
             raise GraphCogError(f'User {handle} is not rated')
 
@@ -375,7 +386,7 @@ class Graphs(commands.Cog):
         contest_ids = [change.contestId for change in ratingchanges]
         
         subs_by_contest_id = {contest_id: [] for contest_id in contest_ids}
-        for sub in await cf.user.status(handle=handle):
+        for sub in await cf_common.cache2.submission_cache.get_submissions(handle):
             if sub.contestId in subs_by_contest_id:
                 subs_by_contest_id[sub.contestId].append(sub)
 
@@ -389,7 +400,7 @@ class Graphs(commands.Cog):
         rating = max(ratingchanges, key=lambda change: change.ratingUpdateTimeSeconds).newRating
         _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolved, legend)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Codeforces extremes graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -404,7 +415,7 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        handles, resp = await cf_common.get_submissions_reporting_failures(ctx, handles)
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
@@ -441,7 +452,7 @@ class Graphs(commands.Cog):
             plt.hist(all_ratings, bins=hist_bins)
             plt.legend(labels, loc='upper right')
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Histogram of problems solved on Codeforces')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -467,7 +478,7 @@ class Graphs(commands.Cog):
 
         handles = handles or ['!' + str(ctx.author)]
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        handles, resp = await cf_common.get_submissions_reporting_failures(ctx, handles)
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
@@ -523,7 +534,7 @@ class Graphs(commands.Cog):
         plt.gca().xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
 
         plt.gcf().autofmt_xdate()
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Histogram of number of solved problems over time')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -537,7 +548,7 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        handles, resp = await cf_common.get_submissions_reporting_failures(ctx, handles)
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
@@ -560,7 +571,7 @@ class Graphs(commands.Cog):
         plt.legend(labels)
 
         plt.gcf().autofmt_xdate()
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Curve of number of solved problems over time')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -591,9 +602,9 @@ class Graphs(commands.Cog):
 
         handle = handle or '!' + str(ctx.author)
         handle, = await cf_common.resolve_handles(ctx, self.converter, (handle,))
-        rating_resp = [await cf.user.rating(handle=handle)]
+        rating_resp = [await cf_common.cache2.rating_changes_cache.get_history(handle)]
         rating_resp = [filt.filter_rating_changes(rating_changes) for rating_changes in rating_resp]
-        submissions = filt.filter_subs(await cf.user.status(handle=handle))
+        submissions = filt.filter_subs(await cf_common.cache2.submission_cache.get_submissions(handle))
 
         def extract_time_and_rating(submissions):
             return [(dt.datetime.fromtimestamp(sub.creationTimeSeconds), sub.problem.rating)
@@ -626,22 +637,28 @@ class Graphs(commands.Cog):
         ymin, ymax = plt.gca().get_ylim()
         plt.ylim(max(ymin, filt.rlo - 100), min(ymax, filt.rhi + 100))
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title=f'Rating vs solved problem rating for {handle}')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
         await ctx.send(embed=embed, file=discord_file)
 
-    async def _rating_hist(self, ctx, ratings, mode, binsize, title):
+    async def _rating_hist(self, ctx, ratings, mode, binsize, title, cache_key=None):
         if mode not in ('log', 'normal'):
             raise GraphCogError('Mode should be either `log` or `normal`')
 
-        ratings = [r for r in ratings if r >= 0]
-        assert ratings, 'Cannot histogram plot empty list of ratings'
+        discord_file = gc.plot_cache.get(cache_key)
+        if discord_file is not None:
+            await _send_plot(ctx, discord_file, title)
+            return
+
+        ratings = np.asarray(ratings, dtype=np.int64)
+        ratings = ratings[ratings >= 0]
+        assert len(ratings), 'Cannot histogram plot empty list of ratings'
 
         assert 100%binsize == 0 # because bins is semi-hardcoded
 
-        bins = 1 + max(ratings) // binsize
+        bins = 1 + int(ratings.max()) // binsize
 
         colors = []
         low, high = 0, binsize * bins
@@ -650,9 +667,7 @@ class Graphs(commands.Cog):
                 colors.append('#' + '%06x' % rank.color_embed)
         assert len(colors) == bins, f'Expected {bins} colors, got {len(colors)}'
 
-        height = [0] * bins
-        for r in ratings:
-            height[r // binsize] += 1
+        height = np.bincount(ratings // binsize, minlength=bins).tolist()
 
         csum = 0
         cent = [0]
@@ -682,13 +697,9 @@ class Graphs(commands.Cog):
         plt.xlabel('Rating')
         plt.ylabel('Number of users')
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file(preset='large', cache_key=cache_key)
         plt.close(fig)
-
-        embed = discord_common.cf_color_embed(title=title)
-        discord_common.attach_image(embed, discord_file)
-        discord_common.set_author_footer(embed, ctx.author)
-        await ctx.send(embed=embed, file=discord_file)
+        await _send_plot(ctx, discord_file, title)
 
     @plot.command(brief='Show server rating distribution')
     async def distrib(self, ctx):
@@ -704,7 +715,8 @@ class Graphs(commands.Cog):
                                 ratings,
                                 'normal',
                                 binsize=100,
-                                title='Rating distribution of server members')
+                                title='Rating distribution of server members',
+                                cache_key=('distrib', tuple(sorted(ratings))))
 
     @plot.command(brief='Show Codeforces rating distribution', usage='[normal/log] [active/all] [contest_cutoff=5]')
     async def cfdistrib(self, ctx, mode: str = 'log', activity = 'active', contest_cutoff: int = 5):
@@ -715,18 +727,27 @@ class Graphs(commands.Cog):
         if activity not in ['active', 'all']:
             raise GraphCogError('Activity should be either `active` or `all`')
 
+        title = f'Rating distribution of {activity} Codeforces users ({mode} scale)'
+        rating_cache = cf_common.cache2.rating_changes_cache
         time_cutoff = int(time.time()) - CONTEST_ACTIVE_TIME_CUTOFF if activity == 'active' else 0
-        handles = cf_common.cache2.rating_changes_cache.get_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
-        if not handles:
+        time_cutoff = rating_cache.round_time_cutoff(time_cutoff)
+        cache_key = ('cfdistrib', mode, activity, time_cutoff, contest_cutoff,
+                     rating_cache.ratings_last_cache)
+        discord_file = gc.plot_cache.get(cache_key)
+        if discord_file is not None:
+            await _send_plot(ctx, discord_file, title)
+            return
+
+        ratings = rating_cache.get_ratings_of_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
+        if not len(ratings):
             raise GraphCogError('No Codeforces users meet the specified criteria')
 
-        ratings = [cf_common.cache2.rating_changes_cache.get_current_rating(handle) for handle in handles]
-        title = f'Rating distribution of {activity} Codeforces users ({mode} scale)'
         await self._rating_hist(ctx,
                                 ratings,
                                 mode,
                                 binsize=100,
-                                title=title)
+                                title=title,
+                                cache_key=cache_key)
 
     @plot.command(brief='Show percentile distribution on codeforces', usage='[+zoom] [+nomarker] [handles...] [+exact]')
     async def centile(self, ctx, *args: str):
@@ -736,12 +757,7 @@ class Graphs(commands.Cog):
         intervals = [(rank.low, rank.high) for rank in cf.RATED_RANKS]
         colors = [rank.color_graph for rank in cf.RATED_RANKS]
 
-        ratings = cf_common.cache2.rating_changes_cache.get_all_ratings()
-        ratings = np.array(sorted(ratings))
-        n = len(ratings)
-        perc = 100*np.arange(n)/n
-
-        users_to_mark = {}
+        user_ratings = {}
         if not nomarker:
             handles = args or ('!' + str(ctx.author),)
             handles = await cf_common.resolve_handles(ctx,
@@ -754,9 +770,24 @@ class Graphs(commands.Cog):
             for info in infos:
                 if info.rating is None:
                     raise GraphCogError(f'User `{info.handle}` is not rated')
-                ix = bisect.bisect_left(ratings, info.rating)
-                cent = 100*ix/len(ratings)
-                users_to_mark[info.handle] = info.rating,cent
+                user_ratings[info.handle] = info.rating
+
+        title = 'Rating/percentile relationship'
+        cache_key = ('centile', zoom, exact, tuple(sorted(user_ratings.items())),
+                     cf_common.cache2.rating_changes_cache.ratings_last_cache)
+        discord_file = gc.plot_cache.get(cache_key)
+        if discord_file is not None:
+            await _send_plot(ctx, discord_file, title)
+            return
+
+        ratings = cf_common.cache2.rating_changes_cache.sorted_ratings
+        n = len(ratings)
+        perc = 100*np.arange(n)/n
+
+        users_to_mark = {}
+        for handle, rating in user_ratings.items():
+            cent = cf_common.cache2.rating_changes_cache.get_percentile(rating)
+            users_to_mark[handle] = rating,cent
 
         # Plot
         plt.clf()
@@ -836,11 +867,8 @@ class Graphs(commands.Cog):
             vert_line(x)
 
         # Discord stuff
-        discord_file = gc.get_current_figure_as_file()
-        embed = discord_common.cf_color_embed(title=f'Rating/percentile relationship')
-        discord_common.attach_image(embed, discord_file)
-        discord_common.set_author_footer(embed, ctx.author)
-        await ctx.send(embed=embed, file=discord_file)
+        discord_file = await gc.get_current_figure_as_file(cache_key=cache_key)
+        await _send_plot(ctx, discord_file, title)
 
     @plot.command(brief='Plot histogram of gudgiting')
     async def howgud(self, ctx, *members: discord.Member):
@@ -864,7 +892,7 @@ class Graphs(commands.Cog):
         plt.ylabel('Number solved')
         plt.legend(labels, prop=gc.fontprop)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         embed = discord_common.cf_color_embed(title='Histogram of gudgitting')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -905,7 +933,7 @@ class Graphs(commands.Cog):
             ax.tick_params(axis='x', length=4, color=ax.spines['bottom'].get_edgecolor())
             plt.xlabel('Country')
             plt.ylabel('Number of members')
-            discord_file = gc.get_current_figure_as_file()
+            discord_file = await gc.get_current_figure_as_file(preset='large')
             plt.close(fig)
             embed = discord_common.cf_color_embed(title='Distribution of server members by country')
         else:
@@ -934,7 +962,7 @@ class Graphs(commands.Cog):
             plt.legend().remove()
             plt.xlabel('Country')
             plt.ylabel('Rating')
-            discord_file = gc.get_current_figure_as_file()
+            discord_file = await gc.get_current_figure_as_file()
             embed = discord_common.cf_color_embed(title='Rating distribution of server members by '
                                                         'country')
 
@@ -1024,7 +1052,7 @@ class Graphs(commands.Cog):
                      markersize=5,
                      color='black')
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file(preset='large')
         plt.close(fig)
 
         embed = discord_common.cf_color_embed(title=title)
@@ -1052,7 +1080,7 @@ class Graphs(commands.Cog):
 
         handles = handles or ['!' + str(ctx.author)]
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        handles, resp = await cf_common.get_submissions_reporting_failures(ctx, handles)
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         plt.clf()
@@ -1118,7 +1146,7 @@ class Graphs(commands.Cog):
         ticks = plt.gca().get_xticks()
         base = ticks[1] - ticks[0]
         plt.gca().get_xaxis().set_major_locator(MultipleLocator(base = max(base // 100 * 100, 100)))
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = await gc.get_current_figure_as_file()
         title = f'Plot of {"median" if use_median else "average"} time spent on a problem'
         embed = discord_common.cf_color_embed(title=title)
         discord_common.attach_image(embed, discord_file)
@@ -7,6 +7,7 @@ import html
 import cairo
 import gi
 import datetime
+import time
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
 from gi.repository import Pango, PangoCairo
@@ -39,6 +40,7 @@ _PRETTY_HANDLES_PER_PAGE = 10
 _TOP_DELTAS_COUNT = 10
 _MAX_RATING_CHANGES_PER_EMBED = 15
 _UPDATE_HANDLE_STATUS_INTERVAL = 6 * 60 * 60  # 6 hours
+_UNMAGIC_PROGRESS_INTERVAL = 3  # seconds
 
 _DIVISION_RATING_LOW  = (2100, 1600, -1000)
 _DIVISION_RATING_HIGH = (9999, 2099,  1599)
@@ -289,8 +291,9 @@ class Handles(commands.Cog):
     async def _updatestatus(self, ctx):
         gid = ctx.guild.id
         active_ids = [m.id for m in ctx.guild.members]
-        cf_common.user_db.reset_status(gid)
-        rc = sum(cf_common.user_db.update_status(gid, chunk) for chunk in paginator.chunkify(active_ids, 100))
+        with cf_common.user_db.batch():
+            cf_common.user_db.reset_status(gid)
+            rc = cf_common.user_db.update_status(gid, active_ids)
         await ctx.send(f'{rc} members active with handle')
 
     @commands.Cog.listener()
@@ -479,10 +482,26 @@ class Handles(commands.Cog):
             member = ctx.guild.get_member(user_id)
             handles.append(handle)
             rev_lookup[handle] = member
-        await self._unmagic_handles(ctx, handles, rev_lookup)
+        await self._unmagic_handles(ctx, handles, rev_lookup, show_progress=True)
 
-    async def _unmagic_handles(self, ctx, handles, rev_lookup):
-        handle_cf_user_mapping = await cf.resolve_redirects(handles)
+    async def _unmagic_handles(self, ctx, handles, rev_lookup, show_progress=False):
+        progress_message = None
+        last_progress_time = 0
+
+        async def report_progress(done, total):
+            nonlocal progress_message, last_progress_time
+            now = time.monotonic()
+            if done < total and now - last_progress_time < _UNMAGIC_PROGRESS_INTERVAL:
+                return
+            last_progress_time = now
+            embed = discord_common.embed_neutral(f'Resolved {done}/{total} handle redirects')
+            if progress_message is None:
+                progress_message = await ctx.send(embed=embed)
+            else:
+                await progress_message.edit(embed=embed)
+
+        handle_cf_user_mapping = await cf.resolve_redirects(
+            handles, progress=report_progress if show_progress else None)
         mapping = {(rev_lookup[handle], handle): cf_user
                    for handle, cf_user in handle_cf_user_mapping.items()}
         summary_embed = await self._fix_and_report(ctx, mapping)
@@ -497,6 +516,7 @@ class Handles(commands.Cog):
             else:
                 await self._set(ctx, member, cf_user)
                 fixed.append((handle, cf_user.handle))
+        cf_common.cache2.rating_changes_cache.add_handle_redirects(fixed)
 
         # Return summary embed
         lines = []
@@ -513,9 +533,6 @@ class Handles(commands.Cog):
     @commands.command(brief="Show gudgitters", aliases=["gitgudders", "gitbadders"], usage="[div1|div2|div3] [+all]")
     async def gudgitters(self, ctx, *args):
         """Show the list of users of gitgud with their scores."""
-        res = cf_common.user_db.get_gudgitters()
-        res.sort(key=lambda r: r[1], reverse=True)
-        
         division = None
         showall = False
         for arg in args:
@@ -529,32 +546,20 @@ class Handles(commands.Cog):
             if arg == "+all":
                 showall = True
 
+        if division is None:
+            res = await cf_common.user_db.get_gudgitters_for_guild(ctx.guild.id)
+        else:
+            res = await cf_common.user_db.get_gudgitters_for_guild(
+                ctx.guild.id, _DIVISION_RATING_LOW[division-1], _DIVISION_RATING_HIGH[division-1])
+
         rankings = []
-        index = 0
-        for user_id, score in res:
+        for user_id, handle, rating, score in res:
             member = ctx.guild.get_member(int(user_id))
             if not showall and member is None:
                 continue
-            if score > 0:
-                handle = cf_common.user_db.get_handle(user_id, ctx.guild.id)
-                user = cf_common.user_db.fetch_cf_user(handle)
-                if user is None:
-                    continue
-                rating = user.rating
-
-                discord_handle = ""
-                if member is not None: 
-                    discord_handle = member.display_name
-                
-                
-                if division is not None:
-                    if rating is None: continue;
-                    if rating < _DIVISION_RATING_LOW[division-1] or rating > _DIVISION_RATING_HIGH[division-1]:
-                        continue
-                
-                rankings.append((index, discord_handle, handle, rating, score))
-                index += 1
-            if index == 20:
+            discord_handle = member.display_name if member is not None else ""
+            rankings.append((len(rankings), discord_handle, handle, rating, score))
+            if len(rankings) == 20:
                 break
 
         if not rankings:
@@ -577,13 +582,7 @@ class Handles(commands.Cog):
             if arg[0:2] == 'd=':
                 now = parse_date(arg[2:])
 
-        start_time, end_time = cf_common.get_start_and_end_of_month(now)
-        
-        # more points seasons start at April 1st 2023 (timestamp: 1680300000) and is only active in the last 7 days of the month
-        morePointsActive = False
-        morePointsTime = end_time - cfc._ONE_WEEK_DURATION
-        if start_time >= cfc._GITGUD_MORE_POINTS_START_TIME: 
-            morePointsActive = True
+        start_time, _ = cf_common.get_start_and_end_of_month(now)
 
         division = None
         showall = False
@@ -598,52 +597,27 @@ class Handles(commands.Cog):
             if arg == "+all":
                 showall = True                    
        
-        # get gitgud of month and calculate scores
-        results = cf_common.user_db.get_gudgitters_timerange(start_time, end_time)
-        res = {}
-        for entry in results:
-            res[entry[0]] = 0
-        for entry in results:
-            if len(entry) >= 3:
-                score = cfc._calculateGitgudScoreForDelta(int(entry[1]))
-                # @@ add finish time constraint (both times need to be within the more points range)
-                res[entry[0]] += 2 * score if morePointsActive and int(entry[2]) >= morePointsTime else score
-            else:
-                raise HandleCogError(f'Tuple size {len(entry)} for entry {entry[0]}')
-        
+        res = await cf_common.user_db.get_monthly_gudgitters_for_guild(ctx.guild.id, start_time)
+
         rankings = []
-        index = 0
         cache = cf_common.cache2.rating_changes_cache
-        for user_id, score in sorted(res.items(), key=lambda item: item[1], reverse=True):
+        #### Live checking of a rating is not working since we get rate limited
+        #### Taking stuff from cache instead
+        ratings_before = cache.get_ratings_before_timestamp(start_time, [row.handle for row in res])
+        for user_id, handle, rating, score in res:
             member = ctx.guild.get_member(int(user_id))
             if not showall and member is None:
                 continue
-            if score > 0:
-                handle = cf_common.user_db.get_handle(user_id, ctx.guild.id)
-                user = cf_common.user_db.fetch_cf_user(handle)
-                if user is None:
-                    continue
-                rating = user.rating
-                
-                discord_handle = ""
-                if member is not None: 
-                    discord_handle = member.display_name                
-                
-                #### Live checking of a rating is not working since we get rate limited
-                #### Taking stuff from cache instead
-                rating_changes = cache.get_rating_changes_for_handle(handle)
-                rating_changes = [change for change in rating_changes if change.ratingUpdateTimeSeconds < start_time]
-                rating_changes.sort(key=lambda a: a.ratingUpdateTimeSeconds)
-                if len(rating_changes) < 1: 
+            discord_handle = member.display_name if member is not None else ""
+
+            rating = ratings_before.get(handle)
+            if rating is None:
+                continue
+            if division is not None:
+                if rating < _DIVISION_RATING_LOW[division-1] or rating > _DIVISION_RATING_HIGH[division-1]:
                     continue
-                if rating_changes[-1] is None: continue
-                if division is not None:
-                    if rating_changes[-1].newRating < _DIVISION_RATING_LOW[division-1] or rating_changes[-1].newRating > _DIVISION_RATING_HIGH[division-1]:
-                        continue
-                rating = rating_changes[-1].newRating
-                rankings.append((index, discord_handle, handle, rating, score))
-                index += 1
-            if index == 20:
+            rankings.append((len(rankings), discord_handle, handle, rating, score))
+            if len(rankings) == 20:
                 break
 
         if not rankings:
@@ -735,8 +709,7 @@ class Handles(commands.Cog):
             raise HandleCogError('Handles not set for any user')
         members, handles = zip(*member_handles)
         users = await cf.user.info(handles=handles)
-        for user in users:
-            cf_common.user_db.cache_cf_user(user)
+        cf_common.user_db.cache_cf_users(users)
 
         required_roles = {user.rank.title for user in users}
         rank2role = {role.name: role for role in guild.roles if role.name in required_roles}
@@ -73,24 +73,17 @@ class Hard75Challenge(commands.Cog):
         if(len(acdProblem)):
             return acdProblem
         solved = {sub.problem.name for sub in submissions}
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if (prob.rating == rating 
-                    and prob.name not in solved)]
-
-        def check(problem):     # check that the user isn't the author and it's not a nonstanard problem    
-            return (not cf_common.is_nonstandard_problem(problem) and
-                    not cf_common.is_contest_writer(problem.contestId, handle))
-
-        problems = list(filter(check, problems))
+        # the user shouldn't be the author and it shouldn't be a nonstandard problem
+        problems = cf_common.cache2.problem_cache.problem_index.query(
+            rating, rating, exclude_names=solved, writers=[handle], standard_only=True)
         if not problems:
             raise Hard75CogError('Great! You have finished all available problems, do atcoder now lol!')
         
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(problem.contestId).startTimeSeconds)
         choice = max(random.randrange(len(problems)) for _ in range(5))
         return problems[choice]    
 
     async def _checkProblemsSolved(self, handle, p1_name, p2_name):
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
         return p1_name in solved,p2_name in solved
 
@@ -226,7 +219,7 @@ class Hard75Challenge(commands.Cog):
         rating = min(3000, rating)
         rating1 = rating            # this is the rating for the problem 1
         rating2 = rating1+200       # this is the rating for the problem 2
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         problem1 = await self._pickProblem(handle, rating1, submissions)
         problem2 = await self._pickProblem(handle, rating2, submissions)
         res=cf_common.user_db.new_Hard75Challenge(user_id,handle,problem1.index,problem1.contestId,problem1.name,problem2.index,problem2.contestId,problem2.name,user.effective_rating, today)
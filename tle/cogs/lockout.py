@@ -15,6 +15,7 @@ from tle import constants
 from tle.util import codeforces_common as cf_common
 from tle.util import codeforces_api as cf
 from tle.util import discord_common
+from tle.util import events
 from tle.util import elo
 from tle.util import paginator
 
@@ -28,7 +29,6 @@ MAX_PROBLEMS = 6
 MAX_ALTS = 5
 ROUNDS_PER_PAGE = 5
 AUTO_UPDATE_TIME = 30
-RECENT_SUBS_LIMIT = 50
 PROBLEM_STATUS_UNSOLVED = 10**18
 PROBLEM_STATUS_TESTING = -1
 _PAGINATE_WAIT_TIME = 5 * 60
@@ -64,9 +64,29 @@ class Round(commands.Cog):
     @commands.Cog.listener()
     @discord_common.once
     async def on_ready(self):
+        cf_common.event_sys.add_listener(self._on_submission_verdict)
         asyncio.create_task(self._check_ongoing_rounds())
 
+    def _round_handles(self, guild):
+        return {cf_common.user_db.get_handle(int(user_id), guild.id)
+                for round in cf_common.user_db.get_ongoing_rounds(guild.id)
+                for user_id in round.users.split()}
+
+    def _watch_ongoing_rounds(self):
+        handles = [handle for guild in self.bot.guilds for handle in self._round_handles(guild)]
+        cf_common.cache2.submission_watcher.watch('lockout', handles)
+
+    @events.listener_spec(name='RoundSubmissionVerdictListener',
+                          event_cls=events.SubmissionVerdict,
+                          with_lock=True)
+    async def _on_submission_verdict(self, event):
+        handle = event.handle.lower()
+        for guild in self.bot.guilds:
+            if any(h and h.lower() == handle for h in self._round_handles(guild)):
+                await self._check_ongoing_rounds_for_guild(guild)
+
     async def _check_ongoing_rounds(self):
+        self._watch_ongoing_rounds()
         for guild in self.bot.guilds:
             await self._check_ongoing_rounds_for_guild(guild)    
         await asyncio.sleep(AUTO_UPDATE_TIME)
@@ -259,14 +279,11 @@ class Round(commands.Cog):
 
     async def _pick_problem(self, handles, solved, rating, selected):
         def get_problems(rating):
-            return [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating == rating and prob.name not in solved
-                    and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
-                    and not cf_common.is_nonstandard_problem(prob)
-                    and prob not in selected]
+            return [prob for prob in cf_common.cache2.problem_cache.problem_index.query(
+                        rating, rating, exclude_names=solved, writers=handles, standard_only=True)
+                    if prob not in selected]
 
         problems = get_problems(rating)
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(problem.contestId).startTimeSeconds)
 
         if not problems:
             raise RoundCogError(f'Not enough unsolved problems of rating {rating} available.')
@@ -308,7 +325,7 @@ class Round(commands.Cog):
         repeat = await self._get_time_response(self.bot, ctx, f"{ctx.author.mention} do you want a new problem to appear when someone solves a problem (type 1 for yes and 0 for no)", 30, ctx.author, [0, 1])
 
         # pick problems
-        submissions = [await cf.user.status(handle=handle) for handle in handles]        
+        submissions = await cf_common.cache2.submission_cache.get_submissions_for_all(handles)
         solved = {sub.problem.name for subs in submissions for sub in subs if sub.verdict != 'COMPILATION_ERROR'} 
         selected = []
         for rating in ratings:
@@ -318,6 +335,7 @@ class Round(commands.Cog):
         await ctx.send(embed=discord.Embed(description="Starting the round...", color=discord.Color.green()))
 
         cf_common.user_db.create_ongoing_round(ctx.guild.id, int(time.time()), members, ratings, points, selected, duration, repeat)
+        self._watch_ongoing_rounds()
         round_info = cf_common.user_db.get_round_info(ctx.guild.id, members[0].id)
 
         await ctx.send(embed=self._round_problems_embed(round_info))
@@ -394,7 +412,7 @@ class Round(commands.Cog):
 
         await channel.send(embed=embed)    
 
-    async def _update_round(self, round_info):
+    async def _update_round(self, round_info, fresh=True):
         user_ids = list(map(int, round_info.users.split()))
         handles = [cf_common.user_db.get_handle(user_id, round_info.guild) for user_id in user_ids]
         rating = list(map(int, round_info.rating.split()))
@@ -407,7 +425,9 @@ class Round(commands.Cog):
         judging, over, updated = False, False, False
 
         updates = []
-        recent_subs = [await cf.user.status(handle=handle, count=RECENT_SUBS_LIMIT) for handle in handles]
+        # Automatic runs use the last poll of the submission watcher, which watches these handles.
+        watcher = cf_common.cache2.submission_watcher
+        recent_subs = [await watcher.get_recent_submissions(handle, fresh=fresh) for handle in handles]
         for i in range(len(problems)):
             # Problem was solved before and no replacement -> skip
             if problems[i] == '0':
@@ -437,7 +457,7 @@ class Round(commands.Cog):
             # Get new problem if repeat is set to 1
             if len(solved) > 0 and round_info.repeat == 1:
                 try: 
-                    submissions = [await cf.user.status(handle=handle) for handle in handles]        
+                    submissions = await cf_common.cache2.submission_cache.get_submissions_for_all(handles)
                     solved = {sub.problem.name for subs in submissions for sub in subs if sub.verdict != 'COMPILATION_ERROR'} 
                     problem = await self._pick_problem(handles, solved, rating[i], [])
                     problems[i] = f'{problem.contestId}/{problem.index}'
@@ -454,7 +474,7 @@ class Round(commands.Cog):
         return updates, over, updated
 
     async def _check_round_complete(self, guild, channel, round, isAutomaticRun = False):
-        updates, over, updated = await self._update_round(round)
+        updates, over, updated = await self._update_round(round, fresh=not isAutomaticRun)
 
         if updated or over:
             await channel.send(f"{' '.join([(guild.get_member(int(m))).mention for m in round.users.split()])} there is an update in standings")
@@ -478,12 +498,12 @@ class Round(commands.Cog):
 
             # change duel rating
             eloChanges = self._calculateRatingChanges([[(guild.get_member(user.id)), user.rank, cf_common.user_db.get_duel_rating(user.id, guild.id)] for user in ranklist])
-            for id in list(map(int, round_info.users.split())):
-                cf_common.user_db.update_duel_rating(id, guild.id, eloChanges[id][1])
-
+            with cf_common.user_db.batch():
+                for id in list(map(int, round_info.users.split())):
+                    cf_common.user_db.update_duel_rating(id, guild.id, eloChanges[id][1])
 
-            cf_common.user_db.delete_round(round_info.guild, round_info.users)
-            cf_common.user_db.create_finished_round(round_info, int(time.time()))
+                cf_common.user_db.delete_round(round_info.guild, round_info.users)
+                cf_common.user_db.create_finished_round(round_info, int(time.time()))
 
             await self._round_end_embed(channel, round_info, ranklist, eloChanges)
 
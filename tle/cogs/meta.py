@@ -7,6 +7,7 @@ import textwrap
 from discord.ext import commands
 
 from tle import constants
+from tle.util import codeforces_api as cf
 from tle.util.codeforces_common import pretty_time_format
 
 RESTART = 42
@@ -90,6 +91,15 @@ class Meta(commands.Cog):
         await ctx.send('TLE has been running for ' +
                        pretty_time_format(time.time() - self.start_time))
 
+    @meta.command(brief='Show Codeforces API queue stats')
+    @commands.has_role(constants.TLE_ADMIN)
+    async def cfapi(self, ctx):
+        """Replies with the queue depth and wait times of each Codeforces API request lane."""
+        msg = [f'{lane.name:<12} queued: {stats["queued"]:<4} served: {stats["served"]:<6} '
+               f'avg wait: {stats["avg_wait"]:.2f}s  max wait: {stats["max_wait"]:.2f}s'
+               for lane, stats in cf.get_scheduler_metrics().items()]
+        await ctx.send('```' + '\n'.join(msg) + '```')
+
     @meta.command(brief='Print bot guilds')
     @commands.has_role(constants.TLE_ADMIN)
     async def guilds(self, ctx):
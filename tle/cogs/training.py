@@ -266,6 +266,19 @@ class Training(commands.Cog):
         self.bot = bot
         self.converter = commands.MemberConverter()
 
+    @commands.Cog.listener()
+    @discord_common.once
+    async def on_ready(self):
+        self._watchActiveTrainings()
+
+    def _watchActiveTrainings(self):
+        # The submission watcher polls the handles of users with an active training, whose
+        # solves are checked against the polled submissions.
+        handles = [cf_common.user_db.get_handle(user_id, guild.id)
+                   for user_id in cf_common.user_db.get_active_training_user_ids()
+                   for guild in self.bot.guilds]
+        cf_common.cache2.submission_watcher.watch('training', handles)
+
     @commands.group(brief='Training commands',
                     invoke_without_command=True)
     async def training(self, ctx):
@@ -363,30 +376,27 @@ class Training(commands.Cog):
     async def _pickTrainingProblem(self, handle, rating, submissions, user_id):
         solved = {sub.problem.name for sub in submissions}
         skips = cf_common.user_db.get_training_skips(user_id)
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if (prob.rating == rating and
-                        prob.name not in solved and
-                        prob.name not in skips)]
-
-        def check(problem):
-            return (not cf_common.is_nonstandard_problem(problem) and
-                    not cf_common.is_contest_writer(problem.contestId, handle))
-
-        problems = list(filter(check, problems))
+        problems = cf_common.cache2.problem_cache.problem_index.query(
+            rating, rating, exclude_names=solved | skips, writers=[handle],
+            standard_only=True)
         # TODO: What happens to DB if this one triggers?
         if not problems:
             raise TrainingCogError(
                 'No problem to assign. Start of training failed.')
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
 
         choice = max(random.randrange(len(problems)) for _ in range(5))
         return problems[choice]
 
-    async def _checkIfSolved(self, ctx, active, handle, submissions):
+    async def _checkIfSolved(self, ctx, active, handle):
         _, _, name, contest_id, index, _, _, _, _, _ = active
-        ac = [sub for sub in submissions if sub.problem.name ==
-              name and sub.verdict == 'OK']
+        # A solve since the last poll of the submission watcher is only in fresh submissions.
+        watcher = cf_common.cache2.submission_watcher
+        for fresh in (False, True):
+            submissions = await watcher.get_recent_submissions(handle, fresh=fresh)
+            ac = [sub for sub in submissions if sub.problem.name ==
+                  name and sub.verdict == 'OK']
+            if ac:
+                break
         # order by creation time increasing
         ac.sort(key=lambda y: y[6])
 
@@ -490,6 +500,7 @@ class Training(commands.Cog):
             raise TrainingCogError(
                 'Your training has already been added to the database!')
 
+        self._watchActiveTrainings()
         active = await self._getActiveTraining(user_id)
         await self._postTrainingStatistics(ctx, active, handle, gamestate, False, False)
 
@@ -522,6 +533,7 @@ class Training(commands.Cog):
         training_id, _, _, _, _, _, _, _, _, _ = active
 
         rc = cf_common.user_db.finish_training(training_id)
+        self._watchActiveTrainings()
         if rc == -1:
             raise TrainingCogError("You already ended your training!")
 
@@ -554,7 +566,7 @@ class Training(commands.Cog):
         # get cf handle
         handle, = await cf_common.resolve_handles(ctx, self.converter, ('!' + str(ctx.author),))
         # get user submissions
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
 
         rating, mode = self._extractArgs(args)
 
@@ -581,15 +593,16 @@ class Training(commands.Cog):
 
         # get cf handle
         handle, = await cf_common.resolve_handles(ctx, self.converter, ('!' + str(ctx.author),))
-        # get user submissions
-        submissions = await cf.user.status(handle=handle)
 
         # check game running
         active = await self._getActiveTraining(ctx.author.id)
         self._checkTrainingActive(ctx, active)
 
         # check if solved
-        finish_time = await self._checkIfSolved(ctx, active, handle, submissions)
+        finish_time = await self._checkIfSolved(ctx, active, handle)
+
+        # get user submissions
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
 
         # game logic here
         _, issue_time, _, _, _, rating, _, _, _, _ = active
@@ -621,7 +634,7 @@ class Training(commands.Cog):
         # get cf handle
         handle, = await cf_common.resolve_handles(ctx, self.converter, ('!' + str(ctx.author),))
         # get user submissions
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
 
         # check game running
         active = await self._getActiveTraining(ctx.author.id)
@@ -10,6 +10,7 @@ TEMP_DIR = os.path.join(DATA_DIR, 'temp')
 
 USER_DB_FILE_PATH = os.path.join(DB_DIR, 'user.db')
 CACHE_DB_FILE_PATH = os.path.join(DB_DIR, 'cache.db')
+RATING_STORE_DIR = os.path.join(DB_DIR, 'rating_store')
 
 FONTS_DIR = os.path.join(ASSETS_DIR, 'fonts')
 
@@ -25,4 +26,7 @@ ALL_DIRS = (attrib_value for attrib_name, attrib_value in list(globals().items()
 
 TLE_ADMIN = os.environ.get('TLE_ADMIN', 'Admin')
 TLE_MODERATOR = os.environ.get('TLE_MODERATOR', 'Moderator')
+# Codeforces API requests allowed per second, and how many may be made in a burst.
+CF_API_RATE = float(os.environ.get('CF_API_RATE', 1))
+CF_API_BURST = int(os.environ.get('CF_API_BURST', 1))
 GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
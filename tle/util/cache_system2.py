@@ -1,20 +1,28 @@
 import asyncio
+import heapq
 import logging
 import time
-from aiocache import cached
+import numpy as np
 
 from collections import defaultdict
 from discord.ext import commands
 
+from tle import constants
 from tle.util import codeforces_common as cf_common
 from tle.util import codeforces_api as cf
 from tle.util import events
+from tle.util import executors
 from tle.util import tasks
 from tle.util import paginator
+from tle.util import rating_store
 from tle.util.ranklist import Ranklist
+from tle.util.ranklist import snapshot
 
 logger = logging.getLogger(__name__)
 _CONTESTS_PER_BATCH_IN_CACHE_UPDATES = 100
+_DISTRIBUTION_TIME_GRANULARITY = 60 * 60
+_MAX_CACHED_DISTRIBUTIONS = 32
+_API_RATING_TTL = 30 * 60
 CONTEST_BLACKLIST = {1308, 1309, 1431, 1432}
 
 
@@ -161,6 +169,65 @@ class ContestCache:
         return delay
 
 
+class ProblemIndex:
+    """Index over problems for picking problems to recommend. Problems are bucketed by rating,
+    each bucket in order of contest start time, and tags of each problem are stored as a bitset
+    over all known tags so that tag filters need no string matching per problem."""
+
+    def __init__(self, problems, contest_by_id):
+        self.tag_bit = {}
+        entries = []
+        for problem in problems:
+            contest = contest_by_id.get(problem.contestId)
+            start_time = contest.startTimeSeconds if contest else 0
+            nonstandard = ((contest is not None and cf_common.is_nonstandard_contest(contest)) or
+                           problem.matches_all_tags(['*special']))
+            entries.append((start_time, self._tag_mask(problem.tags, add=True), nonstandard,
+                            problem))
+        # Stable, so problems of the same contest keep their order.
+        entries.sort(key=lambda entry: entry[0])
+
+        self.buckets = defaultdict(list)
+        for order, (_, tag_mask, nonstandard, problem) in enumerate(entries):
+            self.buckets[problem.rating].append((order, tag_mask, nonstandard, problem))
+
+    def _tag_mask(self, tags, add=False):
+        mask = 0
+        for tag in tags:
+            if add and tag not in self.tag_bit:
+                self.tag_bit[tag] = 1 << len(self.tag_bit)
+            mask |= self.tag_bit.get(tag, 0)
+        return mask
+
+    def _match_mask(self, match_tag):
+        """Mask of known tags matched by `match_tag`, as in `Problem.matches_all_tags`."""
+        return self._tag_mask(tag for tag in self.tag_bit if match_tag in tag)
+
+    def query(self, rlo, rhi, *, tags=(), bantags=(), exclude_names=(), writers=(),
+              standard_only=False):
+        """Returns problems with rating in [rlo, rhi] which match all of `tags`, none of
+        `bantags`, are not named in `exclude_names` and were not written by any of `writers`,
+        in order of contest start time."""
+        tag_masks = [self._match_mask(tag) for tag in set(tags)]
+        if not all(tag_masks):
+            return []
+        bantag_mask = self._tag_mask(bantag for match_tag in set(bantags)
+                                     for bantag in self.tag_bit if match_tag in bantag)
+
+        buckets = [bucket for rating, bucket in self.buckets.items() if rlo <= rating <= rhi]
+        problems = []
+        for _, tag_mask, nonstandard, problem in heapq.merge(*buckets):
+            if (tag_mask & bantag_mask or
+                    not all(tag_mask & mask for mask in tag_masks) or
+                    standard_only and nonstandard or
+                    problem.name in exclude_names or
+                    any(cf_common.is_contest_writer(problem.contestId, handle)
+                        for handle in writers)):
+                continue
+            problems.append(problem)
+        return problems
+
+
 class ProblemCache:
     _RELOAD_INTERVAL = 6 * 60 * 60
 
@@ -169,6 +236,7 @@ class ProblemCache:
 
         self.problems = []
         self.problem_by_name = {}
+        self.problem_index = ProblemIndex([], {})
         self.problems_last_cache = 0
 
         self.reload_lock = asyncio.Lock()
@@ -202,6 +270,7 @@ class ProblemCache:
                 return
             self.problems = problems
             self.problem_by_name = {problem.name: problem for problem in problems}
+            self._build_index()
             self.logger.info(f'{len(self.problems)} problems fetched from disk')
 
     @tasks.task_spec(name='ProblemCacheUpdate',
@@ -237,11 +306,16 @@ class ProblemCache:
 
         self.problems = list(problem_by_name.values())
         self.problem_by_name = problem_by_name
+        self._build_index()
         self.problems_last_cache = time.time()
 
         rc = self.cache_master.conn.cache_problems(self.problems)
         self.logger.info(f'{rc} problems stored in database')
 
+    def _build_index(self):
+        self.problem_index = ProblemIndex(self.problems,
+                                          self.cache_master.contest_cache.contest_by_id)
+
 
 class ProblemsetCacheError(CacheError):
     pass
@@ -321,11 +395,13 @@ class ProblemsetCache:
                     contests_to_refetch.append((contest.id, rated_problem_idx))
 
         new_problems, updated_problems = [], []
-        for contest_id in new_contest_ids:
-            new_problems += await self._fetch_for_contest(contest_id)
-        for contest_id, rated_problem_idx in contests_to_refetch:
-            updated_problems += [prob for prob in await self._fetch_for_contest(contest_id)
-                                 if prob.rating is not None and prob.index not in rated_problem_idx]
+        with cf.priority(cf.Priority.BACKFILL):
+            for contest_id in new_contest_ids:
+                new_problems += await self._fetch_for_contest(contest_id)
+            for contest_id, rated_problem_idx in contests_to_refetch:
+                updated_problems += [
+                    prob for prob in await self._fetch_for_contest(contest_id)
+                    if prob.rating is not None and prob.index not in rated_problem_idx]
 
         return new_problems, updated_problems
 
@@ -367,12 +443,30 @@ class RatingChangesCache:
     def __init__(self, cache_master):
         self.cache_master = cache_master
         self.monitored_contests = []
-        self.handle_rating_cache = {}
+        # All saved rating changes, see rating_store.
+        self._store = rating_store.RatingStore(constants.RATING_STORE_DIR)
+        self._store_lock = asyncio.Lock()
+        # Ids of the contests with rating changes in the store.
+        self._saved_contest_ids = set()
+        # Maps each lowercased handle to the handles that were renamed to it.
+        self._old_handles = {}
+        # Ratings from the API of handles without saved rating changes, as lowercased handle to
+        # (expiry time, rating or None if unrated).
+        self._api_ratings = {}
+        # Current rating, number of rated contests and time of the last rating update of each
+        # handle, as parallel arrays indexed by handle id.
+        self._ratings = np.zeros(0, dtype=np.int64)
+        self._num_contests = np.zeros(0, dtype=np.int64)
+        self._last_update = np.zeros(0, dtype=np.int64)
+        self.sorted_ratings = self._ratings
+        self._distributions = {}
+        self.ratings_last_cache = 0
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        self._refresh_handle_cache()
-        if not self.handle_rating_cache:
+        self._load_redirects()
+        await self._load_store()
+        if not len(self._store):
             self.logger.warning('Rating changes cache on disk is empty. This must be populated '
                                 'manually before use.')
         self._update_task.start()
@@ -381,8 +475,11 @@ class RatingChangesCache:
         """Fetch rating changes for a particular contest. Intended for manual trigger."""
         contest = self.cache_master.contest_cache.contest_by_id[contest_id]
         changes = await self._fetch([contest])
-        self.cache_master.conn.clear_rating_changes(contest_id=contest_id)
-        self._save_changes(changes)
+        async with self._store_lock:
+            self.cache_master.conn.clear_rating_changes(contest_id=contest_id)
+            await self._save_to_db(changes)
+            # Rebuilt even if nothing was fetched, the cleared rows are gone.
+            await self._build_store()
         return len(changes)
 
     async def fetch_all_contests(self):
@@ -397,10 +494,17 @@ class RatingChangesCache:
         contests = [
             contest for contest in contests if not self.has_rating_changes_saved(contest.id)]
         total_changes = 0
-        for contests_chunk in paginator.chunkify(contests, _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
-            contests_chunk = await self._fetch(contests_chunk)
-            self._save_changes(contests_chunk)
-            total_changes += len(contests_chunk)
+        with cf.priority(cf.Priority.BACKFILL):
+            for contests_chunk in paginator.chunkify(contests,
+                                                     _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
+                contests_chunk = await self._fetch(contests_chunk)
+                # The contests are older than saved ones, so they cannot be appended to the
+                # store. It is rebuilt once all are saved.
+                async with self._store_lock:
+                    await self._save_to_db(contests_chunk)
+                total_changes += len(contests_chunk)
+        async with self._store_lock:
+            await self._build_store()
         return total_changes
 
     def is_newly_finished_without_rating_changes(self, contest):
@@ -454,7 +558,7 @@ class RatingChangesCache:
         # Sort by the rating update time of the first change in the list of changes, assuming
         # every change in the list has the same time.
         contest_changes_pairs.sort(key=lambda pair: pair[1][0].ratingUpdateTimeSeconds)
-        self._save_changes(contest_changes_pairs)
+        await self._save_changes(contest_changes_pairs)
         for contest, changes in contest_changes_pairs:
             cf_common.event_sys.dispatch(events.RatingChangesUpdate, contest=contest,
                                          rating_changes=changes)
@@ -472,24 +576,110 @@ class RatingChangesCache:
                 pass
         return all_changes
 
-    def _save_changes(self, contest_changes_pairs):
+    async def _save_to_db(self, contest_changes_pairs):
         flattened = [change for _, changes in contest_changes_pairs for change in changes]
-        if not flattened:
+        if flattened:
+            rc = await self.cache_master.conn.save_rating_changes(flattened)
+            self.logger.info(f'Saved {rc} changes to database.')
+        return flattened
+
+    async def _save_changes(self, contest_changes_pairs):
+        """Saves the changes of newly rated contests, which must have none saved and be newer
+        than all saved ones. They are appended to the store and the cached ratings are updated
+        from them alone."""
+        async with self._store_lock:
+            flattened = await self._save_to_db(contest_changes_pairs)
+            if not flattened:
+                return
+            start = len(self._store)
+            self._store.append([(change.handle, change.contestId, change.rank,
+                                 change.ratingUpdateTimeSeconds, change.oldRating,
+                                 change.newRating) for change in flattened])
+            self._saved_contest_ids.update(change.contestId for change in flattened)
+            self._update_handle_cache(start)
+
+    async def _load_store(self):
+        store = rating_store.RatingStore.load(constants.RATING_STORE_DIR)
+        if store is not None and len(store) == await self.cache_master.conn.count_rating_changes():
+            self._set_store(store)
+        else:
+            await self._build_store()
+
+    async def _build_store(self):
+        self.logger.info('Building the rating store from the database.')
+        store = await self.cache_master.conn.build_rating_store(constants.RATING_STORE_DIR)
+        self._set_store(store)
+
+    def _set_store(self, store):
+        self._store = store
+        self._saved_contest_ids = set(np.unique(store.columns['contest_id']).tolist())
+        empty = np.zeros(0, dtype=np.int64)
+        start, arrays = store.load_snapshot() or (0, {})
+        self._ratings = arrays.get('ratings', empty)
+        self._num_contests = arrays.get('num_contests', empty)
+        self._last_update = arrays.get('last_update', empty)
+        self._update_handle_cache(start)
+
+    def _update_handle_cache(self, start):
+        """Updates the cached ratings from the rows of the store from `start` on, which are newer
+        than the rest, and saves them as the snapshot of the store."""
+        columns = self._store.columns
+        handle_ids = columns['handle_id'][start:]
+        num_handles = len(self._store.handles)
+        if not len(handle_ids) and num_handles == len(self._ratings):
+            self._set_handle_cache(self._ratings, self._num_contests, self._last_update)
             return
-        rc = self.cache_master.conn.save_rating_changes(flattened)
-        self.logger.info(f'Saved {rc} changes to database.')
-        self._refresh_handle_cache()
 
-    def _refresh_handle_cache(self):
-        changes = self.cache_master.conn.get_all_rating_changes()
-        handle_rating_cache = {}
-        for change in changes:
-            handle_rating_cache[change.handle] = change.newRating
-        self.handle_rating_cache = handle_rating_cache
-        self.logger.info(f'Ratings for {len(handle_rating_cache)} handles cached')
+        def extend(values):
+            extended = np.zeros(num_handles, dtype=np.int64)
+            extended[:len(values)] = values
+            return extended
+
+        ratings, num_contests, last_update = map(
+            extend, (self._ratings, self._num_contests, self._last_update))
+        ids, last = rating_store.latest_rows(handle_ids)
+        ratings[ids] = columns['new_rating'][start:][last]
+        last_update[ids] = columns['time'][start:][last]
+        num_contests += np.bincount(handle_ids, minlength=num_handles)
+        self._set_handle_cache(ratings, num_contests, last_update)
+        self._store.save_snapshot(ratings=ratings, num_contests=num_contests,
+                                  last_update=last_update)
+
+    def _set_handle_cache(self, ratings, num_contests, last_update):
+        self._ratings = ratings
+        self._num_contests = num_contests
+        self._last_update = last_update
+        self.sorted_ratings = np.sort(self._ratings)
+        self._distributions = {}
+        self.ratings_last_cache = time.time()
+        self.logger.info(f'Ratings for {len(ratings)} handles cached')
+
+    def get_ratings_of_users_with_more_than_n_contests(self, time_cutoff, n):
+        """Returns an array of the current ratings of users with at least `n` rated contests and
+        a rating update at or after `time_cutoff`. `time_cutoff` is rounded down to
+        `_DISTRIBUTION_TIME_GRANULARITY` so that results can be reused between calls."""
+        time_cutoff = self.round_time_cutoff(time_cutoff)
+        key = time_cutoff, n
+        ratings = self._distributions.get(key)
+        if ratings is None:
+            mask = (self._num_contests >= n) & (self._last_update >= time_cutoff)
+            ratings = self._ratings[mask]
+            if len(self._distributions) >= _MAX_CACHED_DISTRIBUTIONS:
+                self._distributions.clear()
+            self._distributions[key] = ratings
+        return ratings
 
-    def get_users_with_more_than_n_contests(self, time_cutoff, n):
-        return self.cache_master.conn.get_users_with_more_than_n_contests(time_cutoff, n)
+    @staticmethod
+    def round_time_cutoff(time_cutoff):
+        """Returns `time_cutoff` rounded down as it is for the rating distributions."""
+        return time_cutoff - time_cutoff % _DISTRIBUTION_TIME_GRANULARITY
+
+    def get_percentile(self, rating):
+        """Returns the percentage of rated users with a rating less than `rating`."""
+        if not len(self.sorted_ratings):
+            return 0
+        ix = np.searchsorted(self.sorted_ratings, rating, side='left')
+        return 100 * ix / len(self.sorted_ratings)
 
     def get_rating_changes_for_contest(self, contest_id):
         return self.cache_master.conn.get_rating_changes_for_contest(contest_id)
@@ -497,19 +687,333 @@ class RatingChangesCache:
     def has_rating_changes_saved(self, contest_id):
         return self.cache_master.conn.has_rating_changes_saved(contest_id)
 
+    def _saved_changes(self, handle):
+        columns = self._store.columns
+        contest_by_id = self.cache_master.contest_cache.contest_by_id
+        changes = []
+        for row in self._store.rows_of(handle):
+            contest_id = int(columns['contest_id'][row])
+            contest = contest_by_id.get(contest_id)
+            changes.append(cf.RatingChange(contest_id, contest.name if contest else None, handle,
+                                           int(columns['rank'][row]), int(columns['time'][row]),
+                                           int(columns['old_rating'][row]),
+                                           int(columns['new_rating'][row])))
+        return changes
+
     def get_rating_changes_for_handle(self, handle):
-        return self.cache_master.conn.get_rating_changes_for_handle(handle)
+        """Returns the saved rating changes of the handle in order of rating update time,
+        including those saved under the handles it was renamed from."""
+        handle_id = self.get_handle_id(handle)
+        if handle_id is not None:
+            handle = self.handles.canonical(handle_id)
+        changes = self._saved_changes(handle)
+        for old_handle in self._get_old_handles(handle):
+            changes += self._saved_changes(old_handle)
+        # The same contest can be saved under both handles if it was refetched after a rename.
+        changes = {change.contestId: change._replace(handle=handle) for change in changes}
+        return sorted(changes.values(), key=lambda change: change.ratingUpdateTimeSeconds)
+
+    def add_handle_redirects(self, redirects):
+        """Records (old handle, new handle) pairs of renamed handles, so that the rating changes
+        saved under old handles are found from the new ones."""
+        self.cache_master.conn.save_handle_redirects(redirects)
+        self._load_redirects()
+
+    def _load_redirects(self):
+        old_handles = {}
+        for old_handle, new_handle in self.cache_master.conn.get_handle_redirects():
+            old_handles.setdefault(new_handle.lower(), []).append(old_handle)
+        self._old_handles = old_handles
+
+    def _get_old_handles(self, handle):
+        """Returns the handles that were renamed to the handle, directly or through other
+        renames."""
+        found = []
+        pending = [handle]
+        seen = {handle.lower()}
+        while pending:
+            for old_handle in self._old_handles.get(pending.pop().lower(), []):
+                if old_handle.lower() not in seen:
+                    seen.add(old_handle.lower())
+                    found.append(old_handle)
+                    pending.append(old_handle)
+        return found
+
+    @staticmethod
+    def _is_gapless(history):
+        # A history starts from an unrated user, whose old rating is 0, and every change starts
+        # from the rating the previous one ended at. A gap means contests are missing, saved
+        # under a handle the user was renamed from or not fetched.
+        return (history[0].oldRating == 0
+                and all(prev.newRating == cur.oldRating
+                        for prev, cur in zip(history, history[1:])))
+
+    def _is_up_to_date(self, handle, history):
+        # Finished contests after the last saved change that have no rating changes saved were
+        # unrated, or rated but not fetched yet. The user's cached rating tells them apart.
+        last_time = history[-1].ratingUpdateTimeSeconds
+        unsaved = [contest for contest in
+                   self.cache_master.contest_cache.contests_by_phase['FINISHED']
+                   if contest.end_time > last_time and not _is_blacklisted(contest)
+                   and contest.id not in self._saved_contest_ids]
+        if not unsaved:
+            return True
+        cf_user = cf_common.user_db.fetch_cf_user(handle)
+        return cf_user is not None and cf_user.rating == history[-1].newRating
+
+    async def get_histories(self, handles):
+        """Returns the rating history of each of the handles, as cf.user.rating does. Saved
+        rating changes are used only if they can be shown to be the complete history, otherwise
+        the history is fetched from the API."""
+        histories = []
+        for handle in handles:
+            history = self.get_rating_changes_for_handle(handle)
+            if not (history and self._is_gapless(history)
+                    and self._is_up_to_date(handle, history)):
+                history = await cf.user.rating(handle=handle)
+            histories.append(history)
+        return histories
+
+    async def get_history(self, handle):
+        history, = await self.get_histories([handle])
+        return history
+
+    @property
+    def handles(self):
+        """The HandleTable of all handles with rating changes. Its ids index the rating arrays
+        of this cache."""
+        return self._store.handles
+
+    def get_handle_id(self, handle):
+        return self.handles.get(handle)
 
     def get_current_rating(self, handle, default_if_absent=False):
-        return self.handle_rating_cache.get(handle,
-                                            cf.DEFAULT_RATING if default_if_absent else None)
+        i = self.get_handle_id(handle)
+        if i is None:
+            return cf.DEFAULT_RATING if default_if_absent else None
+        return int(self._ratings[i])
+
+    def _get_saved_rating(self, handle):
+        # The latest rating saved under the handle or one it was renamed from.
+        ids = [self.handles.get(handle)] + [self.handles.get(old_handle)
+                                            for old_handle in self._get_old_handles(handle)]
+        ids = [i for i in ids if i is not None and i < len(self._ratings)]
+        if not ids:
+            return None
+        return int(self._ratings[max(ids, key=lambda i: self._last_update[i])])
+
+    async def get_effective_ratings(self, handles, default):
+        """Returns the current rating of each of the handles, or `default` for unrated users.
+        Ratings are taken from the saved rating changes, including those saved under handles
+        the user was renamed from. Handles without any, which are new users or users whose
+        contests are not saved yet, get their rating from the API, which is kept for
+        `_API_RATING_TTL` seconds."""
+        ratings = [self._get_saved_rating(handle) for handle in handles]
+        missing = [handle for handle, rating in zip(handles, ratings) if rating is None]
+        if missing:
+            api_ratings = await self._get_api_ratings(missing)
+            ratings = [api_ratings[handle.lower()] if rating is None else rating
+                       for handle, rating in zip(handles, ratings)]
+        return [default if rating is None else rating for rating in ratings]
+
+    async def _get_api_ratings(self, handles):
+        # Maps lowercased handles to their ratings, None if unrated or not found.
+        now = time.time()
+        self._api_ratings = {key: value for key, value in self._api_ratings.items()
+                             if value[0] > now}
+        ratings = {key: rating for key, (_, rating) in self._api_ratings.items()}
+        to_fetch = [handle for handle in handles if handle.lower() not in ratings]
+        if to_fetch:
+            fetched = {handle.lower(): None for handle in to_fetch}
+            try:
+                for cf_user in await cf.info_skipping_missing(to_fetch):
+                    fetched[cf_user.handle.lower()] = cf_user.rating
+            except cf.CodeforcesApiError as e:
+                # Not kept, so that they are fetched again next time.
+                self.logger.warning(f'Could not fetch ratings of {len(to_fetch)} handles: {e!r}')
+            else:
+                expiry = now + _API_RATING_TTL
+                self._api_ratings.update((key, (expiry, rating)) for key, rating in fetched.items())
+            ratings.update(fetched)
+        return ratings
+
+    def get_ratings_before_timestamp(self, timestamp, handles):
+        """Returns the ratings the handles had before `timestamp`, as a dict. Handles which were
+        unrated then are absent."""
+        ratings = self._store.ratings_before(timestamp, handles)
+        return {handle: rating for handle, rating in zip(handles, ratings) if rating is not None}
+
+
+class SubmissionCache:
+    """Keeps the submissions of every handle asked for in the cache database. Only the head of
+    a handle's submission list is fetched from the API, growing in chunks until it overlaps the
+    submissions already known. Submissions that were still being judged are refetched, and the
+    whole list is refetched once in a while so that later rejudges are picked up too.
+    """
+    _HEAD_FETCH_COUNT = 50
+    _MAX_FETCH_COUNT = 2000
+    _FULL_FETCH_DELAY = 7 * 24 * 60 * 60
 
-    def get_all_ratings_before_timestamp(self, timestamp):
-        res = self.cache_master.conn.get_all_ratings_before_timestamp(timestamp)
-        return {ratingchange.handle: ratingchange for ratingchange in res}
+    def __init__(self, cache_master):
+        self.cache_master = cache_master
+        # Handle -> the fetch of its submissions in flight, shared by concurrent callers.
+        self._fetches = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
 
-    def get_all_ratings(self):
-        return list(self.handle_rating_cache.values())
+    async def get_submissions(self, handle):
+        """Returns all submissions of the handle, newest first, as cf.user.status does.
+        Concurrent calls for the same handle share a single fetch."""
+        fetch = self._fetches.get(handle)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch_submissions(handle))
+            self._fetches[handle] = fetch
+            fetch.add_done_callback(lambda _: self._fetch_done(handle, fetch))
+        # Shielded so that a caller giving up does not cancel the fetch for the others. Callers
+        # are free to modify the list they get, so each gets its own copy.
+        return list(await asyncio.shield(fetch))
+
+    def _fetch_done(self, handle, fetch):
+        if self._fetches.get(handle) is fetch:
+            del self._fetches[handle]
+        if not fetch.cancelled():
+            # Marks an error as retrieved, the callers may all have given up.
+            fetch.exception()
+
+    async def _fetch_submissions(self, handle):
+        conn = self.cache_master.conn
+        full_fetch_time = conn.get_submissions_full_fetch_time(handle)
+        if full_fetch_time is None or time.time() - full_fetch_time > self._FULL_FETCH_DELAY:
+            return await self._full_fetch(handle)
+
+        known_id = conn.get_newest_submission_id(handle) or 0
+        pending_id = conn.get_oldest_pending_submission_id(handle)
+        if pending_id is not None:
+            known_id = min(known_id, pending_id)
+
+        fetched = []
+        from_, count = 1, self._HEAD_FETCH_COUNT
+        while True:
+            subs = await cf.user.status(handle=handle, from_=from_, count=count)
+            fetched += subs
+            if len(subs) < count or subs[-1].id <= known_id:
+                break
+            from_ += count
+            count = min(2 * count, self._MAX_FETCH_COUNT)
+
+        if fetched:
+            await conn.save_submissions(handle, fetched)
+        return await conn.fetch_submissions(handle)
+
+    async def get_submissions_many(self, handles):
+        """Fetches the submissions of all handles concurrently. Requests are still paced by the
+        API scheduler, but no handle waits for the fetch of another to finish. Returns a dict
+        from handle to submissions, and a dict from handle to the API error for handles whose
+        submissions could not be fetched."""
+        handles = list(dict.fromkeys(handles))
+        results = await asyncio.gather(*(self.get_submissions(handle) for handle in handles),
+                                       return_exceptions=True)
+        submissions, failures = {}, {}
+        for handle, result in zip(handles, results):
+            if isinstance(result, cf.CodeforcesApiError):
+                failures[handle] = result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                submissions[handle] = result
+        return submissions, failures
+
+    async def get_submissions_for_all(self, handles):
+        """Returns a list of the submissions of each handle, fetched concurrently. Raises the
+        first error if any handle failed, for callers that would be wrong without one of them."""
+        submissions, failures = await self.get_submissions_many(handles)
+        if failures:
+            raise next(iter(failures.values()))
+        return [submissions[handle] for handle in handles]
+
+    async def _full_fetch(self, handle):
+        conn = self.cache_master.conn
+        subs = await cf.user.status(handle=handle)
+        await conn.replace_submissions(handle, subs, int(time.time()))
+        self.logger.info(f'Fetched all {len(subs)} submissions of {handle}')
+        return subs
+
+
+class SubmissionWatcher:
+    """Polls the recent submissions of hot handles, those which some subsystem such as duels or
+    lockout rounds is waiting on. Each subsystem sets the handles it needs with `watch`, and a
+    handle stays hot while at least one of them watches it. All hot handles are polled once per
+    tick however many subsystems watch them, and the subsystems read the polled submissions with
+    `get_recent_submissions` instead of querying the API themselves. New verdicts are published
+    as SubmissionVerdict events.
+    """
+    _POLL_INTERVAL = 30
+    _RECENT_COUNT = 50
+
+    def __init__(self, cache_master):
+        self.cache_master = cache_master
+        self.handles_by_owner = {}
+        self.refcount_by_handle = defaultdict(int)
+        # Handle -> submissions of the last poll, newest first.
+        self._recent_by_handle = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def run(self):
+        self._poll_task.start()
+
+    def watch(self, owner, handles):
+        """Sets the handles watched by `owner`, replacing the ones it watched before."""
+        old = self.handles_by_owner.pop(owner, set())
+        new = set(filter(None, handles))
+        if new:
+            self.handles_by_owner[owner] = new
+        for handle in new - old:
+            self.refcount_by_handle[handle] += 1
+        for handle in old - new:
+            self.refcount_by_handle[handle] -= 1
+            if self.refcount_by_handle[handle] == 0:
+                del self.refcount_by_handle[handle]
+                self._recent_by_handle.pop(handle, None)
+
+    def unwatch(self, owner):
+        self.watch(owner, ())
+
+    async def get_recent_submissions(self, handle, *, fresh=False):
+        """Returns the latest submissions of the handle, newest first. For a hot handle those of
+        the last poll are returned unless `fresh` is set, others are fetched."""
+        if not fresh and handle in self._recent_by_handle:
+            return self._recent_by_handle[handle]
+        submissions = await cf.user.status(handle=handle, count=self._RECENT_COUNT)
+        if handle in self.refcount_by_handle:
+            self._update(handle, submissions)
+        return submissions
+
+    def _update(self, handle, submissions):
+        # On the first poll of a handle all its judged submissions are new, so that verdicts
+        # given before it became hot are not missed.
+        old_verdicts = {sub.id: sub.verdict for sub in self._recent_by_handle.get(handle, [])}
+        self._recent_by_handle[handle] = submissions
+        judged = [sub for sub in submissions
+                  if sub.verdict not in (None, 'TESTING') and old_verdicts.get(sub.id) != sub.verdict]
+        if judged:
+            cf_common.event_sys.dispatch(events.SubmissionVerdict, handle=handle,
+                                         submissions=judged)
+
+    @tasks.task_spec(name='SubmissionWatcherPoll',
+                     waiter=tasks.Waiter.fixed_delay(_POLL_INTERVAL))
+    async def _poll_task(self, _):
+        handles = list(self.refcount_by_handle)
+        if not handles:
+            return
+        results = await asyncio.gather(
+            *(cf.user.status(handle=handle, count=self._RECENT_COUNT) for handle in handles),
+            return_exceptions=True)
+        for handle, result in zip(handles, results):
+            if isinstance(result, cf.CodeforcesApiError):
+                self.logger.warning(f'Polling submissions of {handle} failed. {result!r}')
+            elif isinstance(result, BaseException):
+                raise result
+            elif handle in self.refcount_by_handle:
+                self._update(handle, result)
 
 
 class RanklistCacheError(CacheError):
@@ -524,16 +1028,59 @@ class RanklistNotMonitored(RanklistCacheError):
 
 class RanklistCache:
     _RELOAD_DELAY = 2 * 60
+    # Between full refreshes of a ranklist only the rows of tracked handles are fetched.
+    _FULL_REFRESH_DELAY = 10 * 60
+    # Number of delta snapshots saved after a full one before the next full one.
+    _MAX_SNAPSHOT_DELTAS = 15
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
         self.monitored_contests = []
         self.ranklist_by_contest = {}
+        # Contest id -> (state of the last saved snapshot, number of deltas since a full one).
+        self._snapshots = {}
+        self._full_refresh_time = {}
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
+        self._load_snapshots()
         self._update_task.start()
 
+    def _load_snapshots(self):
+        data_by_contest = defaultdict(list)
+        for contest_id, data in self.cache_master.conn.fetch_ranklist_snapshots():
+            data_by_contest[contest_id].append(data)
+        for contest_id, data_list in data_by_contest.items():
+            try:
+                state = snapshot.decode(data_list)
+                self.ranklist_by_contest[contest_id] = snapshot.to_ranklist(state)
+            except Exception as e:
+                self.logger.warning(f'Could not load ranklist snapshot of contest {contest_id}. {e!r}')
+                continue
+            self._snapshots[contest_id] = (state, len(data_list) - 1)
+        if self._snapshots:
+            self.logger.info(f'Loaded ranklists of {len(self._snapshots)} contests from snapshots')
+
+    async def _save_snapshot(self, contest_id, ranklist):
+        # Encoding a large ranklist takes a while, keep it off the event loop.
+        state, data, num_deltas = await executors.run_cpu_bound(
+            snapshot.encode, ranklist, self._snapshots.get(contest_id), self._MAX_SNAPSHOT_DELTAS)
+        await self.cache_master.conn.save_ranklist_snapshot(contest_id, data, num_deltas == 0)
+        self._snapshots[contest_id] = (state, num_deltas)
+
+    def _keep_ranklists(self, contest_ids):
+        """Drops the ranklists and snapshots of contests not in `contest_ids`."""
+        self.ranklist_by_contest = {contest_id: ranklist
+                                    for contest_id, ranklist in self.ranklist_by_contest.items()
+                                    if contest_id in contest_ids}
+        self._snapshots = {contest_id: snapshot_
+                           for contest_id, snapshot_ in self._snapshots.items()
+                           if contest_id in contest_ids}
+        self._full_refresh_time = {contest_id: refresh_time
+                                   for contest_id, refresh_time in self._full_refresh_time.items()
+                                   if contest_id in contest_ids}
+        self.cache_master.conn.clear_ranklist_snapshots(contest_ids)
+
     # Currently ranklist monitoring only supports caching unofficial ranklists
     # If official ranklist is asked, the cache will throw RanklistNotMonitored Error
     def get_ranklist(self, contest, show_official):
@@ -562,8 +1109,8 @@ class RanklistCache:
             if to_monitor:
                 self.monitored_contests = to_monitor
                 self._monitor_task.start()
-            else:
-                self.ranklist_by_contest = {}
+        if self.ranklist_by_contest.keys() - new_ids:
+            self._keep_ranklists(new_ids)
 
     @tasks.task_spec(name='RanklistCacheUpdate.MonitorActiveContests',
                      waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
@@ -577,7 +1124,7 @@ class RanklistCache:
         ]
 
         if not self.monitored_contests:
-            self.ranklist_by_contest = {}
+            self._keep_ranklists(())
             self.logger.info('No more active contests for which to monitor ranklists.')
             await self._monitor_task.stop()
             return
@@ -586,17 +1133,41 @@ class RanklistCache:
         # If any ranklist could not be fetched, the old ranklist is kept.
         for contest_id, ranklist in ranklist_by_contest.items():
             self.ranklist_by_contest[contest_id] = ranklist
+            await self._save_snapshot(contest_id, ranklist)
 
     @staticmethod
-    async def _get_contest_details(contest_id, show_unofficial):
-        contest, problems, standings = await cf.contest.standings(contest_id=contest_id,
-                                                                  show_unofficial=show_unofficial)
+    def _is_ranked(row):
         # Exclude PRACTICE and MANAGER
-        standings = [row for row in standings
-                     if row.party.participantType in ('CONTESTANT', 'OUT_OF_COMPETITION', 'VIRTUAL')]
+        return row.party.participantType in ('CONTESTANT', 'OUT_OF_COMPETITION', 'VIRTUAL')
+
+    @staticmethod
+    async def _get_contest_details(contest_id, show_unofficial):
+        contest, problems, rows = await cf.contest.standings_stream(
+            contest_id=contest_id, show_unofficial=show_unofficial)
+        standings = [row async for row in rows if RanklistCache._is_ranked(row)]
 
         return contest, problems, standings
 
+    @staticmethod
+    def _tracked_handles(ranklist):
+        """Handles of active users which are in the ranklist."""
+        active = {handle.lower() for handle in cf_common.user_db.get_active_handles()}
+        return [member.handle for row in ranklist.standings for member in row.party.members
+                if member.handle.lower() in active]
+
+    async def _refresh_tracked_rows(self, ranklist):
+        """Fetches the rows of the tracked handles only and updates `ranklist` with them. The
+        predicted deltas are kept until the next full refresh. Returns whether the ranklist
+        changed."""
+        handles = self._tracked_handles(ranklist)
+        now = time.time()
+        rows = []
+        for chunk in cf.user_info_chunkify(handles):
+            _, _, chunk_rows = await cf.contest.standings(contest_id=ranklist.contest.id,
+                                                          handles=chunk, show_unofficial=True)
+            rows += filter(self._is_ranked, chunk_rows)
+        return ranklist.update_standings(rows, now)
+
     # Fetch final rating changes from CF.
     # For older contests.
     async def _get_ranklist_with_fetched_changes(self, contest_id, show_unofficial):
@@ -622,7 +1193,8 @@ class RanklistCache:
 
     # Rating changes have not been applied yet, predict rating changes.
     # For running/recent/unrated contests.
-    async def _get_ranklist_with_predicted_changes(self, contest_id, show_unofficial):
+    async def _get_ranklist_with_predicted_changes(self, contest_id, show_unofficial,
+                                                   previous=None):
         contest, problems, standings = await self._get_contest_details(contest_id, show_unofficial)
         now = time.time()
 
@@ -637,19 +1209,24 @@ class RanklistCache:
             # The contest is not traditionally rated
             ranklist = Ranklist(contest, problems, standings, now, is_rated=False)
         else:
-            current_rating = await CacheSystem.getUsersEffectiveRating(activeOnly=False)
-            current_rating = {row.party.members[0].handle: current_rating.get(row.party.members[0].handle, 1500)
-                              for row in standings_official}
+            handles = [row.party.members[0].handle for row in standings_official]
+            # Unrated contestants are new and predicted from 1500.
+            ratings = await self.cache_master.rating_changes_cache.get_effective_ratings(handles,
+                                                                                         1500)
+            current_rating = dict(zip(handles, ratings))
             if 'Educational' in contest.name:
                 # For some reason educational contests return all contestants in ranklist even
                 # when unofficial contestants are not requested.
                 current_rating = {handle: rating
                                   for handle, rating in current_rating.items() if rating < 2100}
             ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
-            ranklist.predict(current_rating)
+            await ranklist.predict_in_executor(current_rating, previous)
         return ranklist
 
-    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False, show_unofficial=True):
+    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False, show_unofficial=True,
+                                previous=None):
+        """`previous` is an older ranklist of the contest, whose predicted deltas are reused if
+        the standings they were predicted from did not change."""
         assert fetch_changes ^ predict_changes
 
         ranklist = None
@@ -657,7 +1234,8 @@ class RanklistCache:
             ranklist = await self._get_ranklist_with_fetched_changes(contest_id, show_unofficial)
         if ranklist is None:
             # Either predict_changes was true or fetching rating changes failed
-            ranklist = await self._get_ranklist_with_predicted_changes(contest_id, show_unofficial)
+            ranklist = await self._get_ranklist_with_predicted_changes(contest_id, show_unofficial,
+                                                                       previous)
 
         # for some reason Educational contests also have div1 peeps in the official standings.
         # hence we need to manually weed them out
@@ -688,23 +1266,36 @@ class RanklistCache:
         current_vc_rating = {handle: cf_common.user_db.get_vc_rating(handle_to_member_id.get(handle))
                              for handle in handles}
         ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
-        delta_by_handle = {}
-        for handle in handles:
+
+        async def predict_for(handle):
             mixed_ratings = current_official_rating.copy()
             mixed_ratings[handle] = current_vc_rating.get(handle)
-            ranklist.predict(mixed_ratings)
-            delta_by_handle[handle] = ranklist.delta_by_handle.get(handle, 0)
+            deltas = await ranklist.predict_in_executor(mixed_ratings)
+            return deltas.get(handle, 0)
 
-        ranklist.delta_by_handle = delta_by_handle
+        # Predictions for different handles are independent, let them run in parallel.
+        deltas = await asyncio.gather(*(predict_for(handle) for handle in handles))
+        ranklist.delta_by_handle = dict(zip(handles, deltas))
         return ranklist
 
     async def _fetch(self, contests):
+        """Returns the ranklists which were fetched and changed. A ranklist is fetched in full
+        every _FULL_REFRESH_DELAY, and in between only the rows of tracked handles are."""
         ranklist_by_contest = {}
         for contest in contests:
+            previous = self.ranklist_by_contest.get(contest.id)
+            full_refresh_time = self._full_refresh_time.get(contest.id)
             try:
-                ranklist = await self.generate_ranklist(contest.id, predict_changes=True)
-                ranklist_by_contest[contest.id] = ranklist
-                self.logger.info(f'Ranklist fetched for contest {contest.id}')
+                if (previous is None or full_refresh_time is None
+                        or time.time() - full_refresh_time >= self._FULL_REFRESH_DELAY):
+                    ranklist = await self.generate_ranklist(contest.id, predict_changes=True,
+                                                            previous=previous)
+                    self._full_refresh_time[contest.id] = ranklist.fetch_time
+                    ranklist_by_contest[contest.id] = ranklist
+                    self.logger.info(f'Ranklist fetched for contest {contest.id}')
+                elif await self._refresh_tracked_rows(previous):
+                    ranklist_by_contest[contest.id] = previous
+                    self.logger.info(f'Ranklist rows of tracked handles updated for contest {contest.id}')
             except cf.CodeforcesApiError as er:
                 self.logger.warning(f'Ranklist fetch failed for contest {contest.id}. {er!r}')
 
@@ -719,6 +1310,8 @@ class CacheSystem:
         self.rating_changes_cache = RatingChangesCache(self)
         self.ranklist_cache = RanklistCache(self)
         self.problemset_cache = ProblemsetCache(self)
+        self.submission_cache = SubmissionCache(self)
+        self.submission_watcher = SubmissionWatcher(self)
 
     async def run(self):
         await self.rating_changes_cache.run()
@@ -726,13 +1319,4 @@ class CacheSystem:
         await self.contest_cache.run()
         await self.problem_cache.run()
         await self.problemset_cache.run()
-
-    @staticmethod
-    @cached(ttl=30 * 60)
-    async def getUsersEffectiveRating(*, activeOnly=None):
-        """ Returns a dictionary mapping user handle to his effective rating for all the users.
-        """
-        ratedList = await cf.user.ratedList(activeOnly=activeOnly)
-        users_effective_rating_dict = {user.handle: user.effective_rating
-                                       for user in ratedList}
-        return users_effective_rating_dict
+        await self.submission_watcher.run()
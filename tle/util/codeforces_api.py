@@ -1,13 +1,24 @@
 import asyncio
+import codecs
+import contextlib
+import contextvars
+import enum
+import heapq
+import itertools
+import json
 import logging
+import re
 import time
 import functools
-from collections import namedtuple, deque, defaultdict
+from collections import OrderedDict, namedtuple, defaultdict
 
 import aiohttp
+import numpy as np
 
 from discord.ext import commands
+from tle import constants
 from tle.util import codeforces_common as cf_common
+from tle.util import handle_table
 
 API_BASE_URL = 'https://codeforces.com/api/'
 CONTEST_BASE_URL = 'https://codeforces.com/contest/'
@@ -153,6 +164,10 @@ ProblemResult = namedtuple('ProblemResult',
 
 def make_from_dict(namedtuple_cls, dict_):
     field_vals = [dict_.get(field) for field in namedtuple_cls._fields]
+    if 'handle' in namedtuple_cls._fields:
+        # The same handles come up in many responses, share one copy of each.
+        i = namedtuple_cls._fields.index('handle')
+        field_vals[i] = handle_table.intern(field_vals[i])
     return namedtuple_cls._make(field_vals)
 
 
@@ -220,29 +235,175 @@ def _bool_to_str(value):
     raise TypeError(f'Expected bool, got {value} of type {type(value)}')
 
 
+class Priority(enum.IntEnum):
+    """Priority lanes for API requests. Requests in a lane with a lower value are always served
+    before requests in a lane with a higher value."""
+    INTERACTIVE = 0
+    MONITOR = 1
+    BACKFILL = 2
+
+
+_priority = contextvars.ContextVar('cf_api_priority', default=Priority.INTERACTIVE)
+# The shared call that API requests made from the current task are made for, if any.
+_shared_call = contextvars.ContextVar('cf_api_shared_call', default=None)
+
+
+def set_priority(priority_):
+    """Sets the priority of API requests made from the current asyncio task, and from the tasks
+    it creates afterwards."""
+    _priority.set(priority_)
+
+
+def _current_priority():
+    call = _shared_call.get()
+    return call.priority if call is not None else _priority.get()
+
+
+@contextlib.contextmanager
+def priority(priority_):
+    """Context manager to make API requests with the given priority."""
+    token = _priority.set(priority_)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _LaneStats:
+    def __init__(self):
+        self.served = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def record(self, wait):
+        self.served += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class RequestScheduler:
+    """A token bucket that hands out request slots to waiters in priority order, and in FIFO
+    order within the same priority. The bucket refills at `rate` tokens per second up to
+    `capacity`. When the API reports that the call limit was exceeded, all requests are held back
+    for an exponentially growing delay, which resets once a request goes through.
+    """
+
+    def __init__(self, rate, capacity, *, base_backoff=1, max_backoff=60):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.blocked_until = 0
+        # Heap of (priority, sequence number, enqueue time, future).
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.stats = {lane: _LaneStats() for lane in Priority}
+
+    async def acquire(self, priority_, call=None):
+        """Waits until a request with the given priority may be made. If the request is made for
+        a shared call, it is promoted when the priority of the call is raised while it waits."""
+        future = asyncio.get_running_loop().create_future()
+        self._push(priority_, time.monotonic(), future)
+        if call is not None:
+            call.waiting = future
+        try:
+            await future
+        finally:
+            if call is not None:
+                call.waiting = None
+
+    def promote(self, future, priority_):
+        """Moves the waiter of `future` to the lane of the given priority."""
+        for waiter_priority, _, enqueue_time, waiter in self._waiters:
+            if waiter is future and waiter_priority > priority_:
+                # The old entry stays in the heap and is skipped once the future is done.
+                self._push(priority_, enqueue_time, future)
+                return
+
+    def _push(self, priority_, enqueue_time, future):
+        heapq.heappush(self._waiters, (priority_, next(self._seq), enqueue_time, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def on_limit_exceeded(self):
+        self.backoff = min(self.max_backoff, 2 * self.backoff or self.base_backoff)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff)
+        self.tokens = 0
+        logger.info(f'CF API call limit exceeded, backing off for {self.backoff}s.')
+
+    def on_success(self):
+        self.backoff = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def _dispatch(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            priority_, _, enqueue_time, future = heapq.heappop(self._waiters)
+            if future.done():
+                # The waiter was cancelled, or promoted and served already.
+                continue
+            self.tokens -= 1
+            self.stats[priority_].record(time.monotonic() - enqueue_time)
+            future.set_result(None)
+
+    def get_metrics(self):
+        """Returns a dict mapping each priority lane to its queue depth, number of requests
+        served, and average and maximum time waited in seconds."""
+        depth = {lane: 0 for lane in Priority}
+        lanes = {}
+        for priority_, _, _, future in self._waiters:
+            if not future.done():
+                lanes[future] = min(priority_, lanes.get(future, priority_))
+        for priority_ in lanes.values():
+            depth[priority_] += 1
+        metrics = {}
+        for lane, stats in self.stats.items():
+            metrics[lane] = {
+                'queued': depth[lane],
+                'served': stats.served,
+                'avg_wait': stats.total_wait / stats.served if stats.served else 0,
+                'max_wait': stats.max_wait,
+            }
+        return metrics
+
+
+_scheduler = RequestScheduler(constants.CF_API_RATE, constants.CF_API_BURST)
+
+
+def get_scheduler_metrics():
+    return _scheduler.get_metrics()
+
+
 def cf_ratelimit(f):
     tries = 3
-    per_second = 1
-    last = deque([0]*per_second)
 
     @functools.wraps(f)
     async def wrapped(*args, **kwargs):
+        call = _shared_call.get()
         for i in range(tries):
-            now = time.time()
-
-            # Next valid slot is 1s after the `per_second`th last request
-            next_valid = max(now, 1 + last[0])
-            last.append(next_valid)
-            last.popleft()
-
-            # Delay as needed
-            delay = next_valid - now
-            if delay > 0:
-                await asyncio.sleep(delay)
-
+            await _scheduler.acquire(_current_priority(), call)
             try:
-                return await f(*args, **kwargs)
+                result = await f(*args, **kwargs)
+                _scheduler.on_success()
+                return result
             except (ClientError, CallLimitExceededError) as e:
+                if isinstance(e, CallLimitExceededError):
+                    _scheduler.on_limit_exceeded()
                 logger.info(f'Try {i+1}/{tries} at query failed.')
                 logger.info(repr(e))
                 if i < tries - 1:
@@ -253,6 +414,94 @@ def cf_ratelimit(f):
     return wrapped
 
 
+# Responses to identical queries made while one is in flight, or shortly after, are shared.
+_inflight = {}
+# Maps each query method to an OrderedDict of its cached responses in order of expiry, which is
+# also the order in which they were stored since the ttl of a method is fixed.
+_responses = {}
+_MAX_CACHED_RESPONSES_PER_METHOD = 64
+
+
+class _SharedCall:
+    """A query in flight that is shared by its callers. Its requests are made with the highest
+    priority among the callers."""
+
+    def __init__(self, priority_):
+        self.priority = priority_
+        self.future = None
+        # The scheduler future of the request waiting for a slot, if any.
+        self.waiting = None
+
+    def join(self, priority_):
+        if priority_ < self.priority:
+            self.priority = priority_
+            if self.waiting is not None:
+                _scheduler.promote(self.waiting, priority_)
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _copy_result(result):
+    # Callers are free to modify the lists they get, so each gets its own copy.
+    if isinstance(result, list):
+        return list(result)
+    if isinstance(result, tuple) and not hasattr(result, '_fields'):
+        return tuple(_copy_result(item) for item in result)
+    return result
+
+
+def _store_response(method, key, call, ttl):
+    if _inflight.get((method, key)) is call:
+        del _inflight[(method, key)]
+    future = call.future
+    if future.cancelled() or future.exception() is not None:
+        return
+    now = time.monotonic()
+    responses = _responses.setdefault(method, OrderedDict())
+    responses.pop(key, None)
+    while responses and next(iter(responses.values()))[0] <= now:
+        responses.popitem(last=False)
+    responses[key] = (now + ttl, future.result())
+    if len(responses) > _MAX_CACHED_RESPONSES_PER_METHOD:
+        responses.popitem(last=False)
+
+
+def cf_coalesce(ttl):
+    """Returns a decorator for API query methods which makes concurrent calls with the same
+    arguments share a single request, and serves the response for `ttl` seconds afterwards.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapped(**kwargs):
+            method = f.__qualname__
+            key = _freeze(sorted(kwargs.items()))
+            cached = _responses.get(method, {}).get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return _copy_result(cached[1])
+            call = _inflight.get((method, key))
+            if call is None:
+                call = _SharedCall(_current_priority())
+                # The task runs in a copy of the current context, with the call set.
+                token = _shared_call.set(call)
+                try:
+                    call.future = asyncio.ensure_future(f(**kwargs))
+                finally:
+                    _shared_call.reset(token)
+                _inflight[(method, key)] = call
+                call.future.add_done_callback(
+                    lambda fut: _store_response(method, key, call, ttl))
+            else:
+                call.join(_current_priority())
+            # Shielded so that a caller giving up does not cancel the request for the others.
+            return _copy_result(await asyncio.shield(call.future))
+        return wrapped
+    return decorator
+
+
 @cf_ratelimit
 async def _query_api(path, data=None):
     url = API_BASE_URL + path
@@ -272,14 +521,122 @@ async def _query_api(path, data=None):
     except aiohttp.ClientError as e:
         logger.error(f'Request to CF API encountered error: {e!r}')
         raise ClientError from e
+    _raise_api_error(comment)
+
+
+def _raise_api_error(comment):
     logger.warning(f'Query to CF API failed: {comment}')
     if 'limit exceeded' in comment:
         raise CallLimitExceededError(comment)
     raise TrueApiError(comment)
 
 
+_STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_SEPARATORS = re.compile(r'[\s,]*')
+
+
+class _ResultStream:
+    """Decodes the elements of one large array in the result of a query one by one as the
+    response arrives, instead of buffering the whole response and decoding it at once. The array
+    is the one under the key `array_key` of the result. The rest of the result is available as
+    `header` once `read_header` is done.
+    """
+
+    def __init__(self, resp, array_key):
+        self.resp = resp
+        self.marker = re.compile(rf'"{array_key}"\s*:\s*\[')
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.header = None
+
+    async def _read_more(self):
+        try:
+            chunk = await self.resp.content.read(_STREAM_CHUNK_SIZE)
+        except aiohttp.ClientError as e:
+            logger.error(f'Streaming from CF API encountered error: {e!r}')
+            raise ClientError from e
+        if not chunk:
+            logger.error('Response from CF API ended unexpectedly.')
+            raise ClientError
+        # Drop what has already been decoded.
+        self.buf = self.buf[self.pos:] + self.utf8.decode(chunk)
+        self.pos = 0
+
+    async def read_header(self):
+        match = self.marker.search(self.buf)
+        while match is None:
+            await self._read_more()
+            match = self.marker.search(self.buf)
+        # The array is the last key of the result, so everything before it is the rest of the
+        # result with the closing braces missing.
+        prefix = self.buf[:match.start()].rstrip().rstrip(',')
+        self.header = json.loads(prefix + '}}')['result']
+        self.pos = match.end()
+
+    async def items(self):
+        try:
+            while True:
+                self.pos = _STREAM_SEPARATORS.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf):
+                    await self._read_more()
+                    continue
+                if self.buf[self.pos] == ']':
+                    return
+                try:
+                    item, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                except json.JSONDecodeError:
+                    # The element is not fully received yet.
+                    await self._read_more()
+                    continue
+                yield item
+        finally:
+            self.resp.release()
+
+
+@cf_ratelimit
+async def _query_api_stream(path, data, array_key):
+    """Like `_query_api`, but returns a `_ResultStream` over the array `array_key` of the result."""
+    url = API_BASE_URL + path
+    try:
+        logger.info(f'Streaming CF API at {url} with {data}')
+        headers = {'Accept-Encoding': 'gzip'}
+        resp = await _session.post(url, data=data, headers=headers)
+        if resp.status == 200:
+            stream = _ResultStream(resp, array_key)
+            try:
+                await stream.read_header()
+            except BaseException:
+                resp.release()
+                raise
+            return stream
+        try:
+            respjson = await resp.json()
+        except aiohttp.ContentTypeError:
+            logger.warning(f'CF API did not respond with JSON, status {resp.status}.')
+            raise CodeforcesApiError
+        finally:
+            resp.release()
+        comment = f'HTTP Error {resp.status}, {respjson.get("comment")}'
+    except aiohttp.ClientError as e:
+        logger.error(f'Request to CF API encountered error: {e!r}')
+        raise ClientError from e
+    _raise_api_error(comment)
+
+
+def _make_ranklist_row(row):
+    row['party']['members'] = [make_from_dict(Member, member)
+                               for member in row['party']['members']]
+    row['party'] = make_from_dict(Party, row['party'])
+    row['problemResults'] = [make_from_dict(ProblemResult, problem_result)
+                             for problem_result in row['problemResults']]
+    return make_from_dict(RanklistRow, row)
+
+
 class contest:
     @staticmethod
+    @cf_coalesce(ttl=60)
     async def list(*, gym=None):
         params = {}
         if gym is not None:
@@ -288,6 +645,7 @@ class contest:
         return [make_from_dict(Contest, contest_dict) for contest_dict in resp]
 
     @staticmethod
+    @cf_coalesce(ttl=60)
     async def ratingChanges(*, contest_id):
         params = {'contestId': contest_id}
         try:
@@ -301,8 +659,47 @@ class contest:
         return [make_from_dict(RatingChange, change_dict) for change_dict in resp]
 
     @staticmethod
+    @cf_coalesce(ttl=30)
     async def standings(*, contest_id, from_=None, count=None, handles=None, room=None,
                         show_unofficial=None):
+        params = contest._standings_params(contest_id, from_, count, handles, room,
+                                           show_unofficial)
+        try:
+            resp = await _query_api('contest.standings', params)
+        except TrueApiError as e:
+            if 'not found' in e.comment:
+                raise ContestNotFoundError(e.comment, contest_id)
+            raise
+        contest_ = make_from_dict(Contest, resp['contest'])
+        problems = [make_from_dict(Problem, problem_dict) for problem_dict in resp['problems']]
+        ranklist = [_make_ranklist_row(row_dict) for row_dict in resp['rows']]
+        return contest_, problems, ranklist
+
+    @staticmethod
+    async def standings_stream(*, contest_id, from_=None, count=None, handles=None, room=None,
+                               show_unofficial=None):
+        """Like `standings`, but the ranklist is an async iterator of rows decoded as the
+        response arrives."""
+        params = contest._standings_params(contest_id, from_, count, handles, room,
+                                           show_unofficial)
+        try:
+            stream = await _query_api_stream('contest.standings', params, 'rows')
+        except TrueApiError as e:
+            if 'not found' in e.comment:
+                raise ContestNotFoundError(e.comment, contest_id)
+            raise
+        contest_ = make_from_dict(Contest, stream.header['contest'])
+        problems = [make_from_dict(Problem, problem_dict)
+                    for problem_dict in stream.header['problems']]
+
+        async def ranklist():
+            async for row_dict in stream.items():
+                yield _make_ranklist_row(row_dict)
+
+        return contest_, problems, ranklist()
+
+    @staticmethod
+    def _standings_params(contest_id, from_, count, handles, room, show_unofficial):
         params = {'contestId': contest_id}
         if from_ is not None:
             params['from'] = from_
@@ -314,26 +711,12 @@ class contest:
             params['room'] = room
         if show_unofficial is not None:
             params['showUnofficial'] = _bool_to_str(show_unofficial)
-        try:
-            resp = await _query_api('contest.standings', params)
-        except TrueApiError as e:
-            if 'not found' in e.comment:
-                raise ContestNotFoundError(e.comment, contest_id)
-            raise
-        contest_ = make_from_dict(Contest, resp['contest'])
-        problems = [make_from_dict(Problem, problem_dict) for problem_dict in resp['problems']]
-        for row in resp['rows']:
-            row['party']['members'] = [make_from_dict(Member, member)
-                                       for member in row['party']['members']]
-            row['party'] = make_from_dict(Party, row['party'])
-            row['problemResults'] = [make_from_dict(ProblemResult, problem_result)
-                                     for problem_result in row['problemResults']]
-        ranklist = [make_from_dict(RanklistRow, row_dict) for row_dict in resp['rows']]
-        return contest_, problems, ranklist
+        return params
 
 
 class problemset:
     @staticmethod
+    @cf_coalesce(ttl=60)
     async def problems(*, tags=None, problemset_name=None):
         params = {}
         if tags is not None:
@@ -367,6 +750,7 @@ def user_info_chunkify(handles):
 
 class user:
     @staticmethod
+    @cf_coalesce(ttl=30)
     async def info(*, handles):
         chunks = list(user_info_chunkify(handles))
         if len(chunks) > 1:
@@ -389,24 +773,33 @@ class user:
 
     @staticmethod
     def correct_rating_changes(*, resp):
-        adaptO = [1400, 900, 550, 300, 150, 50]
-        adaptN = [900, 550, 300, 150, 50, 0]
-        for r in resp:
-            if (len(r) > 0):
-                if (r[0].newRating <= 1200):
-                    for ind in range(0,(min(6, len(r)))):
-                        r[ind] = RatingChange(r[ind].contestId, r[ind].contestName, r[ind].handle, r[ind].rank, r[ind].ratingUpdateTimeSeconds, r[ind].oldRating+adaptO[ind], r[ind].newRating+adaptN[ind])
-                else:
-                    r[0] = RatingChange(r[0].contestId, r[0].contestName, r[0].handle, r[0].rank, r[0].ratingUpdateTimeSeconds, r[0].oldRating+1500, r[0].newRating)
+        """Turns each rating history of `resp` into a performance history: the new rating of a
+        change becomes the performance in that contest and the old rating the previous one. The
+        starting rating adjustments of the new rating system are undone first."""
+        adaptO = np.array([1400, 900, 550, 300, 150, 50])
+        adaptN = np.array([900, 550, 300, 150, 50, 0])
+        corrected = []
         for r in resp:
-            oldPerf = 0
-            for ind in range(0,len(r)):
-                r[ind] = RatingChange(r[ind].contestId, r[ind].contestName, r[ind].handle, r[ind].rank, r[ind].ratingUpdateTimeSeconds, oldPerf, r[ind].oldRating + 4*(r[ind].newRating-r[ind].oldRating))
-                oldPerf = r[ind].oldRating + 4*(r[ind].newRating-r[ind].oldRating)
-        return resp
+            if not r:
+                corrected.append([])
+                continue
+            old = np.array([change.oldRating for change in r], dtype=np.int64)
+            new = np.array([change.newRating for change in r], dtype=np.int64)
+            if new[0] <= 1200:
+                k = min(6, len(r))
+                old[:k] += adaptO[:k]
+                new[:k] += adaptN[:k]
+            else:
+                old[0] += 1500
+            perf = old + 4 * (new - old)
+            prev_perf = np.concatenate(([0], perf[:-1]))
+            corrected.append([change._replace(oldRating=int(p), newRating=int(q))
+                              for change, p, q in zip(r, prev_perf, perf)])
+        return corrected
 
 
     @staticmethod
+    @cf_coalesce(ttl=60)
     async def rating(*, handle):
         params = {'handle': handle}
         try:
@@ -420,6 +813,7 @@ class user:
         return [make_from_dict(RatingChange, ratingchange_dict) for ratingchange_dict in resp]
 
     @staticmethod
+    @cf_coalesce(ttl=60)
     async def ratedList(*, activeOnly=None):
         params = {}
         if activeOnly is not None:
@@ -428,6 +822,7 @@ class user:
         return [make_from_dict(User, user_dict) for user_dict in resp]
 
     @staticmethod
+    @cf_coalesce(ttl=5)
     async def status(*, handle, from_=None, count=None):
         params = {'handle': handle}
         if from_ is not None:
@@ -450,57 +845,79 @@ class user:
         return [make_from_dict(Submission, submission_dict) for submission_dict in resp]
 
 
-async def _needs_fixing(handles):
-    to_fix = []
-    chunks = user_info_chunkify(handles)
-    for handle_chunk in chunks:
+async def info_skipping_missing(handles):
+    """Like user.info, but handles that are not found are left out instead of raising."""
+    cf_users = []
+    for handle_chunk in user_info_chunkify(handles):
         while handle_chunk:
             try:
-                cf_users = await user.info(handles=handle_chunk)
-
-                # Users could still have changed capitalization
-                for handle, cf_user in zip(handle_chunk, cf_users):
-                    assert handle.lower() == cf_user.handle.lower()
-                    if handle != cf_user.handle:
-                        to_fix.append(handle)
+                cf_users += await user.info(handles=handle_chunk)
                 break
             except HandleNotFoundError as e:
-                to_fix.append(e.handle)
                 handle_chunk.remove(e.handle)
-            time.sleep(1)
-    return to_fix
+    return cf_users
+
+
+async def _needs_fixing(handles):
+    cf_users = await info_skipping_missing(handles)
+    # Users could still have changed capitalization
+    current = {cf_user.handle.lower(): cf_user.handle for cf_user in cf_users}
+    return [handle for handle in handles if current.get(handle.lower()) != handle]
 
 
+@cf_ratelimit
 async def _resolve_redirect(handle):
     url = PROFILE_BASE_URL + handle
-    async with _session.head(url) as r:
-        if r.status == 200:
-            return handle
-        if r.status == 301 or r.status == 302:
-            redirected = r.headers.get('Location')
-            if '/profile/' not in redirected:
-                # Ended up not on profile page, probably invalid handle
-                return None
-            return redirected.split('/profile/')[-1]
-        raise CodeforcesApiError(
-            f'Something went wrong trying to redirect {url}')
-
-
-async def _resolve_handle_mapping(handles_to_fix):
-    redirections = {}
-    failed = []
-    for handle in handles_to_fix:
-        new_handle = await _resolve_redirect(handle)
-        if not new_handle:
-            redirections[handle] = None
-        else:
-            cf_user, = await user.info(handles=[new_handle])
-            redirections[handle] = cf_user
-        time.sleep(1)
-    return redirections
-
-
-async def resolve_redirects(handles):
+    try:
+        async with _session.head(url) as r:
+            if r.status == 200:
+                return handle
+            if r.status == 301 or r.status == 302:
+                redirected = r.headers.get('Location')
+                if '/profile/' not in redirected:
+                    # Ended up not on profile page, probably invalid handle
+                    return None
+                return redirected.split('/profile/')[-1]
+    except aiohttp.ClientError as e:
+        logger.error(f'Request to {url} encountered error: {e!r}')
+        raise ClientError from e
+    raise CodeforcesApiError(
+        f'Something went wrong trying to redirect {url}')
+
+
+_MAX_CONCURRENT_REDIRECTS = 8
+
+
+async def _resolve_handle_mapping(handles_to_fix, progress=None):
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REDIRECTS)
+
+    async def resolve(handle):
+        async with semaphore:
+            try:
+                return handle, await _resolve_redirect(handle)
+            except CodeforcesApiError as e:
+                logger.warning(f'Could not resolve redirect of {handle}: {e!r}')
+                return handle, None
+
+    new_handles = {}
+    for done, future in enumerate(asyncio.as_completed(map(resolve, handles_to_fix)), 1):
+        handle, new_handle = await future
+        new_handles[handle] = new_handle
+        if progress:
+            await progress(done, len(handles_to_fix))
+
+    cf_users = await info_skipping_missing(
+        [new_handle for new_handle in new_handles.values() if new_handle])
+    cf_user_by_handle = {cf_user.handle.lower(): cf_user for cf_user in cf_users}
+    return {handle: cf_user_by_handle.get(new_handles[handle].lower())
+                    if new_handles[handle] else None
+            for handle in handles_to_fix}
+
+
+async def resolve_redirects(handles, progress=None):
+    """Returns a mapping from each handle that no longer exists as is to the cf.User it now
+    redirects to, or None if it could not be resolved. Redirects are resolved concurrently, and
+    `progress(done, total)` is awaited after each one if given."""
     handles_to_fix = await _needs_fixing(handles)
-    handle_mapping = await _resolve_handle_mapping(handles_to_fix)
+    handle_mapping = await _resolve_handle_mapping(handles_to_fix, progress)
     return handle_mapping
@@ -13,6 +13,7 @@ from tle import constants
 from tle.util import cache_system2
 from tle.util import codeforces_api as cf
 from tle.util import db
+from tle.util import discord_common
 from tle.util import events
 
 logger = logging.getLogger(__name__)
@@ -115,7 +116,7 @@ async def get_visited_contests(handles : [str]):
     """ Returns a set of contest ids of contests that any of the given handles
         has at least one non-CE submission.
     """
-    user_submissions = [await cf.user.status(handle=handle) for handle in handles]
+    user_submissions = await cache2.submission_cache.get_submissions_for_all(handles)
     problem_to_contests = cache2.problemset_cache.problem_to_contests
 
     contest_ids = []
@@ -234,6 +235,20 @@ def days_ago(t):
         return 'yesterday'
     return f'{math.floor(days)} days ago'
 
+async def get_submissions_reporting_failures(ctx, handles):
+    """Fetches the submissions of the handles concurrently. Handles whose submissions could not
+    be fetched are reported in the channel and left out, unless none could be fetched in which
+    case the error is raised. Returns the remaining handles and a list of their submissions."""
+    submissions, failures = await cache2.submission_cache.get_submissions_many(handles)
+    if not submissions and failures:
+        raise next(iter(failures.values()))
+    if failures:
+        failed_str = ', '.join(f'`{handle}`' for handle in failures)
+        await ctx.send(embed=discord_common.embed_alert(
+            f'Could not fetch submissions of {failed_str}, leaving them out.'))
+    return list(submissions), list(submissions.values())
+
+
 async def resolve_handles(ctx, converter, handles, *, mincnt=1, maxcnt=5, default_to_all_server=False):
     """Convert an iterable of strings to CF handles. A string beginning with ! indicates Discord username,
      otherwise it is a raw CF handle to be left unchanged."""
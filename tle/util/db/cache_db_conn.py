@@ -2,13 +2,22 @@ import json
 import sqlite3
 
 from tle.util import codeforces_api as cf
+from tle.util import rating_store
+from tle.util.db import migrations
+from tle.util.db.db_worker import DbWorker, tune_connection
+from tle.util.db.migrations import Migration
 
 
 class CacheDbConn:
     def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
+        self.conn = tune_connection(sqlite3.connect(db_file))
+        self.worker = DbWorker(db_file)
         self.create_tables()
 
+    async def fetchall(self, query, params=()):
+        """Runs a read query on the worker thread."""
+        return await self.worker.fetchall(query, params)
+
     def create_tables(self):
         # Table for contests from the contest.list endpoint.
         self.conn.execute(
@@ -77,6 +86,63 @@ class CacheDbConn:
         self.conn.execute('CREATE INDEX IF NOT EXISTS ix_problem2_contest_id '
                           'ON problem2 (contest_id)')
 
+        # Table for submissions fetched from the user.status endpoint, kept per handle so that
+        # only the submissions newer than the ones already known have to be fetched.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS submission ('
+            'handle                 TEXT NOT NULL COLLATE NOCASE,'
+            'id                     INTEGER NOT NULL,'
+            'contest_id             INTEGER,'
+            'problem                TEXT,'
+            'author                 TEXT,'
+            'programming_language   TEXT,'
+            'verdict                TEXT,'
+            'creation_time          INTEGER,'
+            'relative_time          INTEGER,'
+            'PRIMARY KEY (handle, id)'
+            ')'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS submission_sync ('
+            'handle           TEXT NOT NULL COLLATE NOCASE,'
+            'full_fetch_time  INTEGER,'
+            'PRIMARY KEY (handle)'
+            ')'
+        )
+        # Table for snapshots of monitored ranklists, so that they survive restarts. The rows of
+        # a contest are a full snapshot followed by deltas, see tle.util.ranklist.snapshot.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ranklist_snapshot ('
+            'id           INTEGER PRIMARY KEY,'
+            'contest_id   INTEGER NOT NULL,'
+            'is_full      INTEGER NOT NULL,'
+            'data         BLOB NOT NULL'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_ranklist_snapshot_contest_id '
+                          'ON ranklist_snapshot (contest_id, id)')
+        # Table for handles that were renamed, so that rating changes saved under an old handle
+        # can be found from the new one.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS handle_redirect ('
+            'old_handle   TEXT PRIMARY KEY COLLATE NOCASE,'
+            'new_handle   TEXT NOT NULL COLLATE NOCASE'
+            ')'
+        )
+        migrations.upgrade(self.conn, self.MIGRATIONS)
+
+    MIGRATIONS = [
+        Migration(
+            'Cover per-handle rating summaries with an index',
+            ['CREATE INDEX IF NOT EXISTS ix_rating_change_handle_time_rating '
+             'ON rating_change (handle, rating_update_time, new_rating)'],
+            ['SELECT handle, new_rating, COUNT(*), MAX(rating_update_time) '
+             'FROM rating_change GROUP BY handle']),
+        Migration(
+            'Drop the rating summary index, summaries are computed from the rating store',
+            ['DROP INDEX IF EXISTS ix_rating_change_handle_time_rating']),
+    ]
+
     def cache_contests(self, contests):
         query = ('INSERT OR REPLACE INTO contest '
                  '(id, name, start_time, duration, type, phase, prepared_by) '
@@ -115,7 +181,7 @@ class CacheDbConn:
         res = self.conn.execute(query).fetchall()
         return list(map(self._unsquish_tags, res))
 
-    def save_rating_changes(self, changes):
+    async def save_rating_changes(self, changes):
         change_tuples = [(change.contestId,
                           change.handle,
                           change.rank,
@@ -125,9 +191,7 @@ class CacheDbConn:
         query = ('INSERT OR REPLACE INTO rating_change '
                  '(contest_id, handle, rank, rating_update_time, old_rating, new_rating) '
                  'VALUES (?, ?, ?, ?, ?, ?)')
-        rc = self.conn.executemany(query, change_tuples).rowcount
-        self.conn.commit()
-        return rc
+        return await self.worker.executemany(query, change_tuples)
 
     def clear_rating_changes(self, contest_id=None):
         if contest_id is None:
@@ -138,21 +202,27 @@ class CacheDbConn:
             self.conn.execute(query, (contest_id,))
         self.conn.commit()
 
-    def get_users_with_more_than_n_contests(self, time_cutoff, n):
-        query = ('SELECT handle, COUNT(*) AS num_contests '
-                 'FROM rating_change GROUP BY handle HAVING num_contests >= ? '
-                 'AND MAX(rating_update_time) >= ?')
-        res = self.conn.execute(query, (n, time_cutoff,)).fetchall()
-        return [user[0] for user in res]
+    def save_handle_redirects(self, redirects):
+        query = ('INSERT OR REPLACE INTO handle_redirect (old_handle, new_handle) '
+                 'VALUES (?, ?)')
+        self.conn.executemany(query, redirects)
+        self.conn.commit()
 
-    def get_all_rating_changes(self):
-        query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
-                 'FROM rating_change r '
-                 'LEFT JOIN contest c '
-                 'ON r.contest_id = c.id '
+    def get_handle_redirects(self):
+        query = 'SELECT old_handle, new_handle FROM handle_redirect'
+        return self.conn.execute(query).fetchall()
+
+    async def count_rating_changes(self):
+        count, = await self.worker.fetchone('SELECT COUNT(*) FROM rating_change')
+        return count
+
+    async def build_rating_store(self, path):
+        """Writes the rating store at `path` from the saved rating changes and returns it."""
+        query = ('SELECT handle, contest_id, rank, rating_update_time, old_rating, new_rating '
+                 'FROM rating_change '
                  'ORDER BY rating_update_time')
-        res = self.conn.execute(query)
-        return (cf.RatingChange._make(change) for change in res)
+        return await self.worker.run(
+            lambda conn: rating_store.RatingStore.build(path, conn.execute(query)))
 
     def get_rating_changes_for_contest(self, contest_id):
         query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
@@ -170,24 +240,6 @@ class CacheDbConn:
         res = self.conn.execute(query, (contest_id,)).fetchone()
         return res is not None
 
-    def get_rating_changes_for_handle(self, handle):
-        query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
-                 'FROM rating_change r '
-                 'LEFT JOIN contest c '
-                 'ON r.contest_id = c.id '
-                 'WHERE r.handle = ?')
-        res = self.conn.execute(query, (handle,)).fetchall()
-        return [cf.RatingChange._make(change) for change in res]
-
-    def get_all_ratings_before_timestamp(self, timestamp):
-        query = ('SELECT contest_id, "Dummy", handle, rank, rating_update_time, old_rating, new_rating '
-                 'FROM rating_change '
-                 'WHERE rating_update_time < ? '
-                 'GROUP BY handle '
-                 'HAVING MAX(rating_update_time)')
-        res = self.conn.execute(query, (timestamp,)).fetchall()
-        return [cf.RatingChange._make(change) for change in res]
-
     def cache_problemset(self, problemset):
         query = ('INSERT OR REPLACE INTO problem2 '
                  '(contest_id, problemset_name, [index], name, type, points, rating, tags) '
@@ -222,5 +274,103 @@ class CacheDbConn:
         res = self.conn.execute(query).fetchone()
         return res is None
 
+    @staticmethod
+    def _squish_submission(handle, submission):
+        return (handle, submission.id, submission.contestId, json.dumps(submission.problem),
+                json.dumps(submission.author), submission.programmingLanguage,
+                submission.verdict, submission.creationTimeSeconds,
+                submission.relativeTimeSeconds)
+
+    @staticmethod
+    def _unsquish_submission(row):
+        id_, contest_id, problem, author, language, verdict, creation_time, relative_time = row
+        problem = cf.Problem._make(json.loads(problem))
+        author = cf.Party._make(json.loads(author))
+        author = author._replace(members=[cf.Member._make(member) for member in author.members])
+        return cf.Submission(id_, contest_id, problem, author, language, verdict, creation_time,
+                             relative_time)
+
+    def _save_submissions(self, conn, handle, submissions):
+        query = ('INSERT OR REPLACE INTO submission '
+                 '(handle, id, contest_id, problem, author, programming_language, verdict, '
+                 'creation_time, relative_time) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        rows = [self._squish_submission(handle, submission) for submission in submissions]
+        return conn.executemany(query, rows).rowcount
+
+    async def save_submissions(self, handle, submissions):
+        """Saves the submissions of the handle. They are encoded and written on the worker
+        thread, as lists of many submissions take a while."""
+        def save(conn):
+            with conn:
+                return self._save_submissions(conn, handle, submissions)
+        return await self.worker.run(save)
+
+    async def replace_submissions(self, handle, submissions, full_fetch_time):
+        """Replaces all saved submissions of the handle with `submissions`, fetched in full at
+        `full_fetch_time`."""
+        def replace(conn):
+            with conn:
+                conn.execute('DELETE FROM submission WHERE handle = ?', (handle,))
+                rc = self._save_submissions(conn, handle, submissions)
+                conn.execute('INSERT OR REPLACE INTO submission_sync (handle, full_fetch_time) '
+                             'VALUES (?, ?)', (handle, full_fetch_time))
+                return rc
+        return await self.worker.run(replace)
+
+    async def fetch_submissions(self, handle):
+        query = ('SELECT id, contest_id, problem, author, programming_language, verdict, '
+                 'creation_time, relative_time '
+                 'FROM submission '
+                 'WHERE handle = ? '
+                 'ORDER BY id DESC')
+        return await self.worker.run(
+            lambda conn: list(map(self._unsquish_submission, conn.execute(query, (handle,)))))
+
+    def get_newest_submission_id(self, handle):
+        query = ('SELECT MAX(id) '
+                 'FROM submission '
+                 'WHERE handle = ?')
+        return self.conn.execute(query, (handle,)).fetchone()[0]
+
+    def get_oldest_pending_submission_id(self, handle):
+        query = ('SELECT MIN(id) '
+                 'FROM submission '
+                 'WHERE handle = ? AND (verdict IS NULL OR verdict = \'TESTING\')')
+        return self.conn.execute(query, (handle,)).fetchone()[0]
+
+    def get_submissions_full_fetch_time(self, handle):
+        query = ('SELECT full_fetch_time '
+                 'FROM submission_sync '
+                 'WHERE handle = ?')
+        res = self.conn.execute(query, (handle,)).fetchone()
+        return res[0] if res else None
+
+    async def save_ranklist_snapshot(self, contest_id, data, is_full):
+        """Saves a snapshot of the ranklist of the contest. A full snapshot replaces the ones
+        saved before it."""
+        def save(conn):
+            with conn:
+                if is_full:
+                    conn.execute('DELETE FROM ranklist_snapshot WHERE contest_id = ?',
+                                 (contest_id,))
+                conn.execute('INSERT INTO ranklist_snapshot (contest_id, is_full, data) '
+                             'VALUES (?, ?, ?)', (contest_id, int(is_full), data))
+        await self.worker.run(save)
+
+    def fetch_ranklist_snapshots(self):
+        """Returns (contest_id, data) of all snapshots, in the order they were saved."""
+        query = ('SELECT contest_id, data '
+                 'FROM ranklist_snapshot '
+                 'ORDER BY contest_id, id')
+        return self.conn.execute(query).fetchall()
+
+    def clear_ranklist_snapshots(self, keep_contest_ids=()):
+        keep_contest_ids = list(keep_contest_ids)
+        placeholders = ', '.join('?' * len(keep_contest_ids))
+        query = f'DELETE FROM ranklist_snapshot WHERE contest_id NOT IN ({placeholders})'
+        self.conn.execute(query, keep_contest_ids)
+        self.conn.commit()
+
     def close(self):
         self.conn.close()
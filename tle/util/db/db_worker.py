@@ -0,0 +1,59 @@
+import asyncio
+import concurrent.futures
+import sqlite3
+
+
+def tune_connection(conn):
+    """Puts the database in WAL mode and tunes the connection. With WAL, readers and a writer
+    do not block each other, and synchronous NORMAL makes commits skip the fsync, which is safe
+    in WAL mode except against power loss."""
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -65536')  # 64 MiB
+    conn.execute('PRAGMA mmap_size = 268435456')  # 256 MiB
+    conn.execute('PRAGMA busy_timeout = 5000')  # ms
+    return conn
+
+
+class DbWorker:
+    """A connection to the database which lives on a thread of its own. Queries are run on that
+    thread and awaited, so that long reads and large commits do not block the event loop."""
+
+    def __init__(self, dbfile, row_factory=None):
+        self.dbfile = dbfile
+        self.row_factory = row_factory
+        self.conn = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                              thread_name_prefix='db')
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = tune_connection(sqlite3.connect(self.dbfile))
+            self.conn.row_factory = self.row_factory
+        return self.conn
+
+    async def run(self, func, *args):
+        """Runs `func(conn, *args)` on the worker thread and returns the result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(self._connect(), *args))
+
+    async def fetchall(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchall())
+
+    async def fetchone(self, query, params=()):
+        return await self.run(lambda conn: conn.execute(query, params).fetchone())
+
+    async def execute(self, query, params=()):
+        """Runs a write query in a transaction of its own and returns the row count."""
+        def execute(conn):
+            with conn:
+                return conn.execute(query, params).rowcount
+        return await self.run(execute)
+
+    async def executemany(self, query, seq_of_params):
+        """Runs a write query for each set of params in a single transaction and returns the row
+        count."""
+        def executemany(conn):
+            with conn:
+                return conn.executemany(query, seq_of_params).rowcount
+        return await self.run(executemany)
@@ -0,0 +1,133 @@
+"""
+    Versioned schema migrations for the sqlite databases.
+
+    A database is at version N when the first N migrations of its list have been applied, and
+    the version is kept in PRAGMA user_version. Each migration runs in a transaction together
+    with the version bump, and its statements must be idempotent (IF NOT EXISTS etc.) since
+    databases created before versioning may already have some of them applied.
+
+    Pending migrations of a database file can be inspected without applying them:
+
+        python -m tle.util.db.migrations {user|cache} <dbfile> [--apply]
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(namedtuple('Migration', 'description statements queries')):
+    """`statements` upgrade the schema. `queries` are the queries the migration is meant to
+    speed up, used to report their query plans before and after."""
+    __slots__ = ()
+
+    def __new__(cls, description, statements, queries=()):
+        return super().__new__(cls, description, statements, queries)
+
+
+def get_version(conn):
+    version, = conn.execute('PRAGMA user_version').fetchone()
+    return version
+
+
+def query_plan(conn, query):
+    # Parameters are left unbound, which sqlite treats as NULL.
+    params = (None,) * query.count('?')
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def _begin(conn):
+    if conn.in_transaction:
+        conn.commit()
+    # Begin explicitly, since the sqlite3 module does not open transactions for DDL.
+    conn.execute('BEGIN')
+
+
+def _apply(conn, migration, version):
+    for statement in migration.statements:
+        conn.execute(statement)
+    conn.execute(f'PRAGMA user_version = {version}')
+
+
+def _pending(conn, migrations):
+    for version in range(get_version(conn) + 1, len(migrations) + 1):
+        yield version, migrations[version - 1]
+
+
+def upgrade(conn, migrations):
+    """Applies the pending migrations in order. Returns the versions applied."""
+    applied = []
+    for version, migration in list(_pending(conn, migrations)):
+        _begin(conn)
+        try:
+            _apply(conn, migration, version)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        logger.info(f'Migrated database to version {version}: {migration.description}')
+        applied.append(version)
+    return applied
+
+
+def explain(conn, migrations):
+    """Dry run of `upgrade`. The pending migrations are applied in a transaction which is rolled
+    back, and a report is returned as a list of
+    (version, description, [(query, plan before, plan after)])."""
+    report = []
+    pending = list(_pending(conn, migrations))
+    _begin(conn)
+    try:
+        for version, migration in pending:
+            before = [query_plan(conn, query) for query in migration.queries]
+            _apply(conn, migration, version)
+            after = [query_plan(conn, query) for query in migration.queries]
+            report.append((version, migration.description,
+                           list(zip(migration.queries, before, after))))
+    finally:
+        conn.rollback()
+    return report
+
+
+def format_report(report):
+    if not report:
+        return 'No pending migrations.'
+    lines = []
+    for version, description, plans in report:
+        lines.append(f'Version {version}: {description}')
+        for query, before, after in plans:
+            lines.append(f'  {" ".join(query.split())}')
+            lines.append(f'    before: {"; ".join(before)}')
+            lines.append(f'    after:  {"; ".join(after)}')
+    return '\n'.join(lines)
+
+
+def main():
+    # Imported here, the connection modules import the rest of the bot.
+    from tle.util.db.cache_db_conn import CacheDbConn
+    from tle.util.db.user_db_conn import UserDbConn
+
+    parser = argparse.ArgumentParser(description='Show or apply pending schema migrations.')
+    parser.add_argument('kind', choices=['user', 'cache'])
+    parser.add_argument('dbfile')
+    parser.add_argument('--apply', action='store_true', help='apply the pending migrations')
+    args = parser.parse_args()
+    if not os.path.exists(args.dbfile):
+        parser.error(f'{args.dbfile} does not exist')
+
+    migrations = {'user': UserDbConn.MIGRATIONS, 'cache': CacheDbConn.MIGRATIONS}[args.kind]
+    conn = sqlite3.connect(args.dbfile)
+    print(f'Database is at version {get_version(conn)} of {len(migrations)}.')
+    print(format_report(explain(conn, migrations)))
+    if args.apply:
+        applied = upgrade(conn, migrations)
+        print(f'Applied {len(applied)} migrations.')
+
+
+if __name__ == '__main__':
+    main()
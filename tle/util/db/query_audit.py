@@ -0,0 +1,144 @@
+"""
+    Query plan audit for UserDbConn.
+
+    Collects the queries written in the methods of UserDbConn, creates a database with the
+    current schema filled with synthetic rows, and prints the plan of every query, flagging the
+    ones that scan a whole table, including through one of its indexes, which reads every entry
+    of the index. Queries that are built at runtime are listed as skipped.
+
+        python -m tle.util.db.query_audit [--rows N] [--scans-only]
+"""
+
+import argparse
+import ast
+import inspect
+import os
+import random
+import re
+import sqlite3
+import tempfile
+from collections import namedtuple
+
+from tle.util.db import migrations
+from tle.util.db.user_db_conn import UserDbConn
+
+AuditEntry = namedtuple('AuditEntry', 'method query plan full_scans error')
+
+_QUERY_START = re.compile(r'\s*(SELECT|UPDATE|DELETE)\b', re.IGNORECASE)
+_FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+
+
+def collect_queries(cls=UserDbConn):
+    """Returns (method name, query) for each query string in the methods of `cls`, in order.
+    f-strings are evaluated if they only refer to module level names such as enums. Queries that
+    cannot be evaluated have None as the query."""
+    source = inspect.getsource(cls)
+    class_def = ast.parse(source).body[0]
+    module_globals = vars(inspect.getmodule(cls))
+    queries = []
+    for method in class_def.body:
+        if not isinstance(method, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        # The literal parts of f-strings are Constants too, skip them.
+        fstring_parts = {id(part) for node in ast.walk(method)
+                         if isinstance(node, ast.JoinedStr) for part in node.values}
+        for node in ast.walk(method):
+            if id(node) in fstring_parts:
+                continue
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                query = node.value
+            elif isinstance(node, ast.JoinedStr):
+                try:
+                    query = eval(compile(ast.Expression(node), '<query>', 'eval'),
+                                 module_globals)
+                except NameError:
+                    queries.append((method.name, None))
+                    continue
+            else:
+                continue
+            if _QUERY_START.match(query):
+                queries.append((method.name, query))
+    return queries
+
+
+def _fill_table(conn, table, rows):
+    columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    names = ', '.join(f'"{column[1]}"' for column in columns)
+    placeholders = ', '.join('?' * len(columns))
+
+    def value(column_type, i):
+        # Unique where needed, with some repetition so that lookups are selective but not
+        # unique, as with guild ids or statuses.
+        if column_type.upper() in ('INTEGER', 'INT', 'REAL'):
+            return i if random.random() < 0.5 else random.randrange(max(1, rows // 100))
+        return f'v{i}'
+
+    values = [tuple(value(column[2], i) for column in columns) for i in range(rows)]
+    conn.executemany(f'INSERT OR IGNORE INTO "{table}" ({names}) VALUES ({placeholders})', values)
+
+
+def make_synthetic_db(path, rows):
+    """Creates a database with the current schema at `path`, with `rows` rows in every table."""
+    db = UserDbConn(path)
+    conn = db.conn
+    conn.row_factory = None
+    tables = [name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    with conn:
+        for table in tables:
+            _fill_table(conn, table, rows)
+    conn.execute('ANALYZE')
+    return conn
+
+
+def audit(conn, queries):
+    entries = []
+    for method, query in queries:
+        if query is None:
+            entries.append(AuditEntry(method, None, [], [], 'built at runtime, skipped'))
+            continue
+        try:
+            plan = migrations.query_plan(conn, query)
+        except sqlite3.Error as e:
+            entries.append(AuditEntry(method, query, [], [], repr(e)))
+            continue
+        full_scans = [f'{match[1]} (index {match[2]})' if match[2] else match[1]
+                      for line in plan for match in [_FULL_SCAN.match(line)] if match]
+        entries.append(AuditEntry(method, query, plan, full_scans, None))
+    return entries
+
+
+def format_entries(entries, scans_only=False):
+    lines = []
+    for entry in entries:
+        if scans_only and not entry.full_scans:
+            continue
+        flag = 'FULL SCAN ' + ', '.join(entry.full_scans) if entry.full_scans else 'ok'
+        if entry.error:
+            flag = entry.error
+        lines.append(f'{entry.method}: {flag}')
+        if entry.query:
+            lines.append(f'  {" ".join(entry.query.split())}')
+        lines += (f'    {line}' for line in entry.plan)
+    scanned = sum(1 for entry in entries if entry.full_scans)
+    lines.append(f'{len(entries)} queries, {scanned} with full table scans.')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audit query plans of UserDbConn.')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='synthetic rows per table (default 10000)')
+    parser.add_argument('--scans-only', action='store_true',
+                        help='only list queries with full table scans')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = make_synthetic_db(os.path.join(tmpdir, 'audit.db'), args.rows)
+        entries = audit(conn, collect_queries())
+        conn.close()
+    print(format_entries(entries, args.scans_only))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import sqlite3
 from enum import IntEnum
 from collections import namedtuple
@@ -7,6 +9,9 @@ from discord.ext import commands
 
 from tle.util import codeforces_api as cf
 from tle.util import codeforces_common as cf_common
+from tle.util.db import migrations
+from tle.util.db.db_worker import DbWorker, tune_connection
+from tle.util.db.migrations import Migration
 
 _DEFAULT_VC_RATING = 1500
 
@@ -77,12 +82,81 @@ def namedtuple_factory(cursor, row):
     return Row(*row)
 
 
+class _Rollback(Exception):
+    """Raised by an `_atomic` method to undo its writes and return `result`."""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+def _atomic(method):
+    """Runs the method in a transaction of its own, or a savepoint inside a batch, so that it
+    can undo its writes by raising `_Rollback` without undoing the rest of the batch."""
+    @functools.wraps(method)
+    def wrapped(self, *args, **kwargs):
+        try:
+            with self._transaction():
+                return method(self, *args, **kwargs)
+        except _Rollback as e:
+            return e.result
+    return wrapped
+
+
 class UserDbConn:
     def __init__(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
+        # Every method has its own queries, so keep more of them prepared than the default.
+        self.conn = tune_connection(sqlite3.connect(dbfile, cached_statements=512))
         self.conn.row_factory = namedtuple_factory
+        self.worker = DbWorker(dbfile, row_factory=namedtuple_factory)
+        self._batch_depth = 0
         self.create_tables()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Groups the writes made inside the block into a single transaction, committed when the
+        block exits or rolled back if it raises. The block must not await, or writes of other
+        coroutines would be made part of the transaction. A method that fails inside the block
+        undoes only its own writes."""
+        self._batch_depth += 1
+        try:
+            if self._batch_depth == 1:
+                with self.conn:
+                    # Begun explicitly, so that savepoints are nested in the transaction instead
+                    # of committing when released.
+                    if not self.conn.in_transaction:
+                        self.conn.execute('BEGIN')
+                    yield
+            else:
+                yield
+        finally:
+            self._batch_depth -= 1
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Makes the writes of the block atomic. Inside a batch, the writes of the block are
+        undone if it raises but the batch goes on."""
+        if not self._batch_depth:
+            with self.batch():
+                yield
+            return
+        self.conn.execute('SAVEPOINT method')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK TO method')
+            raise
+        finally:
+            self.conn.execute('RELEASE method')
+
+    def _commit(self):
+        if not self._batch_depth:
+            self.conn.commit()
+
+    async def fetchall(self, query, params=()):
+        """Runs a read query on the worker thread."""
+        return await self.worker.fetchall(query, params)
+
     def create_tables(self):
         self.conn.execute(
             'CREATE TABLE IF NOT EXISTS user_handle ('
@@ -342,6 +416,74 @@ class UserDbConn:
                 "end_time" INT
             )
             ''')
+        migrations.upgrade(self.conn, self.MIGRATIONS)
+
+    MIGRATIONS = [
+        Migration(
+            'Index handles for case-insensitive lookups',
+            ['CREATE INDEX IF NOT EXISTS ix_cf_user_cache_handle_nocase '
+             'ON cf_user_cache (handle COLLATE NOCASE)',
+             'CREATE INDEX IF NOT EXISTS ix_user_handle_guild_handle_nocase '
+             'ON user_handle (guild_id, handle COLLATE NOCASE)'],
+            ['SELECT handle FROM cf_user_cache WHERE handle = ? COLLATE NOCASE',
+             'SELECT user_id FROM user_handle WHERE handle = ? COLLATE NOCASE AND guild_id = ?']),
+        Migration(
+            'Index challenges, duels, lockout rounds and trainings by their lookup columns',
+            ['CREATE INDEX IF NOT EXISTS ix_challenge_user_status ON challenge (user_id, status)',
+             'CREATE INDEX IF NOT EXISTS ix_duel_challenger ON duel (challenger, guild_id, status)',
+             'CREATE INDEX IF NOT EXISTS ix_duel_challengee ON duel (challengee, guild_id, status)',
+             'CREATE INDEX IF NOT EXISTS ix_duel_guild_status ON duel (guild_id, status, start_time)',
+             'CREATE INDEX IF NOT EXISTS ix_duelist_guild_rating ON duelist (guild_id, rating)',
+             'CREATE INDEX IF NOT EXISTS ix_lockout_ongoing_rounds_guild '
+             'ON lockout_ongoing_rounds (guild)',
+             'CREATE INDEX IF NOT EXISTS ix_lockout_finished_rounds_guild_end_time '
+             'ON lockout_finished_rounds (guild, end_time)',
+             'CREATE INDEX IF NOT EXISTS ix_hard75_challenge_user_id ON hard75_challenge (user_id)',
+             'CREATE INDEX IF NOT EXISTS ix_trainings_user_status ON trainings (user_id, status)',
+             'CREATE INDEX IF NOT EXISTS ix_training_problems_training_status '
+             'ON training_problems (training_id, status)'],
+            [f'SELECT id FROM duel WHERE (challengee = ? OR challenger = ?) AND guild_id = ? '
+             f'AND (status == {Duel.ONGOING} OR status == {Duel.PENDING})',
+             f'SELECT id, challenger, challengee, start_time FROM duel '
+             f'WHERE status == {Duel.ONGOING} AND guild_id = ? ORDER BY start_time DESC',
+             'SELECT * FROM lockout_ongoing_rounds WHERE guild = ?',
+             'SELECT * FROM lockout_finished_rounds WHERE guild = ? AND users LIKE ? '
+             'ORDER BY end_time DESC']),
+        Migration(
+            'Drop the challenge finish time index, gitgud leaderboards are read from the scores',
+            ['DROP INDEX IF EXISTS ix_challenge_finish_time']),
+        # The scores are those of _calculateGitgudMonthlyScore in tle/cogs/codeforces.py, with
+        # months in local time as there.
+        Migration(
+            'Keep gitgud scores per month, starting from those of the completed challenges',
+            ['''CREATE TABLE IF NOT EXISTS gitgud_monthly_score (
+                    "user_id"	TEXT,
+                    "month_start"	INTEGER,
+                    "score"	INTEGER NOT NULL,
+                    PRIMARY KEY ("month_start", "user_id")
+                )''',
+             f'''INSERT INTO gitgud_monthly_score (user_id, month_start, score)
+                 SELECT user_id, month_start, SUM(
+                     CASE WHEN rating_delta <= -400 THEN 1
+                          WHEN rating_delta >= 300 THEN 23
+                          ELSE CASE (rating_delta + 400) / 100
+                              WHEN 0 THEN 1 WHEN 1 THEN 2 WHEN 2 THEN 3 WHEN 3 THEN 5
+                              WHEN 4 THEN 8 WHEN 5 THEN 12 ELSE 17 END
+                     END
+                     * CASE WHEN month_start >= 1680300000
+                                 AND issue_time >= month_end - 7 * 24 * 60 * 60 THEN 2
+                            ELSE 1 END)
+                 FROM (SELECT user_id, rating_delta, issue_time,
+                              CAST(strftime('%s', finish_time, 'unixepoch', 'localtime',
+                                            'start of month', 'utc') AS INTEGER) AS month_start,
+                              CAST(strftime('%s', finish_time, 'unixepoch', 'localtime',
+                                            'start of month', '+1 month', 'utc') AS INTEGER)
+                                  AS month_end
+                       FROM challenge
+                       WHERE status = {Gitgud.GOTGUD} AND finish_time IS NOT NULL)
+                 WHERE NOT EXISTS (SELECT 1 FROM gitgud_monthly_score)
+                 GROUP BY user_id, month_start''']),
+    ]
 
     # Helper functions.
 
@@ -351,7 +493,7 @@ class UserDbConn:
             INSERT OR REPLACE INTO {} ({}) VALUES ({})
         '''.format(table, ', '.join(columns), ', '.join(['?'] * n))
         rc = self.conn.execute(query, values).rowcount
-        self.conn.commit()
+        self._commit()
         return rc
 
     def _insert_many(self, table: str, columns, values: list):
@@ -360,7 +502,7 @@ class UserDbConn:
             INSERT OR REPLACE INTO {} ({}) VALUES ({})
         '''.format(table, ', '.join(columns), ', '.join(['?'] * n))
         rc = self.conn.executemany(query, values).rowcount
-        self.conn.commit()
+        self._commit()
         return rc
 
     def _fetchone(self, query: str, params=None, row_factory=None):
@@ -413,6 +555,7 @@ class UserDbConn:
             return False
         return True
     
+    @_atomic
     def updateStreak_Hard75Challenge(self, user_id, current_streak, longest_streak, date):
         cur = self.conn.cursor()
         query1='''
@@ -423,9 +566,7 @@ class UserDbConn:
         #last updated is set to 0 because it's logic wouldn't interfere this way 
         #the entire point of using last updated is that a user shouln't be able to get multiple points for the same day. 
         if cur.rowcount!=1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return 1
 
     def get_Hard75Challenge(self, user_id, date):
@@ -436,6 +577,7 @@ class UserDbConn:
         #the execution assumes that it has been validated that the presence of this row was confirmed! 
         return self.conn.execute(query1, (user_id,date)).fetchone()
     
+    @_atomic
     def new_Hard75Challenge(self,user_id,handle,p1_id,c1_id,p1_name,p2_id,c2_id,p2_name,rating,date):   
         #check for existing record, if exists-> change accordingly else add new row
         query1 = '''
@@ -454,9 +596,7 @@ class UserDbConn:
             cur.execute(query2,(p1_id,c1_id,p1_name,p2_id,c2_id,p2_name,date,user_id))
             #the entire point of using last updated is that a user shouln't be able to get multiple points for the same day. 
             if cur.rowcount!=1:
-                self.conn.rollback()
-                return 0
-            self.conn.commit()
+                raise _Rollback(0)
             return 1
         query3='''
             INSERT INTO hard75_challenge
@@ -466,9 +606,7 @@ class UserDbConn:
         '''
         cur.execute(query3,(user_id,handle,0,0,c1_id,p1_id,p1_name,c2_id,p2_id,p2_name,date,0,rating,date))
         if cur.rowcount!=1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return 1
     
     def get_hard75_status(self,user_id):
@@ -488,6 +626,7 @@ class UserDbConn:
         
 
 
+    @_atomic
     def new_challenge(self, user_id, issue_time, prob, delta):
         query1 = '''
             INSERT INTO challenge
@@ -507,14 +646,11 @@ class UserDbConn:
         cur.execute(query1, (user_id, issue_time, prob.name, prob.contestId, prob.index, delta))
         last_id, rc = cur.lastrowid, cur.rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
+            raise _Rollback(0)
         cur.execute(query2, (user_id,))
         cur.execute(query3, (last_id, issue_time, user_id))
         if cur.rowcount != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return 1
 
     def check_challenge(self, user_id):
@@ -533,23 +669,34 @@ class UserDbConn:
         if res is None: return None
         return c_id, issue_time, res[0], res[1], res[2], res[3]
 
-    def get_gudgitters_last(self, timestamp):
+    async def get_gudgitters_for_guild(self, guild_id, rating_lo=None, rating_hi=None):
+        """All-time gitgud leaderboard of the guild as (user_id, handle, rating, score), best
+        first. Only users with a cached CF user and a positive score are included, and if a rating
+        range is given only those with a cached rating in it."""
         query = '''
-            SELECT user_id, rating_delta FROM challenge WHERE finish_time >= ? ORDER BY user_id
-        '''
-        return self.conn.execute(query, (timestamp,)).fetchall()
-
-    def get_gudgitters_timerange(self, timestampStart, timestampEnd):
-        query = '''
-            SELECT user_id, rating_delta, issue_time FROM challenge WHERE finish_time >= ? AND finish_time <= ? ORDER BY user_id
-        '''
-        return self.conn.execute(query, (timestampStart,timestampEnd)).fetchall()
-
-    def get_gudgitters(self):
+            SELECT uc.user_id, uh.handle, cu.rating, uc.score FROM user_challenge uc
+            JOIN user_handle uh ON uh.user_id = uc.user_id AND uh.guild_id = ?
+            JOIN cf_user_cache cu ON cu.handle = uh.handle COLLATE NOCASE
+            WHERE uc.score > 0
+        '''
+        params = [guild_id]
+        if rating_lo is not None:
+            query += ' AND cu.rating BETWEEN ? AND ?'
+            params += [rating_lo, rating_hi]
+        query += ' ORDER BY uc.score DESC'
+        return await self.fetchall(query, params)
+
+    async def get_monthly_gudgitters_for_guild(self, guild_id, month_start):
+        """Gitgud leaderboard of the guild for the month starting at `month_start`, in the same
+        form as `get_gudgitters_for_guild`."""
         query = '''
-            SELECT user_id, score FROM user_challenge
+            SELECT ms.user_id, uh.handle, cu.rating, ms.score FROM gitgud_monthly_score ms
+            JOIN user_handle uh ON uh.user_id = ms.user_id AND uh.guild_id = ?
+            JOIN cf_user_cache cu ON cu.handle = uh.handle COLLATE NOCASE
+            WHERE ms.month_start = ? AND ms.score > 0
+            ORDER BY ms.score DESC
         '''
-        return self.conn.execute(query).fetchall()
+        return await self.fetchall(query, (guild_id, month_start))
 
     def howgud(self, user_id):
         query = '''
@@ -570,7 +717,11 @@ class UserDbConn:
         '''
         return self.conn.execute(query, (user_id,)).fetchall()
 
-    def complete_challenge(self, user_id, challenge_id, finish_time, delta):
+    @_atomic
+    def complete_challenge(self, user_id, challenge_id, finish_time, delta,
+                           month_start, monthly_delta):
+        """Marks the challenge complete, adding `delta` to the all-time score and
+        `monthly_delta` to the score of the month starting at `month_start`."""
         query1 = f'''
             UPDATE challenge SET finish_time = ?, status = {Gitgud.GOTGUD}
             WHERE id = ? AND status = {Gitgud.GITGUD}
@@ -580,17 +731,20 @@ class UserDbConn:
             active_challenge_id = NULL, issue_time = NULL
             WHERE user_id = ? AND active_challenge_id = ?
         '''
+        query3 = '''
+            INSERT INTO gitgud_monthly_score (user_id, month_start, score) VALUES (?, ?, ?)
+            ON CONFLICT (month_start, user_id) DO UPDATE SET score = score + excluded.score
+        '''
         rc = self.conn.execute(query1, (finish_time, challenge_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
+            raise _Rollback(0)
         rc = self.conn.execute(query2, (delta, user_id, challenge_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
+        self.conn.execute(query3, (user_id, month_start, monthly_delta))
         return 1
 
+    @_atomic
     def skip_challenge(self, user_id, challenge_id, status):
         query1 = '''
             UPDATE user_challenge SET active_challenge_id = NULL, issue_time = NULL
@@ -601,13 +755,10 @@ class UserDbConn:
         '''
         rc = self.conn.execute(query1, (user_id, challenge_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
+            raise _Rollback(0)
         rc = self.conn.execute(query2, (status, challenge_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return 1
 
     def cache_cf_user(self, user):
@@ -615,14 +766,22 @@ class UserDbConn:
                  '(handle, first_name, last_name, country, city, organization, contribution, '
                  '    rating, maxRating, last_online_time, registration_time, friend_of_count, title_photo) '
                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, user).rowcount
 
+    def cache_cf_users(self, users):
+        query = ('INSERT OR REPLACE INTO cf_user_cache '
+                 '(handle, first_name, last_name, country, city, organization, contribution, '
+                 '    rating, maxRating, last_online_time, registration_time, friend_of_count, title_photo) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        with self._transaction():
+            return self.conn.executemany(query, users).rowcount
+
     def fetch_cf_user(self, handle):
         query = ('SELECT handle, first_name, last_name, country, city, organization, contribution, '
                  '    rating, maxRating, last_online_time, registration_time, friend_of_count, title_photo '
                  'FROM cf_user_cache '
-                 'WHERE UPPER(handle) = UPPER(?)')
+                 'WHERE handle = ? COLLATE NOCASE')
         user = self.conn.execute(query, (handle,)).fetchone()
         return cf_common.fix_urls(cf.User._make(user)) if user else None
 
@@ -637,14 +796,14 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO user_handle '
                  '(user_id, guild_id, handle, active) '
                  'VALUES (?, ?, ?, 1)')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (user_id, guild_id, handle)).rowcount
 
     def set_inactive(self, guild_id_user_id_pairs):
         query = ('UPDATE user_handle '
                  'SET active = 0 '
                  'WHERE guild_id = ? AND user_id = ?')
-        with self.conn:
+        with self._transaction():
             return self.conn.executemany(query, guild_id_user_id_pairs).rowcount
 
     def get_handle(self, user_id, guild_id):
@@ -657,14 +816,14 @@ class UserDbConn:
     def get_user_id(self, handle, guild_id):
         query = ('SELECT user_id '
                  'FROM user_handle '
-                 'WHERE UPPER(handle) = UPPER(?) AND guild_id = ?')
+                 'WHERE handle = ? COLLATE NOCASE AND guild_id = ?')
         res = self.conn.execute(query, (handle, guild_id)).fetchone()
         return int(res[0]) if res else None
 
     def remove_handle(self, handle, guild_id):
         query = ('DELETE FROM user_handle '
-                 'WHERE UPPER(handle) = UPPER(?) AND guild_id = ?')
-        with self.conn:
+                 'WHERE handle = ? COLLATE NOCASE AND guild_id = ?')
+        with self._transaction():
             return self.conn.execute(query, (handle, guild_id)).rowcount
 
     def get_handles_for_guild(self, guild_id):
@@ -674,6 +833,13 @@ class UserDbConn:
         res = self.conn.execute(query, (guild_id,)).fetchall()
         return [(int(user_id), handle) for user_id, handle in res]
 
+    def get_active_handles(self):
+        """Returns the handles of active users of all guilds."""
+        query = ('SELECT DISTINCT handle '
+                 'FROM user_handle '
+                 'WHERE active = 1')
+        return [handle for handle, in self.conn.execute(query).fetchall()]
+
     def get_cf_users_for_guild(self, guild_id):
         query = ('SELECT u.user_id, c.handle, c.first_name, c.last_name, c.country, c.city, '
                  '    c.organization, c.contribution, c.rating, c.maxRating, c.last_online_time, '
@@ -699,12 +865,12 @@ class UserDbConn:
             VALUES (?, ?, ?, ?)
         '''
         self.conn.execute(query, (guild_id, channel_id, role_id, before))
-        self.conn.commit()
+        self._commit()
 
     def clear_reminder_settings(self, guild_id):
         query = '''DELETE FROM reminder WHERE guild_id = ?'''
         self.conn.execute(query, (guild_id,))
-        self.conn.commit()
+        self._commit()
 
     def get_starboard(self, guild_id):
         query = ('SELECT channel_id '
@@ -717,20 +883,20 @@ class UserDbConn:
                  '(guild_id, channel_id) '
                  'VALUES (?, ?)')
         self.conn.execute(query, (guild_id, channel_id))
-        self.conn.commit()
+        self._commit()
 
     def clear_starboard(self, guild_id):
         query = ('DELETE FROM starboard '
                  'WHERE guild_id = ?')
         self.conn.execute(query, (guild_id,))
-        self.conn.commit()
+        self._commit()
 
     def add_starboard_message(self, original_msg_id, starboard_msg_id, guild_id):
         query = ('INSERT INTO starboard_message '
                  '(original_msg_id, starboard_msg_id, guild_id) '
                  'VALUES (?, ?, ?)')
         self.conn.execute(query, (original_msg_id, starboard_msg_id, guild_id))
-        self.conn.commit()
+        self._commit()
 
     def check_exists_starboard_message(self, original_msg_id):
         query = ('SELECT 1 '
@@ -749,21 +915,21 @@ class UserDbConn:
             query = ('DELETE FROM starboard_message '
                      'WHERE starboard_msg_id = ?')
             rc = self.conn.execute(query, (starboard_msg_id,)).rowcount
-        self.conn.commit()
+        self._commit()
         return rc
 
     def clear_starboard_messages_for_guild(self, guild_id):
         query = ('DELETE FROM starboard_message '
                  'WHERE guild_id = ?')
         rc = self.conn.execute(query, (guild_id,)).rowcount
-        self.conn.commit()
+        self._commit()
         return rc
     
     def set_ai_channel(self, guild_id, channel_id):
         query = ('INSERT OR REPLACE INTO ai_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_ai_channel(self, guild_id):
@@ -777,7 +943,7 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO ref_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_ref_channel(self, guild_id):
@@ -791,7 +957,7 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO duel_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_duel_channel(self, guild_id):
@@ -856,31 +1022,30 @@ class UserDbConn:
             INSERT INTO duel (challenger, challengee, issue_time, problem_name, contest_id, p_index, status, type, guild_id) VALUES (?, ?, ?, ?, ?, ?, {Duel.PENDING}, ?, ?)
         '''
         duelid = self.conn.execute(query, (challenger, challengee, issue_time, prob.name, prob.contestId, prob.index, dtype, guild_id)).lastrowid
-        self.conn.commit()
+        self._commit()
         return duelid
 
+    @_atomic
     def cancel_duel(self, duelid, guild_id, status):
         query = f'''
             UPDATE duel SET status = ? WHERE id = ? AND guild_id = ? AND status = {Duel.PENDING}
         '''
         rc = self.conn.execute(query, (status, duelid, guild_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return rc
 
+    @_atomic
     def invalidate_duel(self, duelid, guild_id):
         query = f'''
             UPDATE duel SET status = {Duel.INVALID} WHERE id = ? AND guild_id = ? AND status = {Duel.ONGOING}
         '''
         rc = self.conn.execute(query, (duelid,guild_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return rc
 
+    @_atomic
     def start_duel(self, duelid, guild_id, start_time):
         query = f'''
             UPDATE duel SET start_time = ?, status = {Duel.ONGOING}
@@ -888,25 +1053,22 @@ class UserDbConn:
         '''
         rc = self.conn.execute(query, (start_time, duelid, guild_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return rc
 
+    @_atomic
     def complete_duel(self, duelid, guild_id, winner, finish_time, winner_id = -1, loser_id = -1, delta = 0, dtype = DuelType.OFFICIAL):
         query = f'''
             UPDATE duel SET status = {Duel.COMPLETE}, finish_time = ?, winner = ? WHERE id = ? AND guild_id = ? AND status = {Duel.ONGOING}
         '''
         rc = self.conn.execute(query, (finish_time, winner, duelid, guild_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
+            raise _Rollback(0)
 
         if dtype == DuelType.OFFICIAL or dtype == DuelType.ADJOFFICIAL:
             self.update_duel_rating(winner_id, guild_id, +delta)
             self.update_duel_rating(loser_id, guild_id, -delta)
 
-        self.conn.commit()
         return 1
 
     def update_duel_rating(self, userid, guild_id, delta):
@@ -914,7 +1076,7 @@ class UserDbConn:
             UPDATE duelist SET rating = rating + ? WHERE user_id = ? AND guild_id = ?
         '''
         rc = self.conn.execute(query, (delta, userid, guild_id)).rowcount
-        self.conn.commit()
+        self._commit()
         return rc
 
     def get_duel_wins(self, userid, guild_id):
@@ -1004,7 +1166,7 @@ class UserDbConn:
             INSERT OR IGNORE INTO duelist (user_id, rating, guild_id)
             VALUES (?, 1500, ?)
         '''
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (userid,guild_id)).rowcount
 
     def get_duelists(self, guild_id):
@@ -1031,26 +1193,26 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO rankup '
                  '(guild_id, channel_id) '
                  'VALUES (?, ?)')
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def clear_rankup_channel(self, guild_id):
         query = ('DELETE FROM rankup '
                  'WHERE guild_id = ?')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (guild_id,)).rowcount
 
     def enable_auto_role_update(self, guild_id):
         query = ('INSERT OR REPLACE INTO auto_role_update '
                  '(guild_id) '
                  'VALUES (?)')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (guild_id,)).rowcount
 
     def disable_auto_role_update(self, guild_id):
         query = ('DELETE FROM auto_role_update '
                  'WHERE guild_id = ?')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (guild_id,)).rowcount
 
     def has_auto_role_update_enabled(self, guild_id):
@@ -1066,7 +1228,7 @@ class UserDbConn:
             WHERE guild_id = ?
         '''
         self.conn.execute(inactive_query, (id,))
-        self.conn.commit()
+        self._commit()
 
     def update_status(self, guild_id: str, active_ids: list):
         placeholders = ', '.join(['?'] * len(active_ids))
@@ -1077,9 +1239,8 @@ class UserDbConn:
             WHERE user_id IN ({})
             AND guild_id = ?
         '''.format(placeholders)
-        rc = self.conn.execute(active_query, (*active_ids, guild_id)).rowcount
-        self.conn.commit()
-        return rc
+        with self._transaction():
+            return self.conn.execute(active_query, (*active_ids, guild_id)).rowcount
 
     # Rated VC stuff
 
@@ -1090,7 +1251,7 @@ class UserDbConn:
                  '(contest_id, start_time, finish_time, status, guild_id) '
                  'VALUES ( ?, ?, ?, ?, ?)')
         id = None
-        with self.conn:
+        with self._transaction():
             id = self.conn.execute(query, (contest_id, start_time, finish_time, RatedVC.ONGOING, guild_id)).lastrowid
             for user_id in user_ids:
                 query = ('INSERT INTO rated_vc_users '
@@ -1129,7 +1290,7 @@ class UserDbConn:
                 'SET status = ? '
                 'WHERE id = ? ')
 
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (RatedVC.FINISHED, vc_id))
 
     def update_vc_rating(self, vc_id: int, user_id: str, rating: int):
@@ -1137,7 +1298,7 @@ class UserDbConn:
                  '(vc_id, user_id, rating) '
                  'VALUES (?, ?, ?) ')
 
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (vc_id, user_id, rating))
 
     def get_vc_rating(self, user_id: str, default_if_not_exist: bool = True):
@@ -1166,7 +1327,7 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO rated_vc_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_rated_vc_channel(self, guild_id):
@@ -1184,14 +1345,14 @@ class UserDbConn:
         vc_id = self._fetchone(query, params=(user_id, ), row_factory=namedtuple_factory).vc_id
         query = ('DELETE FROM rated_vc_users '
                  'WHERE user_id = ? AND vc_id = ? ')
-        with self.conn:
+        with self._transaction():
             return self.conn.execute(query, (user_id, vc_id)).rowcount
 
     def set_training_channel(self, guild_id, channel_id):
         query = ('INSERT OR REPLACE INTO training_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_training_channel(self, guild_id):
@@ -1201,6 +1362,7 @@ class UserDbConn:
         channel_id = self.conn.execute(query, (guild_id,)).fetchone()
         return int(channel_id[0]) if channel_id else None
 
+    @_atomic
     def new_training(self, user_id, issue_time, prob, mode, score, lives, time_left):
         query1 = f'''
             INSERT INTO trainings
@@ -1216,13 +1378,10 @@ class UserDbConn:
         cur.execute(query1, (user_id, lives, time_left, mode))
         training_id, rc = cur.lastrowid, cur.rowcount
         if rc != 1:
-            self.conn.rollback()
-            return 0
+            raise _Rollback(0)
         cur.execute(query2, (training_id, issue_time, prob.name, prob.contestId, prob.index, prob.rating))
         if cur.rowcount != 1:
-            self.conn.rollback()
-            return 0
-        self.conn.commit()
+            raise _Rollback(0)
         return 1
 
 
@@ -1242,6 +1401,13 @@ class UserDbConn:
         if res is None: return None
         return training_id, res[0], res[1], res[2], res[3], res[4], mode, score, lives,time_left
 
+    def get_active_training_user_ids(self):
+        query = f'''
+            SELECT user_id FROM trainings
+            WHERE status = {Training.ACTIVE}
+        '''
+        return [user_id for user_id, in self.conn.execute(query).fetchall()]
+
     def get_latest_training(self, user_id):
         query1 = f'''
             SELECT id, mode, score, lives, time_left FROM trainings
@@ -1253,6 +1419,7 @@ class UserDbConn:
         return training_id, None, None, None, None, None, mode, score, lives,time_left
 
 
+    @_atomic
     def end_current_training_problem(self, training_id, finish_time, status, score, lives, time_left):
         query1 = f'''
             UPDATE training_problems SET finish_time = ?, status = ?
@@ -1264,15 +1431,13 @@ class UserDbConn:
         '''
         rc = self.conn.execute(query1, (finish_time, status, training_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return -1
+            raise _Rollback(-1)
         rc = self.conn.execute(query2, (score, lives, time_left, training_id)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return -2
-        self.conn.commit()
+            raise _Rollback(-2)
         return 1
 
+    @_atomic
     def assign_training_problem(self, training_id, issue_time, prob):
         query1 = f'''
             INSERT INTO training_problems (training_id, issue_time, problem_name, contest_id, p_index, rating, status)
@@ -1282,11 +1447,10 @@ class UserDbConn:
         cur = self.conn.cursor()
         cur.execute(query1, (training_id, issue_time, prob.name, prob.contestId, prob.index, prob.rating))
         if cur.rowcount != 1:
-            self.conn.rollback()
-            return -1
-        self.conn.commit()
+            raise _Rollback(-1)
         return 1
 
+    @_atomic
     def finish_training(self, training_id):
         query1 = f'''
             UPDATE trainings SET status = {Training.COMPLETED}
@@ -1294,9 +1458,7 @@ class UserDbConn:
         '''
         rc = self.conn.execute(query1, (training_id,)).rowcount
         if rc != 1:
-            self.conn.rollback()
-            return -1
-        self.conn.commit()
+            raise _Rollback(-1)
         return 1
 
     def get_training_skips(self, user_id):
@@ -1362,7 +1524,7 @@ class UserDbConn:
         query = ('INSERT OR REPLACE INTO round_settings '
                  ' (guild_id, channel_id) VALUES (?, ?)'
                  )
-        with self.conn:
+        with self._transaction():
             self.conn.execute(query, (guild_id, channel_id))
 
     def get_round_channel(self, guild_id):
@@ -1388,7 +1550,7 @@ class UserDbConn:
                                       repeat, 
                                       ' '.join(['0'] * len(users)))
                     )
-        self.conn.commit()
+        self._commit()
         cur.close()
 
     def create_finished_round(self, round_info, timestamp):
@@ -1400,7 +1562,7 @@ class UserDbConn:
         cur.execute(query, (round_info.guild, round_info.users, round_info.rating, round_info.points, round_info.time,
                                 round_info.problems, round_info.status, round_info.duration, round_info.repeat,
                                 round_info.times, timestamp))
-        self.conn.commit()
+        self._commit()
         cur.close()                
 
     def update_round_status(self, guild, user, status, problems, timestamp):
@@ -1417,7 +1579,7 @@ class UserDbConn:
         cur.execute(query,
                      (' '.join([str(x) for x in status]), ' '.join(problems), ' '.join([str(x) for x in timestamp]),
                       guild, f"%{user}%"))
-        self.conn.commit()
+        self._commit()
         cur.close()
 
     def get_round_info(self, guild_id, users):
@@ -1455,7 +1617,7 @@ class UserDbConn:
                 '''
         cur = self.conn.cursor()
         cur.execute(query, (guild, f"%{user}%"))
-        self.conn.commit()
+        self._commit()
         cur.close()    
 
     def get_ongoing_rounds(self, guild):
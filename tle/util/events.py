@@ -22,6 +22,14 @@ class RatingChangesUpdate(Event):
         self.rating_changes = rating_changes
 
 
+class SubmissionVerdict(Event):
+    """New verdicts of a watched handle, see SubmissionWatcher. `submissions` are the ones which
+    were judged or whose verdict changed since the handle was last polled, newest first."""
+    def __init__(self, *, handle, submissions):
+        self.handle = handle
+        self.submissions = submissions
+
+
 # Event errors
 
 class EventError(commands.CommandError):
@@ -0,0 +1,52 @@
+"""
+    Executors to run blocking work away from the event loop. CPU-bound work runs in a pool of
+    worker processes, and matplotlib rendering on a single dedicated thread since pyplot is not
+    thread-safe.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+_CPU_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+_process_pool = None
+_plot_thread = None
+
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # Spawn rather than fork, the bot process has threads and an event loop running.
+        context = multiprocessing.get_context('spawn')
+        _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=_CPU_WORKERS,
+                                                               mp_context=context)
+        logger.info(f'Started process pool with {_CPU_WORKERS} workers.')
+    return _process_pool
+
+
+def _get_plot_thread():
+    global _plot_thread
+    if _plot_thread is None:
+        _plot_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                             thread_name_prefix='plot')
+    return _plot_thread
+
+
+async def run_cpu_bound(func, *args, **kwargs):
+    """Runs `func` in a worker process. `func` and its arguments must be picklable."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_process_pool(),
+                                      functools.partial(func, *args, **kwargs))
+
+
+async def run_plot(func, *args, **kwargs):
+    """Runs `func` on the plotting thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_plot_thread(),
+                                      functools.partial(func, *args, **kwargs))
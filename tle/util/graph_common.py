@@ -1,15 +1,16 @@
-import os
 import io
-import discord
 import time
+import discord
 import matplotlib.font_manager
 import matplotlib
 matplotlib.use('agg') # Explicitly set the backend to avoid issues
 
 from tle import constants
+from tle.util import executors
 from matplotlib import pyplot as plt
 from matplotlib import rcParams
 from cycler import cycler
+from collections import namedtuple, OrderedDict
 
 rating_color_cycler = cycler('color', ['#5d4dff',
                                        '#009ccc',
@@ -31,15 +32,74 @@ class StrWrap:
     def __str__(self):
         return self.string
 
-def get_current_figure_as_file():
-    filename = os.path.join(constants.TEMP_DIR, f'tempplot_{time.time()}.png')
-    plt.savefig(filename, facecolor=plt.gca().get_facecolor(), bbox_inches='tight', pad_inches=0.25)
+PlotPreset = namedtuple('PlotPreset', 'dpi compress_level')
+
+# Render settings for plots. The compression level is that of zlib for the PNG, lower is faster
+# but gives larger files. Large plots have the most pixels to compress, so they take the
+# fastest level.
+PLOT_PRESETS = {
+    'default': PlotPreset(dpi='figure', compress_level=3),
+    'large': PlotPreset(dpi='figure', compress_level=1),
+}
+
+def _render_figure(fig, facecolor, preset):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=preset.dpi, facecolor=facecolor, bbox_inches='tight',
+                pad_inches=0.25, pil_kwargs={'compress_level': preset.compress_level})
+    buffer.seek(0)
+    return buffer
+
+async def get_current_figure_as_file(preset='default', cache_key=None):
+    """Renders the current figure on the plotting thread with the named preset. The figure is
+    closed in pyplot first, so other commands get a fresh figure to draw on meanwhile. If
+    `cache_key` is given, the rendered plot is saved in `plot_cache` under it."""
+    fig = plt.gcf()
+    facecolor = fig.gca().get_facecolor()
+    plt.close(fig)
+    buffer = await executors.run_plot(_render_figure, fig, facecolor, PLOT_PRESETS[preset])
+    if cache_key is not None:
+        plot_cache.put(cache_key, buffer.getvalue())
+    return discord.File(buffer, filename='plot.png')
+
+class PlotCache:
+    """An LRU cache of rendered plots, bounded by the total size of the images. A key must
+    contain everything the plot depends on, including the version stamps of cached data used,
+    so that entries stop being hit once the data is reloaded. Entries also expire after `ttl`
+    seconds for data that is not versioned."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        """Returns the plot as a discord.File, or None if not cached."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        created, data = entry
+        if time.time() - created > self.ttl:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return discord.File(io.BytesIO(data), filename='plot.png')
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time(), data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
 
-    with open(filename, 'rb') as file:
-        discord_file = discord.File(io.BytesIO(file.read()), filename='plot.png')
+    def _remove(self, key):
+        _, data = self.entries.pop(key)
+        self.size -= len(data)
 
-    os.remove(filename)
-    return discord_file
+plot_cache = PlotCache(max_bytes=32 * 1024 * 1024, ttl=60 * 60)
 
 def plot_rating_bg(ranks):
     ymin, ymax = plt.gca().get_ylim()
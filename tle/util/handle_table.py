@@ -0,0 +1,53 @@
+"""
+    Symbol table of Codeforces handles.
+
+    Handles are case insensitive, so a handle is keyed by its lowercased form, as HandleDict and
+    the COLLATE NOCASE columns do. Each key gets an integer id in order of first appearance, and
+    the spelling it was first seen with is kept as its canonical spelling. Ids index the columns
+    of the rating store and the per-handle arrays of the rating changes cache.
+"""
+
+import sys
+
+
+def _key(handle):
+    return handle.lower()
+
+
+def intern(handle):
+    """Returns the shared copy of the handle string, so that the same handle parsed from
+    different API responses takes memory once."""
+    return sys.intern(handle) if type(handle) == str else handle
+
+
+class HandleTable:
+    def __init__(self, handles=()):
+        self._handles = []
+        self._id_by_key = {}
+        for handle in handles:
+            self.add(handle)
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, handle):
+        return _key(handle) in self._id_by_key
+
+    def __iter__(self):
+        return iter(self._handles)
+
+    def add(self, handle):
+        """Returns the id of the handle, giving it a new id if it has none."""
+        key = _key(handle)
+        id_ = self._id_by_key.get(key)
+        if id_ is None:
+            id_ = self._id_by_key[key] = len(self._handles)
+            self._handles.append(intern(handle))
+        return id_
+
+    def get(self, handle, default=None):
+        """Returns the id of the handle, or `default` if it has none."""
+        return self._id_by_key.get(_key(handle), default)
+
+    def canonical(self, id_):
+        return self._handles[id_]
@@ -19,6 +19,12 @@ class HandleDict:
     def __getitem__(self, key):
         return self._store[self._getlower(key)][1]
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     # get correct handle irrespective of the input case of the handle (if the handle is present)
     def get_correct_handle(self, key):
         try:
@@ -1,6 +1,7 @@
 from discord.ext import commands
 
-from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator
+from tle.util import executors
+from tle.util.ranklist.rating_calculator import predict_deltas
 from tle.util.handledict import HandleDict
 from tle.util.codeforces_api import make_from_dict, RanklistRow
 
@@ -37,6 +38,8 @@ class Ranklist:
         self.is_rated = is_rated
         self.delta_by_handle = None
         self.deltas_status = None
+        # The input of the last prediction, to tell whether it has to be made again.
+        self.prediction_standings = None
         self.standing_by_id = None
         self._create_inverse_standings()
 
@@ -46,6 +49,24 @@ class Ranklist:
             id_ = self.get_ranklist_lookup_key(row)
             self.standing_by_id[id_] = row
 
+    def update_standings(self, rows, fetch_time):
+        """Replaces the rows of the contestants present in `rows` and keeps all other rows, as
+        when only the rows of some handles were fetched. Returns whether any row changed."""
+        row_by_id = {self.get_ranklist_lookup_key(row): row for row in rows}
+        changed = {id_: row for id_, row in row_by_id.items()
+                   if self.standing_by_id.get(id_) != row}
+        self.fetch_time = fetch_time
+        if not changed:
+            return False
+        standings = [changed.pop(self.get_ranklist_lookup_key(row), row)
+                     for row in self.standings]
+        standings += changed.values()  # Contestants not seen before.
+        standings.sort(key=lambda row: row.rank)
+        self.standings = standings
+        for id_, row in row_by_id.items():
+            self.standing_by_id[id_] = row
+        return True
+
     def remove_unofficial_contestants(self):
         """
         To be used for cases when official ranklist contains unofficial contestants
@@ -79,14 +100,25 @@ class Ranklist:
         self.delta_by_handle = delta_by_handle.copy()
         self.deltas_status = 'Final'
 
-    def predict(self, current_rating):
+    def _get_prediction_standings(self, current_rating):
         if not self.is_rated:
             raise ContestNotRatedError(self.contest)
-        standings = [(id_, row.points, row.penalty, current_rating[id_])
-                     for id_, row in self.standing_by_id.items() if id_ in current_rating]
-        if standings:
-            self.delta_by_handle = CodeforcesRatingCalculator(standings).calculate_rating_changes()
+        return [(id_, row.points, row.penalty, current_rating[id_])
+                for id_, row in self.standing_by_id.items() if id_ in current_rating]
+
+    async def predict_in_executor(self, current_rating, previous=None):
+        """Predicts the rating changes from the current ratings of the contestants, in a worker
+        process. Returns the predicted deltas. If `previous`, an older ranklist of the same
+        contest, was predicted from the same standings and ratings, its deltas are reused
+        instead."""
+        standings = self._get_prediction_standings(current_rating)
+        if previous is not None and standings and previous.prediction_standings == standings:
+            self.delta_by_handle = previous.delta_by_handle
+        elif standings:
+            self.delta_by_handle = await executors.run_cpu_bound(predict_deltas, standings)
+        self.prediction_standings = standings
         self.deltas_status = 'Predicted'
+        return self.delta_by_handle
 
     def get_delta(self, handle):
         if not self.is_rated:
@@ -4,8 +4,6 @@ by Mike Mirzayanov (mirzayanovmr@gmail.com) at https://codeforces.com/contest/1/
 Updated to use the current rating formula.
 """
 
-from dataclasses import dataclass
-
 import numpy as np
 from numpy.fft import fft, ifft
 
@@ -14,23 +12,28 @@ def intdiv(x, y):
     return -(-x // y) if x < 0 else x // y
 
 
-@dataclass
-class Contestant:
-    party: str
-    points: float
-    penalty: int
-    rating: int
-    need_rating: int = 0
-    delta: int = 0
-    rank: float = 0.0
-    seed: float = 0.0
+def _intdiv_array(x, y):
+    """`intdiv` over an integer array."""
+    return np.where(x < 0, -(-x // y), x // y)
+
+
+def predict_deltas(standings):
+    """Return the predicted rating changes for the given standings. A plain function so that it
+    can be run in a worker process."""
+    return CodeforcesRatingCalculator(standings).calculate_rating_changes()
 
 
 class CodeforcesRatingCalculator:
+    MAX = 6144
+
     def __init__(self, standings):
-        """Calculate Codeforces rating changes and seeds given contest and user information."""
-        self.contestants = [Contestant(handle, points, penalty, rating)
-                            for handle, points, penalty, rating in standings]
+        """Calculate Codeforces rating changes and seeds given contest and user information.
+        Contestants are held as parallel arrays, in order of rank once ranks are assigned."""
+        parties, points, penalties, ratings = zip(*standings) if standings else ((),) * 4
+        self.parties = list(parties)
+        self.points = np.array(points, dtype=float)
+        self.penalties = np.array(penalties, dtype=np.int64)
+        self.ratings = np.array(ratings, dtype=np.int64)
         self._precalc_seed()
         self._reassign_ranks()
         self._process()
@@ -38,72 +41,78 @@ class CodeforcesRatingCalculator:
 
     def calculate_rating_changes(self):
         """Return a mapping between contestants and their corresponding delta."""
-        return {contestant.party: contestant.delta for contestant in self.contestants}
+        return dict(zip(self.parties, self.deltas.tolist()))
 
-    def get_seed(self, rating, me=None):
-        """Get seed given a rating and user."""
+    def get_seed(self, rating, me_rating=None):
+        """Get seed given a rating and the rating of the user, both may be arrays."""
         seed = self.seed[rating]
-        if me:
-            seed -= self.elo_win_prob[rating - me.rating]
+        if me_rating is not None:
+            seed = seed - self.elo_win_prob[rating - me_rating]
         return seed
 
     def _precalc_seed(self):
-        MAX = 6144
+        MAX = self.MAX
 
         # Precompute the ELO win probability for all possible rating differences.
         self.elo_win_prob = np.roll(1 / (1 + pow(10, np.arange(-MAX, MAX) / 400)), -MAX)
 
         # Compute the rating histogram.
         count = np.zeros(2 * MAX)
-        for a in self.contestants:
-            count[a.rating] += 1
+        np.add.at(count, self.ratings, 1)
 
         # Precompute the seed for all possible ratings using FFT.
         self.seed = 1 + ifft(fft(count) * fft(self.elo_win_prob)).real
 
     def _reassign_ranks(self):
-        """Find the rank of each contestant."""
-        contestants = self.contestants
-        contestants.sort(key=lambda o: (-o.points, o.penalty))
-        points = penalty = rank = None
-        for i in reversed(range(len(contestants))):
-            if contestants[i].points != points or contestants[i].penalty != penalty:
-                rank = i + 1
-                points = contestants[i].points
-                penalty = contestants[i].penalty
-            contestants[i].rank = rank
+        """Sort the contestants by rank and find the rank of each of them."""
+        # Stable, so ties keep the order in which contestants were given.
+        order = np.lexsort((self.penalties, -self.points))
+        self.parties = [self.parties[i] for i in order]
+        self.points = self.points[order]
+        self.penalties = self.penalties[order]
+        self.ratings = self.ratings[order]
+
+        # Tied contestants all get the rank of the last of them.
+        n = len(order)
+        is_last_of_tie = np.ones(n, dtype=bool)
+        is_last_of_tie[:-1] = ((self.points[1:] != self.points[:-1]) |
+                               (self.penalties[1:] != self.penalties[:-1]))
+        last_of_tie = np.flatnonzero(is_last_of_tie)
+        self.ranks = last_of_tie[np.searchsorted(last_of_tie, np.arange(n))] + 1
 
     def _process(self):
-        """Process and assign approximate delta for each contestant."""
-        for a in self.contestants:
-            a.seed = self.get_seed(a.rating, a)
-            mid_rank = (a.rank * a.seed) ** 0.5
-            a.need_rating = self._rank_to_rating(mid_rank, a)
-            a.delta = intdiv(a.need_rating - a.rating, 2)
-
-    def _rank_to_rating(self, rank, me):
-        """Binary Search to find the performance rating for a given rank."""
-        left, right = 1, 8000
-        while right - left > 1:
+        """Assign approximate delta for each contestant."""
+        self.seeds = self.get_seed(self.ratings, self.ratings)
+        mid_ranks = np.sqrt(self.ranks * self.seeds)
+        self.need_ratings = self._rank_to_rating(mid_ranks, self.ratings)
+        self.deltas = _intdiv_array(self.need_ratings - self.ratings, 2)
+
+    def _rank_to_rating(self, ranks, me_ratings):
+        """Binary search to find the performance rating for given ranks, for all contestants at
+        once."""
+        left = np.full(len(ranks), 1, dtype=np.int64)
+        right = np.full(len(ranks), 8000, dtype=np.int64)
+        active = right - left > 1
+        while active.any():
             mid = (left + right) // 2
-            if self.get_seed(mid, me) < rank:
-                right = mid
-            else:
-                left = mid
+            below = self.get_seed(mid, me_ratings) < ranks
+            right = np.where(active & below, mid, right)
+            left = np.where(active & ~below, mid, left)
+            active = right - left > 1
         return left
 
     def _update_delta(self):
         """Update the delta of each contestant."""
-        contestants = self.contestants
-        n = len(contestants)
+        n = len(self.deltas)
+        if not n:
+            return
 
-        contestants.sort(key=lambda o: -o.rating)
-        correction = intdiv(-sum(c.delta for c in contestants), n) - 1
-        for contestant in contestants:
-            contestant.delta += correction
+        correction = intdiv(-int(self.deltas.sum()), n) - 1
+        self.deltas += correction
 
+        # Stable, so contestants with the same rating stay in order of rank.
+        by_rating = np.argsort(-self.ratings, kind='stable')
         zero_sum_count = min(4 * round(n ** 0.5), n)
-        delta_sum = -sum(contestants[i].delta for i in range(zero_sum_count))
+        delta_sum = -int(self.deltas[by_rating[:zero_sum_count]].sum())
         correction = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
-        for contestant in contestants:
-            contestant.delta += correction
+        self.deltas += correction
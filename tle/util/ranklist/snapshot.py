@@ -0,0 +1,173 @@
+"""
+    Compact serialization of ranklists, used to persist them across restarts.
+
+    A ranklist is first turned into a state of plain lists, with the standings split in columns:
+    the lookup keys in standings order, the parties, the ranks and the results. A state is stored
+    either in full or as a delta against the previous state of the same contest. Between two
+    refreshes of a live ranklist most parties stay the same and most results do not change, so a
+    delta holds the new order, the ranks and only the rows that changed. Orders and ranks are
+    difference coded, which turns them into runs of small numbers, and every record is compressed
+    JSON.
+"""
+
+import itertools
+import json
+import zlib
+
+from tle.util.codeforces_api import Contest, Member, Party, Problem, ProblemResult, RanklistRow
+from tle.util.ranklist.ranklist import Ranklist
+
+
+def _diff(values):
+    return [cur - prev for prev, cur in zip(itertools.chain([0], values), values)]
+
+
+def _undiff(diffs):
+    return list(itertools.accumulate(diffs))
+
+
+def _party_to_plain(party):
+    return [party.contestId, [member.handle for member in party.members], party.participantType,
+            party.teamId, party.teamName, party.ghost, party.room, party.startTimeSeconds]
+
+
+def _party_from_plain(plain):
+    contest_id, handles, *rest = plain
+    return Party(contest_id, [Member(handle) for handle in handles], *rest)
+
+
+def _result_to_plain(row):
+    return [row.points, row.penalty, [list(result) for result in row.problemResults]]
+
+
+def from_ranklist(ranklist):
+    """Returns the state of `ranklist`."""
+    standings = ranklist.standings
+    return {
+        'contest': list(ranklist.contest),
+        'problems': [list(problem) for problem in ranklist.problems],
+        'fetch_time': ranklist.fetch_time,
+        'is_rated': ranklist.is_rated,
+        'deltas_status': ranklist.deltas_status,
+        'deltas': ranklist.delta_by_handle,
+        'keys': [Ranklist.get_ranklist_lookup_key(row) for row in standings],
+        'parties': [_party_to_plain(row.party) for row in standings],
+        'ranks': [row.rank for row in standings],
+        'results': [_result_to_plain(row) for row in standings],
+    }
+
+
+def to_ranklist(state):
+    """Returns the ranklist of which `state` is the state."""
+    standings = [
+        RanklistRow(_party_from_plain(party), rank, points, penalty,
+                    [ProblemResult(*result) for result in problem_results])
+        for party, rank, (points, penalty, problem_results)
+        in zip(state['parties'], state['ranks'], state['results'])]
+    ranklist = Ranklist(Contest(*state['contest']),
+                        [Problem(*problem) for problem in state['problems']],
+                        standings, state['fetch_time'], is_rated=state['is_rated'])
+    ranklist.delta_by_handle = state['deltas']
+    ranklist.deltas_status = state['deltas_status']
+    return ranklist
+
+
+def _pack(record):
+    return zlib.compress(json.dumps(record, separators=(',', ':')).encode())
+
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data))
+
+
+_HEADER_FIELDS = ('contest', 'problems', 'fetch_time', 'is_rated', 'deltas_status')
+
+
+def encode_full(state):
+    record = {field: state[field] for field in _HEADER_FIELDS}
+    record.update(deltas=state['deltas'], keys=state['keys'], parties=state['parties'],
+                  ranks=_diff(state['ranks']), results=state['results'])
+    return _pack(record)
+
+
+def encode_delta(prev, state):
+    """Encodes `state` as a delta against `prev`, the previous state of the same contest."""
+    index_by_key = {key: i for i, key in enumerate(prev['keys'])}
+    new_keys, new_parties, order, parties, results = [], [], [], [], []
+    for i, (key, party, result) in enumerate(zip(state['keys'], state['parties'],
+                                                 state['results'])):
+        j = index_by_key.get(key)
+        if j is None:
+            j = len(prev['keys']) + len(new_keys)
+            new_keys.append(key)
+            new_parties.append(party)
+            results.append([i, result])
+        else:
+            if prev['parties'][j] != party:
+                parties.append([i, party])
+            if prev['results'][j] != result:
+                results.append([i, result])
+        order.append(j)
+
+    deltas, prev_deltas = state['deltas'], prev['deltas']
+    if deltas is not None and prev_deltas is not None:
+        deltas = {'set': {handle: delta for handle, delta in deltas.items()
+                          if prev_deltas.get(handle) != delta},
+                  'removed': [handle for handle in prev_deltas if handle not in deltas]}
+    else:
+        deltas = {'all': deltas}
+
+    record = {field: state[field] for field in _HEADER_FIELDS}
+    record.update(deltas=deltas, new_keys=new_keys, new_parties=new_parties,
+                  order=_diff(order), parties=parties, ranks=_diff(state['ranks']),
+                  results=results)
+    return _pack(record)
+
+
+def encode(ranklist, prev, max_deltas):
+    """Returns the state of `ranklist`, its encoding and the number of deltas since the last full
+    encoding. `prev` is the previous state of the contest with its number of deltas, or None. The
+    state is encoded as a delta against it unless `max_deltas` deltas already follow a full one."""
+    state = from_ranklist(ranklist)
+    if prev is not None and prev[1] < max_deltas:
+        prev_state, num_deltas = prev
+        return state, encode_delta(prev_state, state), num_deltas + 1
+    return state, encode_full(state), 0
+
+
+def _apply_delta(prev, record):
+    order = _undiff(record['order'])
+    keys = prev['keys'] + record['new_keys']
+    parties = prev['parties'] + record['new_parties']
+    results = prev['results'] + [None] * len(record['new_keys'])
+
+    state = {field: record[field] for field in _HEADER_FIELDS}
+    state['keys'] = [keys[j] for j in order]
+    state['parties'] = [parties[j] for j in order]
+    state['results'] = [results[j] for j in order]
+    state['ranks'] = _undiff(record['ranks'])
+    for i, party in record['parties']:
+        state['parties'][i] = party
+    for i, result in record['results']:
+        state['results'][i] = result
+
+    deltas = record['deltas']
+    if 'all' in deltas:
+        state['deltas'] = deltas['all']
+    else:
+        state['deltas'] = dict(prev['deltas'])
+        for handle in deltas['removed']:
+            del state['deltas'][handle]
+        state['deltas'].update(deltas['set'])
+    return state
+
+
+def decode(data_list):
+    """Returns the state encoded by a full record followed by any number of deltas."""
+    full, *deltas = map(_unpack, data_list)
+    state = {field: full[field] for field in _HEADER_FIELDS}
+    state.update(deltas=full['deltas'], keys=full['keys'], parties=full['parties'],
+                 ranks=_undiff(full['ranks']), results=full['results'])
+    for record in deltas:
+        state = _apply_delta(state, record)
+    return state
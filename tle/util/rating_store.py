@@ -0,0 +1,203 @@
+"""
+    Columnar store of the rating changes saved in the cache database.
+
+    Rating changes are kept as parallel arrays sorted by rating update time: handle id, contest
+    id, rank, update time, old rating and new rating. Every column is a raw file in the store
+    directory which is memory-mapped when loaded. Changes of newly rated contests are appended to
+    the files, the store is only rewritten after a backfill. Handle ids are those of a
+    HandleTable, whose handles are listed one per line in the handles file in id order. The meta
+    file is written last and tells whether the other files are complete.
+
+    Arrays derived from the store, such as the current rating of every handle, can be saved
+    alongside it as a snapshot stamped with the number of rows they reflect. Since rows are only
+    appended, such a snapshot stays valid for the rows up to its stamp, and a rebuild removes it.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from tle.util.handle_table import HandleTable
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = {
+    'handle_id': np.int32,
+    'contest_id': np.int32,
+    'rank': np.int32,
+    'time': np.int64,
+    'old_rating': np.int32,
+    'new_rating': np.int32,
+}
+_HANDLES_FILE = 'handles.txt'
+_META_FILE = 'meta.json'
+_SNAPSHOT_FILE = 'snapshot.npz'
+_BUILD_CHUNK_SIZE = 100000
+_TIME = list(_COLUMNS).index('time')
+
+
+def _column_file(name):
+    return f'{name}.bin'
+
+
+def _map_column(path, dtype):
+    # np.memmap cannot map an empty file.
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def latest_rows(handle_ids):
+    """Returns the distinct handle ids and, for each, the index of its last row."""
+    ids, reversed_index = np.unique(handle_ids[::-1], return_index=True)
+    return ids, len(handle_ids) - 1 - reversed_index
+
+
+class RatingStore:
+    def __init__(self, path, handles=(), columns=None):
+        self.path = path
+        self.handles = HandleTable(handles)
+        self.columns = columns or {name: np.zeros(0, dtype=dtype)
+                                   for name, dtype in _COLUMNS.items()}
+        # Rows grouped by handle, built on first use: rows of handle i are
+        # _by_handle[_offsets[i]:_offsets[i + 1]], in time order.
+        self._by_handle = None
+        self._offsets = None
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    @property
+    def last_time(self):
+        return int(self.columns['time'][-1]) if len(self) else None
+
+    @classmethod
+    def load(cls, path):
+        """Maps the store saved at `path`. Returns None if there is none or it is incomplete."""
+        try:
+            with open(os.path.join(path, _META_FILE)) as f:
+                meta = json.load(f)
+            with open(os.path.join(path, _HANDLES_FILE)) as f:
+                handles = f.read().splitlines()
+            columns = {name: _map_column(os.path.join(path, _column_file(name)), dtype)
+                       for name, dtype in _COLUMNS.items()}
+        except (OSError, ValueError) as e:
+            logger.info(f'Rating store at {path} could not be loaded: {e!r}')
+            return None
+        store = cls(path, handles, columns)
+        # The handles could differ only in case in files written before handles were case
+        # folded, then the ids do not match.
+        if (len(store.handles) != meta['handles']
+                or any(len(column) != meta['rows'] for column in columns.values())):
+            logger.warning(f'Rating store at {path} is incomplete.')
+            return None
+        return store
+
+    @classmethod
+    def build(cls, path, rows):
+        """Writes a new store at `path` from `rows` of (handle, contest id, rank, update time,
+        old rating, new rating) in order of update time, and returns it."""
+        os.makedirs(path, exist_ok=True)
+        # The files are written under temporary names and then replaced, a store that is in use
+        # keeps its memory maps of the old files.
+        files = [_column_file(name) for name in _COLUMNS] + [_HANDLES_FILE]
+        for file in files:
+            open(os.path.join(path, file + '.tmp'), 'wb').close()
+        store = cls(path)
+        rows = iter(rows)
+        while True:
+            chunk = [row for _, row in zip(range(_BUILD_CHUNK_SIZE), rows)]
+            if not chunk:
+                break
+            store._write(chunk, suffix='.tmp')
+        for file in (_META_FILE, _SNAPSHOT_FILE):
+            try:
+                os.remove(os.path.join(path, file))
+            except FileNotFoundError:
+                pass
+        for file in files:
+            os.replace(os.path.join(path, file + '.tmp'), os.path.join(path, file))
+        store._write_meta()
+        return cls.load(path)
+
+    def append(self, rows):
+        """Appends `rows` as for `build`. They must be newer than all rows in the store."""
+        if not rows:
+            return
+        rows = sorted(rows, key=lambda row: row[_TIME])
+        if len(self) and rows[0][_TIME] < self.last_time:
+            raise ValueError('Appended rating changes must be newer than the stored ones.')
+        os.remove(os.path.join(self.path, _META_FILE))
+        self._write(rows)
+        self._write_meta()
+        self.columns = {name: _map_column(os.path.join(self.path, _column_file(name)), dtype)
+                        for name, dtype in _COLUMNS.items()}
+        self._by_handle = self._offsets = None
+
+    def _write(self, rows, suffix=''):
+        num_handles = len(self.handles)
+        handles, *values = zip(*rows)
+        values = [[self.handles.add(handle) for handle in handles]] + values
+        new_handles = [self.handles.canonical(i) for i in range(num_handles, len(self.handles))]
+        for (name, dtype), column in zip(_COLUMNS.items(), values):
+            with open(os.path.join(self.path, _column_file(name) + suffix), 'ab') as f:
+                f.write(np.array(column, dtype=dtype).tobytes())
+        with open(os.path.join(self.path, _HANDLES_FILE + suffix), 'a') as f:
+            f.writelines(f'{handle}\n' for handle in new_handles)
+
+    def _write_meta(self):
+        rows = os.path.getsize(os.path.join(self.path, _column_file('time'))) // 8
+        with open(os.path.join(self.path, _META_FILE), 'w') as f:
+            json.dump({'rows': rows, 'handles': len(self.handles)}, f)
+
+    def save_snapshot(self, **arrays):
+        """Saves arrays indexed by handle id, stamped with the current number of rows."""
+        tmp_path = os.path.join(self.path, _SNAPSHOT_FILE + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, rows=len(self), **arrays)
+        os.replace(tmp_path, os.path.join(self.path, _SNAPSHOT_FILE))
+
+    def load_snapshot(self):
+        """Returns the number of rows and the arrays of the saved snapshot, or None if there is
+        none that fits the store."""
+        try:
+            with np.load(os.path.join(self.path, _SNAPSHOT_FILE)) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            logger.info(f'Rating store snapshot could not be loaded: {e!r}')
+            return None
+        rows = int(arrays.pop('rows'))
+        if rows > len(self) or any(len(array) > len(self.handles) for array in arrays.values()):
+            logger.warning('Rating store snapshot does not fit the store.')
+            return None
+        return rows, arrays
+
+    def _group_by_handle(self):
+        if self._by_handle is None:
+            handle_ids = self.columns['handle_id']
+            # A stable sort keeps the rows of each handle in time order.
+            self._by_handle = np.argsort(handle_ids, kind='stable')
+            self._offsets = np.searchsorted(handle_ids[self._by_handle],
+                                            np.arange(len(self.handles) + 1))
+        return self._by_handle, self._offsets
+
+    def rows_of(self, handle):
+        """Returns the row indices of the handle, in any case, in time order."""
+        i = self.handles.get(handle)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        by_handle, offsets = self._group_by_handle()
+        return by_handle[offsets[i]:offsets[i + 1]]
+
+    def ratings_before(self, timestamp, handles):
+        """Returns the rating of each of the handles after its last rating change before
+        `timestamp`, or None if it had none."""
+        times, new_ratings = self.columns['time'], self.columns['new_rating']
+        ratings = []
+        for handle in handles:
+            rows = self.rows_of(handle)
+            k = np.searchsorted(times[rows], timestamp, side='left')
+            ratings.append(int(new_ratings[rows[k - 1]]) if k else None)
+        return ratings
@@ -3,6 +3,7 @@ import logging
 
 from discord.ext import commands
 
+import tle.util.codeforces_api as cf
 import tle.util.codeforces_common as cf_common
 
 
@@ -148,6 +149,8 @@ class Task:
             await asyncio.sleep(0)  # To ensure cancellation if called from within the task itself.
 
     async def _task(self):
+        # Background tasks should not hold up API requests made by commands.
+        cf.set_priority(cf.Priority.MONITOR)
         arg = None
         if self._waiter.run_first:
             arg = await self._waiter.wait(self.instance)